@@ -0,0 +1,225 @@
+"""Benchmark the tree operations on a synthetic tree.
+
+A tree of the given depth and fan-out is built in a scratch database of a
+local redis-server (which is flushed), with a share of its directories
+linked from /links. Each operation is then timed, and its ops/sec, p50/p99
+latencies and Redis round trips per call are reported as JSON:
+
+    python benchmark.py --depth 4 --fanout 8 --output results.json
+
+The operations are run --repeat times, after an untimed warmup, and the
+median of every statistic over the runs is reported.
+
+Give the results of a previous run with --baseline to compare against it:
+the run fails if an operation needs more round trips than in the baseline.
+Timings are noisy, so an operation whose median latencies got slower by more
+than --threshold and by more than --min-diff milliseconds is only reported,
+unless --fail-on-timings is given.
+"""
+
+import argparse
+import json
+import random
+import sys
+from time import time
+
+import redis
+
+from redistree import RedisTree
+
+
+class CountingConnection(redis.Connection):
+    """A connection counting the requests sent to Redis. A pipeline is sent
+    at once and counts as a single round trip."""
+
+    round_trips = 0
+
+    def send_packed_command(self, *args, **kwargs):
+        CountingConnection.round_trips += 1
+        return super(CountingConnection, self).send_packed_command(*args,
+                                                                   **kwargs)
+
+
+def build_tree(rt, depth, fanout, symlinks):
+    """Create the tree and return its leaves and the created links."""
+
+    directories = ['/tree']
+    level = ['/tree']
+    for _ in range(depth):
+        level = ['%s/%d' % (path, i) for path in level for i in range(fanout)]
+        directories.extend(level)
+    rt.create_many([(path, {'size': '0'}) for path in directories])
+
+    linked = random.sample(directories[1:],
+                           int((len(directories) - 1) * symlinks))
+    rt.create_child_node('/links')
+    links = []
+    for i, path in enumerate(linked):
+        rt.create_symlink(path, '/links/%d' % i)
+        links.append('/links/%d' % i)
+    return level, links
+
+
+def measure(func, args):
+    """Call func with every item of args and return its statistics."""
+
+    latencies = []
+    CountingConnection.round_trips = 0
+    start = time()
+    for arg in args:
+        t = time()
+        func(arg)
+        latencies.append(time() - t)
+    elapsed = time() - start
+
+    latencies.sort()
+    calls = len(latencies)
+    return {
+        'calls': calls,
+        'ops_per_sec': calls / elapsed,
+        'p50_ms': latencies[calls // 2] * 1000,
+        'p99_ms': latencies[min(calls - 1, int(calls * 0.99))] * 1000,
+        'round_trips': CountingConnection.round_trips / float(calls),
+    }
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def run_operations(rt, n, fanout, leaves, links):
+    """Time every operation n times and return their statistics."""
+
+    subtrees = ['/tree/%d' % (i % fanout) for i in range(n)]
+    copies = ['/copy%d' % i for i in range(n)]
+    results = {}
+
+    results['real_node'] = measure(
+        rt.real_node, [random.choice(leaves) for _ in range(n)])
+    if links:
+        results['real_node_symlink'] = measure(
+            lambda path: rt.real_node(path, full=True),
+            [random.choice(links) for _ in range(n)])
+    results['copy_path'] = measure(
+        lambda i: rt.copy_path(subtrees[i], copies[i]), range(n))
+    results['move_node'] = measure(
+        lambda i: rt.move_node(copies[i], copies[i] + 'm'), range(n))
+    results['delete_node'] = measure(
+        lambda i: rt.delete_node(copies[i] + 'm'), range(n))
+    return results
+
+
+def run(options):
+    pool = redis.ConnectionPool(host=options.host, port=options.port,
+                                db=options.db,
+                                connection_class=CountingConnection)
+    rt = RedisTree(connection_pool=pool, use_scripts=not options.no_scripts)
+    rt.r.flushdb()
+    rt.init_fs(layout=options.layout, path_index=options.path_index)
+
+    random.seed(options.seed)
+    start = time()
+    leaves, links = build_tree(rt, options.depth, options.fanout,
+                               options.symlinks)
+    build = time() - start
+
+    if options.warmup:
+        run_operations(rt, options.warmup, options.fanout, leaves, links)
+    runs = [run_operations(rt, options.iterations, options.fanout, leaves,
+                           links)
+            for _ in range(options.repeat)]
+    results = {}
+    for name in runs[0]:
+        results[name] = dict(
+            (stat, median([r[name][stat] for r in runs]))
+            for stat in runs[0][name])
+
+    return {
+        'parameters': dict(vars(options), nodes=len(rt.r.keys('NODE:*'))),
+        'build_seconds': build,
+        'operations': results,
+    }
+
+
+def compare(results, baseline, threshold, min_diff):
+    """Return the regressions of results against baseline, as messages: the
+    operations needing more round trips, and the ones whose mean or p50
+    latency got slower by more than threshold and min_diff milliseconds."""
+
+    round_trips, timings = [], []
+    for name, new in results['operations'].items():
+        old = baseline['operations'].get(name)
+        if old is None:
+            continue
+        # The seed is fixed, so the round trips of a run are exact.
+        if new['round_trips'] > old['round_trips'] + 0.01:
+            round_trips.append('%s: %.2f round trips, was %.2f' % (
+                name, new['round_trips'], old['round_trips']))
+        latencies = [
+            ('mean', 1000 / new['ops_per_sec'], 1000 / old['ops_per_sec']),
+            ('p50', new['p50_ms'], old['p50_ms']),
+        ]
+        for stat, new_ms, old_ms in latencies:
+            if new_ms > old_ms * (1 + threshold) and \
+                    new_ms - old_ms > min_diff:
+                timings.append('%s: %s %.3fms, was %.3fms' % (
+                    name, stat, new_ms, old_ms))
+    return round_trips, timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=6379)
+    parser.add_argument('--db', type=int, default=15,
+                        help='scratch database, flushed by the run')
+    parser.add_argument('--depth', type=int, default=4)
+    parser.add_argument('--fanout', type=int, default=8)
+    parser.add_argument('--symlinks', type=float, default=0.1,
+                        help='share of the directories having a symlink')
+    parser.add_argument('--layout', choices=['path', 'uid'], default='path')
+    parser.add_argument('--path-index', action='store_true')
+    parser.add_argument('--no-scripts', action='store_true')
+    parser.add_argument('--iterations', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='runs of the operations, reported by median')
+    parser.add_argument('--warmup', type=int, default=20,
+                        help='untimed iterations before the runs')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results to this file')
+    parser.add_argument('--baseline', help='results of a previous run')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='tolerated slowdown against the baseline')
+    parser.add_argument('--min-diff', type=float, default=0.1,
+                        help='tolerated slowdown in milliseconds')
+    parser.add_argument('--fail-on-timings', action='store_true',
+                        help='fail on slowdowns, not only on round trips')
+    options = parser.parse_args()
+
+    results = run(options)
+    report = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print(report)
+
+    if options.baseline:
+        with open(options.baseline) as f:
+            round_trips, timings = compare(results, json.load(f),
+                                           options.threshold,
+                                           options.min_diff)
+        for regression in round_trips:
+            sys.stderr.write('regression: %s\n' % regression)
+        for regression in timings:
+            sys.stderr.write('slower: %s\n' % regression)
+        if round_trips or (timings and options.fail_on_timings):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""Compare the memory used by a synthetic tree with each NODE codec.
+
+The same tree, of the given depth and fan-out and with a few small
+attributes per node, is built in a scratch database of a local redis-server
+(which is flushed) once per codec of redistree.codec. The MEMORY USAGE of
+every key is summed by family (NODE, NODES buckets, TREE, other), and the
+encodings of the TREE hashes are counted: the ones above
+hash-max-listpack-entries (or hash-max-ziplist-entries) are stored as real
+hash tables.
+
+    python memory_usage.py --depth 4 --fanout 8
+"""
+
+import argparse
+import json
+
+import redis
+
+from redistree import RedisTree
+from redistree.codec import CODECS
+
+
+def build_tree(rt, depth, fanout):
+    entries = []
+    level = ['/tree']
+    for _ in range(depth):
+        level = ['%s/%d' % (path, i) for path in level for i in range(fanout)]
+        entries.extend(level)
+    rt.create_many([(path, {
+        'size': str(len(path) * 4096),
+        'mtime': str(1500000000 + i),
+        'mode': '0644',
+        'owner': 'user%d' % (i % 100),
+    }) for i, path in enumerate(entries)])
+    return len(entries)
+
+
+def measure(r, batch_size=1000):
+    """Return the memory used by the keys of the database, by family, and the
+    encodings of the TREE hashes."""
+
+    usage = {'NODE': 0, 'NODES': 0, 'TREE': 0, 'other': 0}
+    encodings = {}
+    keys = list(r.scan_iter(count=batch_size))
+    for i in range(0, len(keys), batch_size):
+        batch = keys[i:i + batch_size]
+        pipe = r.pipeline(transaction=False)
+        for key in batch:
+            pipe.execute_command('MEMORY', 'USAGE', key, 'SAMPLES', '0')
+            pipe.object('encoding', key)
+        res = pipe.execute()
+        for key, size, encoding in zip(batch, res[::2], res[1::2]):
+            family = key.split(b':')[0].decode('utf-8')
+            if family not in usage:
+                family = 'other'
+            usage[family] += size or 0
+            if family == 'TREE':
+                encoding = encoding.decode('utf-8')
+                encodings[encoding] = encodings.get(encoding, 0) + 1
+    return usage, encodings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=6379)
+    parser.add_argument('--db', type=int, default=15,
+                        help='scratch database, flushed by the run')
+    parser.add_argument('--depth', type=int, default=4)
+    parser.add_argument('--fanout', type=int, default=8)
+    parser.add_argument('--layout', choices=['path', 'uid'], default='path')
+    options = parser.parse_args()
+
+    pool = redis.ConnectionPool(host=options.host, port=options.port,
+                                db=options.db)
+    rt = RedisTree(connection_pool=pool)
+    raw = redis.Redis(connection_pool=redis.ConnectionPool(
+        host=options.host, port=options.port, db=options.db))
+
+    results = {}
+    for name in CODECS:
+        rt.r.flushdb()
+        rt.init_fs(layout=options.layout, node_codec=name)
+        nodes = build_tree(rt, options.depth, options.fanout)
+        usage, encodings = measure(raw)
+        results[name] = {
+            'nodes': nodes,
+            'bytes': usage,
+            'bytes_per_node': sum(usage.values()) / float(nodes),
+            'tree_encodings': encodings,
+        }
+    rt.r.flushdb()
+
+    config = rt.r.config_get('hash-max-*-entries')
+    print(json.dumps({'hash_config': config, 'codecs': results}, indent=2,
+                     sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
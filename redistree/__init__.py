@@ -1 +1,4 @@
-from core import RedisTree
+from redistree.core import RedisTree, BrokenPath, NodeExists, SymlinkLoopError, \
+    SnapshotNotFound
+from redistree.cache import PathCache
+from redistree.instrument import Instrumentation
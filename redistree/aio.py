@@ -0,0 +1,849 @@
+"""
+asyncio version of RedisTreeCore.
+
+This module needs Python 3.5+ and redis-py 4.2+ (redis.asyncio), so it is not
+imported by the redistree package:
+
+    from redistree.aio import AsyncRedisTree
+"""
+
+import asyncio
+import posixpath
+from time import time
+
+import redis
+import redis.asyncio
+
+from redistree import codec
+from redistree.core import (CREATE_SCRIPT, LINK_FIELDS, RESOLVE_SCRIPT,
+                            BrokenPath, CopyResult, NodeExists,
+                            ScriptingUnavailable, SymlinkLoopError,
+                            check_move, link_destination)
+
+
+class AsyncRedisTree:
+    """
+    The RedisTreeCore API, as coroutines.
+
+    All the tree operations share a blocking pool of at most max_connections
+    connections, so any number of concurrent calls can be in flight. Subtree
+    operations (copy_path, delete_node) run the pipelines of a level
+    concurrently, at most concurrency of them at a time.
+
+    A connection pool given to the constructor must decode responses.
+    """
+
+    def __init__(self, connection_pool=None, redis_host='localhost',
+                                             redis_port=6379,
+                                             redis_db=0,
+                                             max_connections=10,
+                                             concurrency=8,
+                                             use_scripts=True,
+                                             path_cache=None,
+                                             publish_invalidations=False,
+                                             max_symlink_hops=40,
+                                             uid_block_size=None):
+
+        self.ROOT_NODE = -9223372036854775807
+
+        if connection_pool:
+            self.pool = connection_pool
+        else:
+            self.pool = redis.asyncio.BlockingConnectionPool(
+                host=redis_host, port=redis_port, db=redis_db,
+                max_connections=max_connections, decode_responses=True)
+
+        self.r = redis.asyncio.Redis(connection_pool=self.pool)
+        self.concurrency = concurrency
+
+        self.use_scripts = use_scripts
+        self._scripts = {}
+        self.use_unlink = True
+        self.max_symlink_hops = max_symlink_hops
+
+        self.path_cache = path_cache
+        self.publish_invalidations = publish_invalidations
+        self.INVALIDATION_CHANNEL = 'TREE_INVALIDATE'
+
+        self.uid_block_size = uid_block_size
+        self._uid_lock = asyncio.Lock()
+        self._uid_next = None
+        self._uid_end = None
+
+        self._layout = None
+        self._path_index = None
+        self._node_codec = None
+        self._aggregate = None
+        self._change_feed = None
+
+    async def close(self):
+        """Release the leased uids and close the connections of the pool."""
+        await self.release_uids()
+        await self.pool.disconnect()
+
+    async def get_layout(self):
+        """The TREE hashes layout of the tree: 'path' or 'uid'."""
+        if self._layout is None:
+            self._layout = await self.r.get('TREE_LAYOUT') or 'path'
+        return self._layout
+
+    async def get_path_index(self):
+        """'1' if the tree maintains PATHINDEX, '0' otherwise. The index is
+        used for lookups, but can't be maintained by AsyncRedisTree."""
+        if self._path_index is None:
+            self._path_index = await self.r.get('TREE_PATHINDEX') or '0'
+        return self._path_index
+
+    async def get_node_codec(self):
+        """The storage codec of the NODE attributes: 'plain' or 'packed'.
+        AsyncRedisTree reads both, but writes attributes the plain way."""
+        if self._node_codec is None:
+            self._node_codec = await self.r.get('TREE_CODEC') or 'plain'
+        return self._node_codec
+
+    async def node_commands(self, uid, fields=None):
+        """Return the commands reading the attributes of a node, for
+        _pipelined and codec.decode. See RedisTreeCore.read_node."""
+        if fields is None:
+            commands = [('hgetall', ("NODE:%s" % uid,))]
+        else:
+            commands = [('hmget', ("NODE:%s" % uid, list(fields)))]
+        if await self.get_node_codec() == 'packed':
+            commands.append(('hget', codec.bucket(uid)))
+        return commands
+
+    async def check_writable(self):
+        """Refuse to modify a tree maintaining indexes, aggregates or a
+        change feed this class doesn't know how to update."""
+        if await self.get_path_index() == '1':
+            raise Exception("AsyncRedisTree can't maintain PATHINDEX")
+        if self._aggregate is None:
+            self._aggregate = await self.r.get('TREE_AGGREGATE') or ''
+        if self._aggregate:
+            raise Exception("AsyncRedisTree can't maintain the DU aggregates")
+        if self._change_feed is None:
+            self._change_feed = await self.r.get('TREE_CHANGEFEED') or ''
+        if self._change_feed:
+            raise Exception("AsyncRedisTree can't append to the change feed")
+
+    async def tree_key(self, path, uid):
+        """Return the key of the TREE hash holding the children of the node
+        living at the given real path and having the given uid."""
+        if await self.get_layout() == 'uid':
+            return "TREE:%s" % uid
+        return "TREE:%s" % path
+
+    async def init_fs(self, layout='path'):
+        """Create the root node and the ID counter, if they don't exist."""
+        await self.r.setnx('TREE_LAYOUT', layout)
+        self._layout = None
+        self._node_codec = None
+        self._aggregate = None
+        self._change_feed = None
+        if await self.r.setnx('NODE_COUNTER', str(self.ROOT_NODE)):
+            await self.create_node({'name': 'root'}, uid=self.ROOT_NODE)
+
+    async def create_node(self, attributes, uid=None):
+        """Create a NODE entry and assign it with the given attributes."""
+        if uid is None:
+            uid = await self.allocate_uids()
+
+        await self.r.hset("NODE:%s" % uid, mapping=attributes)
+        return uid
+
+    async def allocate_uids(self, count=1):
+        """Reserve count consecutive uids and return the first one. See
+        RedisTreeCore.allocate_uids."""
+
+        if not self.uid_block_size or count > self.uid_block_size:
+            return await self.r.incrby('NODE_COUNTER', count) - count + 1
+
+        async with self._uid_lock:
+            if self._uid_next is None or self._uid_next + count > \
+                    self._uid_end + 1:
+                await self._release_block()
+                await self._lease_block(count)
+            uid = self._uid_next
+            self._uid_next += count
+            return uid
+
+    async def _lease_block(self, count):
+        free = await self.r.lpop('FREE_UIDS')
+        if free is not None:
+            start, end = [int(bound) for bound in free.split()]
+            if end - start + 1 >= count:
+                self._uid_next, self._uid_end = start, end
+                return
+            await self.r.rpush('FREE_UIDS', free)
+
+        self._uid_end = await self.r.incrby('NODE_COUNTER',
+                                            self.uid_block_size)
+        self._uid_next = self._uid_end - self.uid_block_size + 1
+
+    async def _release_block(self):
+        if self._uid_next is not None and self._uid_next <= self._uid_end:
+            await self.r.rpush('FREE_UIDS',
+                               '%d %d' % (self._uid_next, self._uid_end))
+        self._uid_next = self._uid_end = None
+
+    async def release_uids(self):
+        """Give the unused uids of the leased block back to FREE_UIDS."""
+        async with self._uid_lock:
+            await self._release_block()
+
+    async def create_child_node(self, path, attributes=None, resolve=True,
+                                exclusive=False):
+        """Create a node and attach it to the parent living at the given
+        path. See RedisTreeCore.create_child_node."""
+
+        await self.check_writable()
+
+        parent, name = posixpath.split(path)
+
+        if attributes is None:
+            attributes = {'name': name}
+
+        uid = self.uid_block_size and await self.allocate_uids() or None
+
+        if self.use_scripts:
+            fields = []
+            for item in attributes.items():
+                fields.extend(item)
+            try:
+                new_uid, real_path = await self.run_script(
+                    CREATE_SCRIPT, await self.get_layout(), '0',
+                    self.max_symlink_hops, self.ROOT_NODE,
+                    exclusive and '1' or '0', resolve and '1' or '0',
+                    uid or '', name, '', '', 0, len(fields),
+                    *(fields + self.split_path(parent)))
+            except ScriptingUnavailable:
+                pass
+            except redis.ResponseError as e:
+                if str(e) == 'Broken path':
+                    raise BrokenPath(parent)
+                if str(e) == 'Node exists':
+                    raise NodeExists(path)
+                if str(e) == 'Too many levels of symbolic links':
+                    raise SymlinkLoopError(parent)
+                raise
+            else:
+                await self.invalidate(real_path)
+                return str(new_uid)
+
+        if await self.get_layout() == 'uid' or resolve:
+            real_parent, parent_uid = await self.real_node(parent, full=True)
+        else:
+            real_parent, parent_uid = parent, None
+        parent_key = await self.tree_key(real_parent, parent_uid)
+        # The parent is detached from the TREE hash of the grandparent.
+        watched = [parent_key]
+        packed = await self.get_node_codec() == 'packed'
+        if parent_uid is not None:
+            watched.append("NODE:%s" % parent_uid)
+            if packed:
+                watched.append(codec.bucket(parent_uid)[0])
+        if real_parent != '/':
+            grandparent, parent_name = posixpath.split(real_parent.rstrip('/'))
+            grandparent_uid = None
+            if await self.get_layout() == 'uid':
+                grandparent_uid = await self.get_node_at_path(grandparent)
+            grandparent_key = await self.tree_key(grandparent,
+                                                  grandparent_uid)
+            watched.append(grandparent_key)
+
+        if uid is None:
+            uid = await self.allocate_uids()
+
+        async with self.r.pipeline() as pipe:
+            while True:
+                try:
+                    await pipe.watch(*watched)
+                    if real_parent != '/':
+                        entry = await pipe.hget(grandparent_key, parent_name)
+                        if entry is None or (parent_uid is not None and
+                                             entry != str(parent_uid)):
+                            raise BrokenPath(parent)
+                    if parent_uid is not None and not (
+                            await pipe.exists("NODE:%s" % parent_uid) or
+                            packed and
+                            await pipe.hexists(*codec.bucket(parent_uid))):
+                        raise BrokenPath(parent)
+                    if exclusive and await pipe.hexists(parent_key, name):
+                        raise NodeExists(path)
+                    pipe.multi()
+                    pipe.hset("NODE:%s" % uid, mapping=attributes)
+                    pipe.hset(parent_key, name, uid)
+                    await pipe.execute()
+                    break
+                except redis.WatchError:
+                    continue
+
+        await self.invalidate(posixpath.join(real_parent, name))
+        return str(uid)
+
+    async def run_script(self, source, *args):
+        """Run a Lua script with EVALSHA. See RedisTreeCore.run_script."""
+
+        for attempt in range(2):
+            sha = self._scripts.get(source)
+            try:
+                if sha is None:
+                    sha = await self.r.script_load(source)
+                    self._scripts[source] = sha
+                return await self.r.evalsha(sha, 0, *args)
+            except redis.exceptions.NoScriptError:
+                if attempt == 0:
+                    del self._scripts[source]
+                    continue
+                raise
+            except redis.ResponseError as e:
+                if 'unknown command' in str(e).lower():
+                    self.use_scripts = False
+                    raise ScriptingUnavailable(str(e))
+                raise
+
+    def split_path(self, path):
+        """Return the list of the components of an absolute path."""
+        chunks = path.split('/')
+        del chunks[0]
+        if chunks[-1] == '':
+            chunks.pop()
+        return chunks
+
+    async def real_node(self, path, full=False):
+        """Returns the expanded ("real") path version of the given path and
+        the node number. See RedisTreeCore.real_node."""
+
+        if self.path_cache is not None:
+            cached = self.path_cache.get(path, full)
+            if cached is not None:
+                return cached
+
+        current_path, current_node = await self.resolve(path, full)
+
+        if self.path_cache is not None:
+            self.path_cache.set(path, full, current_path, current_node)
+        return current_path, current_node
+
+    async def resolve(self, path, full=False):
+        """Uncached version of real_node."""
+
+        chunks = self.split_path(path)
+
+        if self.use_scripts:
+            try:
+                res = await self.run_script(RESOLVE_SCRIPT,
+                                            full and '1' or '0',
+                                            await self.get_layout(),
+                                            await self.get_path_index(),
+                                            self.max_symlink_hops,
+                                            self.ROOT_NODE, *chunks)
+            except ScriptingUnavailable:
+                pass
+            except redis.ResponseError as e:
+                if str(e) == 'Broken path':
+                    raise BrokenPath(path)
+                if str(e) == 'Too many levels of symbolic links':
+                    raise SymlinkLoopError(path)
+                raise Exception(str(e))
+            else:
+                current_path, current_node = res
+                if current_node == str(self.ROOT_NODE):
+                    current_node = self.ROOT_NODE
+                return current_path, current_node
+
+        return await self.walk_real_node(chunks, full)
+
+    async def walk_real_node(self, chunks, full=False):
+        """Client-side version of real_node, taking the path components."""
+
+        chunks = list(chunks)
+        current_path = '/'
+        current_node = self.ROOT_NODE
+        hops = 0
+
+        while True:
+            if len(chunks) == 0 and not full:
+                break
+
+            link = link_destination(await self.r.hmget(
+                "NODE:%s" % current_node, LINK_FIELDS))
+
+            if link is not None:
+                hops += 1
+                if hops > self.max_symlink_hops:
+                    raise SymlinkLoopError(current_path)
+                current_path, current_node = link
+                continue
+
+            if len(chunks) == 0 and full:
+                break
+
+            next_chunk = chunks.pop(0)
+            current_node = await self.r.hget(
+                await self.tree_key(current_path, current_node), next_chunk)
+            if current_node is None:
+                raise BrokenPath('/'.join([current_path, next_chunk]))
+            if current_path == '/':
+                current_path = ''
+            current_path = '/'.join([current_path, next_chunk])
+
+        return current_path, current_node
+
+    async def invalidate(self, *paths):
+        """Tell the path caches that the tree changed at the given paths."""
+
+        if self.path_cache is not None:
+            for path in paths:
+                self.path_cache.invalidate(path)
+
+        if self.publish_invalidations:
+            pipe = self.r.pipeline(transaction=False)
+            for path in paths:
+                pipe.publish(self.INVALIDATION_CHANNEL, path)
+            await pipe.execute()
+
+    async def get_node_at_path(self, *args, **kwargs):
+        """Return the NODE uid composant of real_node."""
+        return (await self.real_node(*args, **kwargs))[1]
+
+    async def get_real_path(self, *args, **kwargs):
+        """Return the path composant of real_node."""
+        return (await self.real_node(*args, **kwargs))[0]
+
+    async def get_node_info(self, node_id, fields=None):
+        """Return the attributes of a node, or only the given fields of
+        them."""
+        return (await self.get_nodes_info([node_id], fields))[0]
+
+    async def get_nodes_info(self, uids, fields=None, batch_size=1000):
+        """Return the list of the attributes of several nodes. See
+        RedisTreeCore.get_nodes_info."""
+        commands = []
+        for uid in uids:
+            commands.extend(await self.node_commands(uid, fields))
+        res = iter(await self._pipelined(commands, batch_size))
+        packed = await self.get_node_codec() == 'packed'
+        return [codec.decode(res, fields, packed) for _ in uids]
+
+    async def listdir_with_info(self, path, fields=None):
+        """Return a hash of name:(node_uid, attributes) of the children at
+        the given path. See RedisTreeCore.listdir_with_info."""
+        children = await self.get_children(path)
+        names = list(children)
+        infos = await self.get_nodes_info([children[name] for name in names],
+                                          fields)
+        return dict((name, (children[name], info))
+                    for name, info in zip(names, infos))
+
+    async def move_node(self, orig_path, dest_path):
+        """Move the subtree starting at orig_path to dest_path."""
+
+        await self.check_writable()
+
+        if await self.get_layout() == 'uid':
+            real_orig, real_dest = await self._move_node_uid(orig_path,
+                                                             dest_path)
+        else:
+            real_orig, real_dest = await self._move_node_path(orig_path,
+                                                              dest_path)
+        await self.invalidate(real_orig, real_dest)
+
+    async def _move_node_path(self, orig_path, dest_path):
+        check_move(orig_path, dest_path)
+        parent, name = posixpath.split(orig_path)
+        dest_parent, dest_name = posixpath.split(dest_path)
+
+        uid = await self.r.hget("TREE:%s" % parent, name)
+        if uid is None:
+            raise BrokenPath(orig_path)
+
+        nodes = await self.list_subtree(orig_path, uid)
+
+        pipe = self.r.pipeline()
+        pipe.hdel("TREE:%s" % parent, name)
+        pipe.hset("TREE:%s" % dest_parent, dest_name, uid)
+        for path, _, has_children in nodes:
+            if has_children:
+                pipe.rename("TREE:%s" % path,
+                            "TREE:%s%s" % (dest_path, path[len(orig_path):]))
+        if await self.has_links():
+            await self._move_links(pipe, nodes, orig_path, dest_path)
+        await pipe.execute()
+        return orig_path, dest_path
+
+    async def _move_node_uid(self, orig_path, dest_path):
+        parent, name = posixpath.split(orig_path)
+        dest_parent, dest_name = posixpath.split(dest_path)
+
+        parent_node, dest_node = await asyncio.gather(
+            self.real_node(parent, full=True),
+            self.real_node(dest_parent, full=True))
+        parent_key = await self.tree_key(*parent_node)
+        dest_key = await self.tree_key(*dest_node)
+        real_orig = posixpath.join(parent_node[0], name)
+        real_dest = posixpath.join(dest_node[0], dest_name)
+        check_move(real_orig, real_dest)
+
+        nodes = []
+        has_links = await self.has_links()
+        if has_links:
+            nodes = await self.list_subtree(
+                real_orig, await self.get_node_at_path(real_orig))
+
+        async with self.r.pipeline() as pipe:
+            while True:
+                try:
+                    await pipe.watch(parent_key)
+                    uid = await pipe.hget(parent_key, name)
+                    if uid is None:
+                        raise BrokenPath(orig_path)
+                    pipe.multi()
+                    pipe.hdel(parent_key, name)
+                    pipe.hset(dest_key, dest_name, uid)
+                    if has_links:
+                        await self._move_links(pipe, nodes, real_orig,
+                                               real_dest)
+                    await pipe.execute()
+                    return real_orig, real_dest
+                except redis.WatchError:
+                    continue
+
+    async def list_subtree(self, path, uid, batch_size=1000):
+        """Return the (real path, uid, has_children) tuples of every node of
+        the subtree, breadth-first."""
+
+        nodes = []
+        level = [(path, uid)]
+        while level:
+            keys = [await self.tree_key(path, uid) for path, uid in level]
+            res = await self._pipelined([('hgetall', (key,)) for key in keys],
+                                        batch_size)
+            next_level = []
+            for (path, uid), content in zip(level, res):
+                nodes.append((path, uid, bool(content)))
+                for child, child_uid in content.items():
+                    next_level.append((posixpath.join(path, child), child_uid))
+            level = next_level
+        return nodes
+
+    async def has_links(self):
+        """Whether any node of the tree is the final target of a symlink, or
+        the target of a link to a symlink."""
+        return bool(await self.r.scard('LINKED'))
+
+    def register_link(self, pipe, uid, target_node, final_node):
+        """Queue the registration of a link. See
+        RedisTreeCore.register_link."""
+        pipe.sadd("LINKS:%s" % final_node, uid)
+        pipe.sadd('LINKED', final_node)
+        if str(target_node) != str(final_node):
+            pipe.sadd("CHAINS:%s" % target_node, uid)
+            pipe.sadd('LINKED', target_node)
+
+    async def chained_links(self, links):
+        """Return links along with the links going through them. See
+        RedisTreeCore.chained_links."""
+        result = set(links)
+        level = result
+        while level:
+            res = await self._pipelined([('smembers', ("CHAINS:%s" % link,))
+                                         for link in level])
+            level = set().union(*res) - result
+            result |= level
+        return result
+
+    async def _move_links(self, pipe, nodes, orig_path, dest_path):
+        """Queue the updates of the final_target of the links to the moved
+        nodes."""
+
+        res = await self._pipelined([('smembers', ("LINKS:%s" % uid,))
+                                     for _, uid, _ in nodes])
+        for (path, _, _), links in zip(nodes, res):
+            for link in links:
+                pipe.hset("NODE:%s" % link, 'final_target',
+                          dest_path + path[len(orig_path):])
+
+    async def get_children(self, path):
+        """Return a hash of name:node_uid of the children at the given path."""
+        if await self.get_layout() == 'uid':
+            try:
+                key = await self.tree_key(*await self.real_node(path))
+            except BrokenPath:
+                return {}
+        else:
+            key = "TREE:%s" % path
+        return await self.r.hgetall(key)
+
+    async def create_symlink(self, target_path, path):
+        """Create a symlink between one tree to another."""
+
+        target_node = await self.get_node_at_path(target_path)
+        final_target, final_node = await self.real_node(target_path, full=True)
+        uid = await self.create_child_node(path, {
+            'target': target_path,
+            'target_node': target_node,
+            'final_target': final_target,
+            'final_node': final_node,
+        })
+
+        pipe = self.r.pipeline()
+        self.register_link(pipe, uid, target_node, final_node)
+        await pipe.execute()
+        return uid
+
+    async def get_target(self, path):
+        """Return the target of a symlink (where it points to)."""
+
+        if await self.get_layout() == 'uid':
+            uid = await self.get_node_at_path(path)
+        else:
+            parent, name = posixpath.split(path)
+            uid = await self.r.hget("TREE:%s" % parent, name)
+            if not uid:
+                raise BrokenPath(path)
+        return await self.r.hget("NODE:%s" % uid, 'target')
+
+    async def is_symlink(self, path):
+        """Return a boolean indicating whether the node is a symlink or not."""
+        return bool(await self.get_target(path))
+
+    async def delete_node(self, apath, background=False, batch_size=1000):
+        """Remove a subtree starting at apath and delete the associated node
+        entries. See RedisTreeCore.delete_node; with background=True, the
+        reclamation runs in a task which is returned."""
+
+        await self.check_writable()
+        if await self.r.scard('SNAPSHOTS'):
+            raise Exception("AsyncRedisTree can't keep the nodes of snapshots")
+
+        rpath, ruid = await self.real_node(apath)
+        parent, name = posixpath.split(rpath)
+        if await self.get_layout() == 'uid':
+            parent_key = await self.tree_key(*await self.real_node(parent))
+        else:
+            parent_key = await self.tree_key(parent, None)
+
+        links = await self.chained_links(
+            await self.r.smembers("LINKS:%s" % ruid) |
+            await self.r.smembers("CHAINS:%s" % ruid))
+
+        pipe = self.r.pipeline()
+        pipe.hdel(parent_key, name)
+        for link in links:
+            pipe.hset("NODE:%s" % link, 'dangling', '1')
+        if not (await pipe.execute())[0]:
+            raise BrokenPath(apath)
+        await self.invalidate(apath, rpath)
+
+        reclaim = self.reclaim_subtree(rpath, ruid, batch_size)
+        if background:
+            return asyncio.ensure_future(reclaim)
+        return await reclaim
+
+    async def reclaim_subtree(self, path, uid, batch_size=1000):
+        """Delete the NODE and TREE hashes of a detached subtree."""
+
+        has_links = await self.has_links()
+        packed = await self.get_node_codec() == 'packed'
+
+        count = 0
+        level = [(path, uid)]
+        while level:
+            keys = [await self.tree_key(path, uid) for path, uid in level]
+            commands = []
+            for (path, uid), key in zip(level, keys):
+                commands.append(('hgetall', (key,)))
+                if has_links:
+                    commands.append(('smembers', ("LINKS:%s" % uid,)))
+                    commands.append(('smembers', ("CHAINS:%s" % uid,)))
+                    commands.append(('hmget', ("NODE:%s" % uid,
+                                               ['target_node', 'final_node'])))
+            res = iter(await self._pipelined(commands, batch_size))
+
+            delete = []
+            next_level = []
+            dangling = set()
+            commands = []
+            for (path, uid), key in zip(level, keys):
+                content = next(res)
+                delete.append("NODE:%s" % uid)
+                if packed:
+                    commands.append(('hdel', codec.bucket(uid)))
+                if content:
+                    delete.append(key)
+                for child, child_uid in content.items():
+                    next_level.append((posixpath.join(path, child), child_uid))
+
+                if has_links:
+                    links, chains = next(res), next(res)
+                    target_node, final_node = next(res)
+                    dangling.update(links, chains)
+                    if links:
+                        delete.append("LINKS:%s" % uid)
+                    if chains:
+                        delete.append("CHAINS:%s" % uid)
+                    if links or chains:
+                        commands.append(('srem', ('LINKED', uid)))
+                    if final_node is not None:
+                        commands.append(('srem', ("LINKS:%s" % final_node,
+                                                  uid)))
+                        if target_node != final_node:
+                            commands.append(('srem', (
+                                "CHAINS:%s" % target_node, uid)))
+            for link in await self.chained_links(dangling):
+                commands.append(('hset', ("NODE:%s" % link, 'dangling', '1')))
+            await self._pipelined(commands, batch_size)
+            await self.delete_keys(delete, batch_size)
+
+            count += len(level)
+            level = next_level
+        return count
+
+    async def delete_keys(self, keys, batch_size=1000):
+        """Delete keys with UNLINK (or DEL), concurrently by commands of at
+        most batch_size keys."""
+
+        command = self.use_unlink and 'UNLINK' or 'DEL'
+        batches = [keys[i:i + batch_size]
+                   for i in range(0, len(keys), batch_size)]
+        try:
+            await self._gather([self.r.execute_command(command, *batch)
+                                for batch in batches])
+        except redis.ResponseError as e:
+            if not self.use_unlink or 'unknown command' not in str(e).lower():
+                raise
+            self.use_unlink = False
+            await self.delete_keys(keys, batch_size)
+
+    async def clone_node(self, uid):
+        """Clone a node entry and return the uid of the new node."""
+        return await self.create_node(await self.get_node_info(uid))
+
+    async def copy_path(self, source_path, dest_path, batch_size=1000):
+        """Copy a subtree starting at source_path to dest_path, breadth-first.
+        See RedisTreeCore.copy_path."""
+
+        await self.check_writable()
+
+        start = time()
+        dparent, dname = posixpath.split(dest_path)
+        rs_path, rs_node = await self.real_node(source_path)
+        rd_path, rd_node = await self.real_node(dparent, full=True)
+
+        count = 0
+        level = [(rs_path, rs_node, rd_path, rd_node, dname)]
+
+        while level:
+            commands = []
+            for path, uid, _, _, _ in level:
+                commands.extend(await self.node_commands(uid))
+                commands.append(('hgetall', (await self.tree_key(path, uid),)))
+            res = iter(await self._pipelined(commands, batch_size))
+            packed = await self.get_node_codec() == 'packed'
+
+            first_uid = await self.allocate_uids(len(level))
+
+            children = {}
+            next_level = []
+            commands = []
+            for i, (path, uid, dparent, dparent_uid, name) in enumerate(level):
+                new_uid = first_uid + i
+                data = codec.decode(res, packed=packed)
+                content = next(res)
+                if data:
+                    commands.append(('hset', ("NODE:%s" % new_uid,),
+                                     {'mapping': data}))
+                    if 'final_node' in data:
+                        commands.append(('sadd', ("LINKS:%s" % data['final_node'],
+                                                  new_uid)))
+                        commands.append(('sadd', ('LINKED', data['final_node'])))
+                        if data['target_node'] != data['final_node']:
+                            commands.append(('sadd', (
+                                "CHAINS:%s" % data['target_node'], new_uid)))
+                            commands.append(('sadd', ('LINKED',
+                                                      data['target_node'])))
+                dkey = await self.tree_key(dparent, dparent_uid)
+                children.setdefault(dkey, {})[name] = new_uid
+
+                dpath = posixpath.join(dparent, name)
+                for child, child_uid in content.items():
+                    next_level.append((posixpath.join(path, child), child_uid,
+                                       dpath, new_uid, child))
+
+            for dkey, content in children.items():
+                commands.append(('hset', (dkey,), {'mapping': content}))
+            await self._pipelined(commands, batch_size)
+
+            count += len(level)
+            level = next_level
+
+        await self.invalidate(posixpath.join(rd_path, dname))
+        return CopyResult(count, time() - start)
+
+    async def migrate_layout(self, layout, batch_size=1000):
+        """Switch the tree to another layout of the TREE hashes. See
+        RedisTreeCore.migrate_layout."""
+
+        current = await self.get_layout()
+        if layout == current:
+            return 0
+
+        keys = {
+            'path': lambda path, uid: "TREE:%s" % path,
+            'uid': lambda path, uid: "TREE:%s" % uid,
+        }
+        old_key, new_key = keys[current], keys[layout]
+
+        count = 0
+        level = [('/', self.ROOT_NODE)]
+        while level:
+            res = await self._pipelined(
+                [('hgetall', (old_key(path, uid),)) for path, uid in level],
+                batch_size)
+
+            commands = []
+            next_level = []
+            for (path, uid), content in zip(level, res):
+                if not content:
+                    continue
+                commands.append(('rename', (old_key(path, uid),
+                                            new_key(path, uid))))
+                count += 1
+                for child, child_uid in content.items():
+                    next_level.append((posixpath.join(path, child), child_uid))
+            await self._pipelined(commands, batch_size)
+            level = next_level
+
+        await self.r.set('TREE_LAYOUT', layout)
+        self._layout = layout
+        return count
+
+    async def _pipelined(self, commands, batch_size=1000):
+        """Run (method, args[, kwargs]) commands in non transactional
+        pipelines of batch_size commands, executed concurrently. Return all
+        the results in order."""
+
+        async def execute(batch):
+            pipe = self.r.pipeline(transaction=False)
+            for command in batch:
+                kwargs = len(command) > 2 and command[2] or {}
+                getattr(pipe, command[0])(*command[1], **kwargs)
+            return await pipe.execute()
+
+        results = await self._gather([execute(commands[i:i + batch_size])
+                                      for i in range(0, len(commands),
+                                                     batch_size)])
+        return [item for result in results for item in result]
+
+    async def _gather(self, coros):
+        """Like asyncio.gather, with at most concurrency coroutines running at
+        the same time."""
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def run(coro):
+            async with semaphore:
+                return await coro
+
+        return await asyncio.gather(*[run(coro) for coro in coros])
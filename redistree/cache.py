@@ -0,0 +1,435 @@
+import itertools
+import threading
+import uuid
+from collections import OrderedDict
+from time import time, sleep
+
+import redis
+
+
+class PathCache(object):
+    """
+    A LRU cache of path resolutions, mapping (path, full) to the
+    (real_path, node_uid) tuple returned by RedisTreeCore.real_node.
+
+    Entries are dropped when the tree is modified below their path (see
+    invalidate). Entries which were resolved through a symlink can be affected
+    by a change anywhere in the tree, so they are dropped on every
+    invalidation.
+
+    When several processes share a tree, each client should be created with
+    publish_invalidations=True and each cache should listen() to the
+    invalidation channel.
+    """
+
+    def __init__(self, max_size=10000, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+        # (path, full) -> (real_path, node_uid, through_symlink, expires_at)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self._listener = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, path, full):
+        """Return the cached (real_path, node_uid) or None."""
+        key = (path, full)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or (entry[3] is not None and entry[3] < time()):
+                self.misses += 1
+                return None
+            # Re-insert the entry to mark it as the most recently used one.
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[0], entry[1]
+
+    def set(self, path, full, real_path, uid):
+        """Store the result of a path resolution."""
+        through_symlink = real_path != normalize(path)
+        expires_at = None
+        if self.ttl is not None:
+            expires_at = time() + self.ttl
+
+        with self.lock:
+            self.entries.pop((path, full), None)
+            self.entries[(path, full)] = (real_path, uid, through_symlink,
+                                          expires_at)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, prefix):
+        """Drop every entry which path or real path is prefix or lives below
+        it, and every entry resolved through a symlink."""
+        prefix = normalize(prefix)
+        if prefix == '/':
+            self.clear()
+            return
+
+        below = prefix + '/'
+        with self.lock:
+            self.invalidations += 1
+            for key, entry in list(self.entries.items()):
+                path = normalize(key[0])
+                if (entry[2] or
+                        path == prefix or path.startswith(below) or
+                        entry[0] == prefix or entry[0].startswith(below)):
+                    del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.invalidations += 1
+            self.entries.clear()
+
+    def stats(self):
+        """Return a dict of counters describing the cache efficiency."""
+        return {
+            'size': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+        }
+
+    def listen(self, r, channel='TREE_INVALIDATE'):
+        """Start a daemon thread applying the invalidation messages published
+        by other clients on the given Redis connection."""
+
+        def run():
+            while self._listener is thread:
+                pubsub = r.pubsub()
+                try:
+                    pubsub.subscribe(channel)
+                    for message in pubsub.listen():
+                        if self._listener is not thread:
+                            break
+                        if message['type'] == 'message':
+                            self.invalidate(message['data'])
+                except Exception:
+                    # Messages may have been lost while disconnected.
+                    self.clear()
+                    sleep(0.1)
+                finally:
+                    pubsub.close()
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        self._listener = thread
+        thread.start()
+
+    def stop_listening(self):
+        """Stop applying published invalidations. The listener thread exits
+        on the next message it receives."""
+        self._listener = None
+
+
+# The approximate memory used by a TreeCache entry and by each of its fields,
+# besides their strings.
+ENTRY_OVERHEAD = 200
+FIELD_OVERHEAD = 80
+
+
+class TreeCache(object):
+    """
+    A LRU cache of the TREE and NODE hashes read by a RedisTreeCore (see its
+    tree_cache argument), kept up to date by Redis 6 client tracking.
+
+    The hashes are read on the primary through connections which turn
+    CLIENT TRACKING on, redirecting the invalidations to a connection
+    subscribed to __redis__:invalidate. Redis then announces every change
+    of a key read through them, by any client, and the listener thread
+    drops its entry. A hash may only be partly cached, by the fields read
+    with HGET or HMGET.
+
+    The entries use about max_bytes, estimated from the length of their
+    strings; the least recently used ones are evicted first. Everything is
+    dropped when the listener loses its connection, and nothing is cached
+    until it is back.
+
+    After a mutation of the tree, sync waits for the listener to apply the
+    invalidations Redis sent so far, so the tree reads its own writes.
+    Other clients see their effect as soon as the listener applies them.
+    """
+
+    INVALIDATE_CHANNEL = '__redis__:invalidate'
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, sync_timeout=1.0):
+        self.max_bytes = max_bytes
+        self.sync_timeout = sync_timeout
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+        self.bytes = 0
+
+        # key -> _Entry
+        self.entries = OrderedDict()
+        # key -> token of the last read of key on its way, see read.
+        self._pending = {}
+        self.lock = threading.Lock()
+
+        self._connection_kwargs = None
+        self._client_class = redis.Redis
+        self._client = None
+        self._connection = None
+        self._listener = None
+        # Incremented every time the tracking connections change.
+        self._epoch = 0
+
+        self._sync_channel = 'TREE_CACHE_SYNC:%s' % uuid.uuid4().hex
+        self._sync_tokens = itertools.count(1)
+        self._synced = 0
+        self._sync_condition = threading.Condition()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def start(self, connection_kwargs, client_class=redis.Redis):
+        """Connect the listener to the server of the connection pool
+        arguments connection_kwargs and start its thread. The hashes are
+        read with client_class clients, such as the InstrumentedRedis of the
+        tree, so the misses count in its measures."""
+        self._connection_kwargs = dict(connection_kwargs)
+        self._client_class = client_class
+        self._connect()
+        thread = threading.Thread(target=self._listen)
+        thread.daemon = True
+        self._listener = thread
+        thread.start()
+
+    def stop(self):
+        """Stop the listener and drop every entry."""
+        self._listener = None
+        with self.lock:
+            client, self._client = self._client, None
+            self._clear()
+        if client is not None:
+            client.connection_pool.disconnect()
+        if self._connection is not None:
+            self._connection.disconnect()
+
+    def _connect(self):
+        connection = redis.Connection(**self._connection_kwargs)
+        connection.send_command('CLIENT', 'ID')
+        client_id = connection.read_response()
+        connection.send_command('SUBSCRIBE', self.INVALIDATE_CHANNEL,
+                                self._sync_channel)
+        connection.read_response()
+        connection.read_response()
+
+        pool = redis.ConnectionPool(connection_class=TrackingConnection,
+                                    redirect=client_id,
+                                    **self._connection_kwargs)
+        with self.lock:
+            self._clear()
+            self._epoch += 1
+            self._client = self._client_class(connection_pool=pool)
+            self._connection = connection
+
+    def _listen(self):
+        thread = threading.current_thread()
+        while self._listener is thread:
+            try:
+                message = self._connection.read_response()
+            except Exception:
+                if self._listener is not thread:
+                    return
+                # Invalidations may have been lost while disconnected.
+                with self.lock:
+                    self._client = None
+                    self._clear()
+                sleep(0.1)
+                try:
+                    self._connect()
+                except Exception:
+                    pass
+                continue
+
+            kind, channel, data = message[:3]
+            if kind != 'message':
+                continue
+            if channel == self._sync_channel:
+                with self._sync_condition:
+                    self._synced = max(self._synced, int(data))
+                    self._sync_condition.notify_all()
+            elif data is None:
+                # FLUSHDB, FLUSHALL, or the server out of tracking memory.
+                self.clear()
+            else:
+                self.invalidate(data)
+
+    def read(self, requests, fallback, batch_size=1000):
+        """Return the replies to requests, a list of (key, fields) tuples,
+        fields being None to read the whole hash with HGETALL, or a list of
+        fields to read with HMGET. The missing hashes are read with
+        pipelines of at most batch_size commands, or with fallback, a
+        client, if the listener isn't connected."""
+
+        replies = [None] * len(requests)
+        misses = []
+        with self.lock:
+            client = self._client
+            epoch = self._epoch
+            for i, (key, fields) in enumerate(requests):
+                entry = self.entries.pop(key, None)
+                if entry is not None:
+                    self.entries[key] = entry
+                    if entry.covers(fields):
+                        self.hits += 1
+                        replies[i] = entry.reply(fields)
+                        continue
+                self.misses += 1
+                token = object()
+                if client is not None:
+                    self._pending[key] = token
+                misses.append((i, key, fields, token))
+
+        if not misses:
+            return replies
+        if client is None:
+            client = fallback
+        for start in range(0, len(misses), batch_size):
+            batch = misses[start:start + batch_size]
+            pipe = client.pipeline(transaction=False)
+            for _, key, fields, _ in batch:
+                if fields is None:
+                    pipe.hgetall(key)
+                else:
+                    pipe.hmget(key, fields)
+            for (i, _, _, _), reply in zip(batch, pipe.execute()):
+                replies[i] = reply
+
+        if client is not fallback:
+            with self.lock:
+                if epoch == self._epoch:
+                    for i, key, fields, token in misses:
+                        # Unless the key changed since it was read.
+                        if self._pending.get(key) is token:
+                            del self._pending[key]
+                            self._store(key, fields, replies[i])
+        return replies
+
+    def _store(self, key, fields, reply):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry.size
+        if fields is None or entry is None:
+            entry = _Entry()
+        entry.add(fields, reply)
+        self.entries[key] = entry
+        self.bytes += entry.size
+        while self.bytes > self.max_bytes and self.entries:
+            _, evicted = self.entries.popitem(last=False)
+            self.bytes -= evicted.size
+            self.evictions += 1
+
+    def invalidate(self, keys):
+        """Drop the entries of keys."""
+        with self.lock:
+            for key in keys:
+                self._pending.pop(key, None)
+                entry = self.entries.pop(key, None)
+                if entry is not None:
+                    self.bytes -= entry.size
+                    self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self._clear()
+
+    def _clear(self):
+        self.invalidations += len(self.entries)
+        self.entries.clear()
+        self._pending.clear()
+        self.bytes = 0
+
+    def sync(self, client):
+        """Wait for the listener to apply the invalidations sent by the
+        server before now, publishing a token with client which reaches the
+        listener after them. The cache is cleared if it doesn't within
+        sync_timeout seconds."""
+
+        if self._client is None:
+            return
+        token = next(self._sync_tokens)
+        deadline = time() + self.sync_timeout
+        if client.publish(self._sync_channel, token):
+            with self._sync_condition:
+                while self._synced < token and time() < deadline:
+                    self._sync_condition.wait(deadline - time())
+                if self._synced >= token:
+                    return
+        self.clear()
+
+    def stats(self):
+        """Return a dict of counters describing the cache efficiency."""
+        return {
+            'size': len(self.entries),
+            'bytes': self.bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+            'evictions': self.evictions,
+        }
+
+
+class _Entry(object):
+    """A hash cached by TreeCache. fields maps the known fields to their
+    value, or to None for the ones the hash doesn't have."""
+
+    __slots__ = ['fields', 'complete', 'size']
+
+    def __init__(self):
+        self.fields = {}
+        self.complete = False
+        self.size = ENTRY_OVERHEAD
+
+    def covers(self, fields):
+        if self.complete:
+            return True
+        return fields is not None and all(f in self.fields for f in fields)
+
+    def reply(self, fields):
+        if fields is None:
+            return dict((f, v) for f, v in self.fields.items()
+                        if v is not None)
+        return [self.fields.get(f) for f in fields]
+
+    def add(self, fields, reply):
+        if fields is None:
+            self.complete = True
+            items = reply.items()
+        else:
+            items = zip(fields, reply)
+        for field, value in items:
+            if field not in self.fields:
+                self.size += FIELD_OVERHEAD + len(field)
+                self.size += len(value or '')
+                self.fields[field] = value
+
+
+class TrackingConnection(redis.Connection):
+    """A connection turning CLIENT TRACKING on, redirecting the
+    invalidations to the client id redirect."""
+
+    def __init__(self, redirect=None, **kwargs):
+        super(TrackingConnection, self).__init__(**kwargs)
+        self.redirect = redirect
+
+    def on_connect(self):
+        super(TrackingConnection, self).on_connect()
+        self.send_command('CLIENT', 'TRACKING', 'on', 'REDIRECT',
+                          self.redirect)
+        self.read_response()
+
+
+def normalize(path):
+    """Remove the trailing slash of a path, if any."""
+    if len(path) > 1 and path.endswith('/'):
+        return path.rstrip('/') or '/'
+    return path
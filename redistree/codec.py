@@ -0,0 +1,92 @@
+"""
+Storage codecs of the NODE attributes, selected per tree by init_fs.
+
+    * plain: the attributes of a node are the fields of its NODE:<uid> hash.
+    * packed: small attribute sets are packed into a single value, stored in
+      a bucket hash shared by BUCKET_SIZE consecutive uids (see bucket).
+      Small hashes are kept by Redis in a compact encoding (ziplist or
+      listpack), so a node costs a few bytes more than its attributes
+      instead of the overhead of a whole key. Links, which the Lua scripts
+      read, and attribute sets packing to more than MAX_PACKED_SIZE bytes
+      are stored like with the plain codec.
+"""
+
+import struct
+
+
+# At most hash-max-listpack-entries (hash-max-ziplist-entries before Redis
+# 7), which defaults to 128 (512), so the buckets stay compact.
+BUCKET_SIZE = 128
+
+# Larger values would make Redis convert the bucket out of its compact
+# encoding (hash-max-listpack-value, 64 bytes by default).
+MAX_PACKED_SIZE = 64
+
+CODECS = ['plain', 'packed']
+
+
+def bucket(uid):
+    """Return the key of the bucket hash of a node and its field there."""
+    uid = int(uid)
+    return 'NODES:%d' % (uid // BUCKET_SIZE), str(uid % BUCKET_SIZE)
+
+
+def to_bytes(value):
+    if not isinstance(value, bytes):
+        value = (u'%s' % value).encode('utf-8')
+    return value
+
+
+def pack(attributes):
+    """Return attributes packed into a single string, or None if it would be
+    longer than MAX_PACKED_SIZE."""
+
+    items = [(to_bytes(name), to_bytes(value))
+             for name, value in sorted(attributes.items())]
+    if sum(2 + len(name) + len(value) for name, value in items) > \
+            MAX_PACKED_SIZE:
+        return None
+    return b''.join(struct.pack('BB', len(name), len(value)) + name + value
+                    for name, value in items)
+
+
+def unpack(packed):
+    """Return the attributes packed by pack."""
+
+    # Clients decoding responses (like the asyncio one) give text.
+    text = not isinstance(packed, bytes)
+    if text:
+        packed = packed.encode('utf-8')
+
+    attributes = {}
+    i = 0
+    while i < len(packed):
+        name_size, value_size = struct.unpack('BB', packed[i:i + 2])
+        i += 2
+        name = packed[i:i + name_size]
+        i += name_size
+        value = packed[i:i + value_size]
+        i += value_size
+        if text:
+            name, value = name.decode('utf-8'), value.decode('utf-8')
+        attributes[name] = value
+    return attributes
+
+
+def decode(replies, fields=None, packed=False):
+    """Return the attributes of a node from the replies iterator: the reply
+    of HGETALL on its NODE hash (or of HMGET of the given fields), then if
+    packed the one of HGET of its field in its bucket."""
+
+    attributes = next(replies)
+    if fields is not None:
+        attributes = dict((field, value)
+                          for field, value in zip(fields, attributes)
+                          if value is not None)
+    if packed:
+        value = next(replies)
+        if value is not None:
+            for name, value in unpack(value).items():
+                if fields is None or name in fields:
+                    attributes[name] = value
+    return attributes
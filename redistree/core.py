@@ -1,6 +1,319 @@
+import functools
 import posixpath
+import threading
+from collections import namedtuple
+from time import time
 import redis
 
+from redistree import codec
+from redistree.instrument import InstrumentedRedis, instrumented
+from redistree.replica import ReplicatedRedis
+from redistree.shard import ShardedRedis
+
+
+# Lua function resolving a path on the server side, shared by the scripts
+# below. Mirrors RedisTreeCore.resolve. Returns the real path and node uid,
+# or nil and an error message.
+RESOLVE_FUNCTION = """
+local function resolve(chunks, full, uid_layout, path_index, max_hops, root)
+    local current_path = '/'
+    local current_node = root
+    local i = 1
+    local hops = 0
+
+    if path_index and #chunks > 0 then
+        local path = '/' .. table.concat(chunks, '/')
+        local uid = redis.call('HGET', 'PATHINDEX', path)
+        if uid then
+            current_path = path
+            current_node = uid
+            i = #chunks + 1
+        end
+    end
+
+    while true do
+        if i > #chunks and not full then
+            break
+        end
+
+        local link = redis.call('HMGET', 'NODE:' .. current_node, 'target',
+                                'target_node', 'final_target', 'final_node',
+                                'dangling')
+        if link[1] then
+            if link[5] then
+                return nil, 'Broken path'
+            end
+            -- A loop would block the whole server, so don't follow forever.
+            hops = hops + 1
+            if hops > max_hops then
+                return nil, 'Too many levels of symbolic links'
+            end
+            if link[4] then
+                current_path = link[3]
+                current_node = link[4]
+            else
+                current_path = link[1]
+                current_node = link[2]
+            end
+        else
+            if i > #chunks then
+                break
+            end
+            local chunk = chunks[i]
+            i = i + 1
+            local key = 'TREE:' .. current_path
+            if uid_layout then
+                key = 'TREE:' .. current_node
+            end
+            current_node = redis.call('HGET', key, chunk)
+            if not current_node then
+                return nil, 'Broken path'
+            end
+            if current_path == '/' then
+                current_path = ''
+            end
+            current_path = current_path .. '/' .. chunk
+        end
+    end
+
+    return current_path, current_node
+end
+"""
+
+
+# Resolve a path. See RedisTreeCore.resolve.
+# ARGV: full flag ('1' or '0'), tree layout, path index flag ('1' or '0'),
+# maximum number of symlinks to follow, root node uid, then the path chunks.
+RESOLVE_SCRIPT = RESOLVE_FUNCTION + """
+local chunks = {}
+for i = 6, #ARGV do
+    chunks[#chunks + 1] = ARGV[i]
+end
+
+local path, node = resolve(chunks, ARGV[1] == '1', ARGV[2] == 'uid',
+                           ARGV[3] == '1', tonumber(ARGV[4]), ARGV[5])
+if not path then
+    return redis.error_reply(node)
+end
+return {path, node}
+"""
+
+
+# Create a node and link it to its parent. See
+# RedisTreeCore.create_child_node.
+# ARGV: tree layout, path index flag, maximum number of symlinks to follow,
+# root node uid, exclusive flag, resolve flag, uid of the node ('' to take
+# the next one from NODE_COUNTER), name of the node, key of the hash to
+# write the attributes to ('' for NODE:<uid>), key of the change feed stream
+# ('' for none) and its maximum length, number n of field names and values,
+# then these n strings, then the parent path chunks. Returns the uid and the
+# real path of the node.
+CREATE_SCRIPT = RESOLVE_FUNCTION + """
+local uid_layout = ARGV[1] == 'uid'
+local n = tonumber(ARGV[12])
+local chunks = {}
+for i = 13 + n, #ARGV do
+    chunks[#chunks + 1] = ARGV[i]
+end
+
+local parent_path, parent_node
+if ARGV[6] == '1' or uid_layout then
+    parent_path, parent_node = resolve(chunks, true, uid_layout,
+                                       ARGV[2] == '1', tonumber(ARGV[3]),
+                                       ARGV[4])
+    if not parent_path then
+        return redis.error_reply(parent_node)
+    end
+elseif #chunks > 0 then
+    -- Unresolved, the parent must still be a child of its own parent.
+    parent_path = '/' .. table.concat(chunks, '/')
+    local grandparent = '/' .. table.concat(chunks, '/', 1, #chunks - 1)
+    if redis.call('HEXISTS', 'TREE:' .. grandparent,
+                  chunks[#chunks]) == 0 then
+        return redis.error_reply('Broken path')
+    end
+else
+    parent_path = '/'
+end
+
+local key = 'TREE:' .. parent_path
+if uid_layout then
+    key = 'TREE:' .. parent_node
+end
+local name = ARGV[8]
+if ARGV[5] == '1' and redis.call('HEXISTS', key, name) == 1 then
+    return redis.error_reply('Node exists')
+end
+
+-- Lua numbers can't hold every 64 bit uid, so read it back as a string.
+local uid = ARGV[7]
+if uid == '' then
+    redis.call('INCR', 'NODE_COUNTER')
+    uid = redis.call('GET', 'NODE_COUNTER')
+end
+
+local attributes_key = ARGV[9]
+if attributes_key == '' then
+    attributes_key = 'NODE:' .. uid
+end
+if n > 0 then
+    redis.call('HMSET', attributes_key, unpack(ARGV, 13, 12 + n))
+end
+redis.call('HSET', key, name, uid)
+
+if parent_path == '/' then
+    parent_path = ''
+end
+local path = parent_path .. '/' .. name
+if ARGV[2] == '1' then
+    redis.call('HSET', 'PATHINDEX', path, uid)
+end
+if ARGV[10] ~= '' then
+    local event = {'op', 'create', 'path', path, 'uid', uid}
+    for i = 13, 12 + n, 2 do
+        if ARGV[i] == 'target' then
+            event[2] = 'symlink'
+            event[#event + 1] = 'target'
+            event[#event + 1] = ARGV[i + 1]
+        end
+    end
+    redis.call('XADD', ARGV[10], 'MAXLEN', '~', ARGV[11], '*',
+               unpack(event))
+end
+return {uid, path}
+"""
+
+
+# Read the uids of the nodes along real paths, with the uid layout. See
+# RedisTreeCore.ancestors_many.
+# ARGV: root node uid, then for every path the number n of its chunks and
+# these n chunks. Returns the list of the uids of every path.
+ANCESTORS_SCRIPT = """
+local chains = {}
+local i = 2
+while i <= #ARGV do
+    local n = tonumber(ARGV[i])
+    local node = ARGV[1]
+    local chain = {}
+    for j = i + 1, i + n do
+        node = redis.call('HGET', 'TREE:' .. node, ARGV[j])
+        if not node then
+            return redis.error_reply('Broken path')
+        end
+        chain[#chain + 1] = node
+    end
+    chains[#chains + 1] = chain
+    i = i + n + 1
+end
+return chains
+"""
+
+
+# Copy the TREE hashes of a batch of directories to
+# SNAPTREE:<snapshot id>:<uid>. See RedisTreeCore.snapshot.
+# ARGV: tree layout, snapshot id, then the real path and uid of every
+# directory. Returns the real paths and uids of their children, flattened.
+SNAPSHOT_SCRIPT = """
+local uid_layout = ARGV[1] == 'uid'
+local prefix = 'SNAPTREE:' .. ARGV[2] .. ':'
+local children = {}
+for j = 3, #ARGV, 2 do
+    local path, node = ARGV[j], ARGV[j + 1]
+    local key = 'TREE:' .. path
+    if uid_layout then
+        key = 'TREE:' .. node
+    end
+    local content = redis.call('HGETALL', key)
+    for i = 1, #content, 1000 do
+        redis.call('HMSET', prefix .. node,
+                   unpack(content, i, math.min(i + 999, #content)))
+    end
+    if path == '/' then
+        path = ''
+    end
+    for i = 1, #content, 2 do
+        children[#children + 1] = path .. '/' .. content[i]
+        children[#children + 1] = content[i + 1]
+    end
+end
+return children
+"""
+
+
+CopyResult = namedtuple('CopyResult', ['nodes', 'elapsed'])
+
+# The number of nodes of a subtree and the sum of the aggregated attribute
+# over them, see RedisTreeCore.du.
+DiskUsage = namedtuple('DiskUsage', ['nodes', 'total'])
+
+
+# The attributes of a symlink node read while resolving paths.
+LINK_FIELDS = ['target', 'target_node', 'final_target', 'final_node',
+               'dangling']
+
+
+def link_destination(fields):
+    """Return the (path, uid) where a node leads to, given the values of its
+    LINK_FIELDS, or None if it isn't a symlink. Symlinks created by
+    create_symlink lead straight to their final target."""
+
+    target, target_node, final_target, final_node, dangling = fields
+    if target is None:
+        return None
+    if dangling is not None:
+        raise BrokenPath(target)
+    if final_node is not None:
+        return final_target, final_node
+    return target, target_node
+
+
+def check_move(orig_path, dest_path):
+    """Refuse to move the node at the real path orig_path into its own
+    subtree, which would detach the subtree from the tree in a cycle."""
+    if dest_path == orig_path or \
+            dest_path.startswith(orig_path.rstrip('/') + '/'):
+        raise ValueError("Can't move %s into itself (%s)" % (orig_path,
+                                                              dest_path))
+
+
+class _Cursor(object):
+    """The state of a path being resolved by RedisTreeCore.walk_many."""
+
+    __slots__ = ['path', 'chunks', 'index', 'current', 'node', 'hops']
+
+    def __init__(self, path, chunks, node):
+        self.path = path
+        self.chunks = chunks
+        self.index = 0
+        self.current = '/'
+        self.node = node
+        self.hops = 0
+
+    def result(self):
+        return self.current, self.node
+
+
+class BrokenPath(Exception):
+    """Raised when a path doesn't lead to any node."""
+
+
+class SymlinkLoopError(Exception):
+    """Raised when resolving a path follows more symlinks than allowed, which
+    usually means there is a symlink loop."""
+
+
+class NodeExists(Exception):
+    """Raised by create_child_node(exclusive=True) when the name is already
+    taken."""
+
+
+class SnapshotNotFound(Exception):
+    """Raised when reading from a snapshot which doesn't exist (anymore)."""
+
+
+class ScriptingUnavailable(Exception):
+    """Raised when the Redis server does not support Lua scripting."""
+
 
 class RedisTreeCore:
     """
@@ -9,96 +322,661 @@ class RedisTreeCore:
     Keys namespaces:
         * TREE: Keys part of the hierarchical structure.
         * NODE: Keys representing nodes.
+        * DU: Aggregates of the descendants of a node, when turned on (see
+          enable_aggregates).
+        * SNAPSHOT, SNAPTREE: Read-only views of subtrees (see snapshot).
+
+    Two layouts are available for the TREE hashes, selected per tree by
+    init_fs (see migrate_layout to switch an existing tree):
+        * path: the children of a node live in TREE:<real path of the node>.
+        * uid: the children of a node live in TREE:<node uid>. Moving a
+          subtree of any size only touches the two parent hashes.
 
     A link node must have:
         - target (containing the path it links to).
         - target_node (containing the node id it links to).
+    Links made by create_symlink also have final_target and final_node, the
+    real path and node id at the end of the chain of symlinks, and are
+    registered in LINKS:<final node id>, and when their target is a link
+    itself, in CHAINS:<target node id>. A link whose final node, or one of
+    the links it goes through, has been deleted is marked with a dangling
+    attribute.
     """
 
     def __init__(self, connection_pool=None, redis_host='localhost',
                                              redis_port=6379,
-                                             redis_db=0):
+                                             redis_db=0,
+                                             use_scripts=True,
+                                             path_cache=None,
+                                             publish_invalidations=False,
+                                             max_symlink_hops=40,
+                                             instrumentation=None,
+                                             shards=None,
+                                             uid_block_size=None,
+                                             replicas=None,
+                                             read_your_writes=1.0,
+                                             tree_cache=None):
 
         # By definition, the root node is always the one with the smallest
         # value.
         self.ROOT_NODE = -9223372036854775807
 
-        # Attach a connection pool if provided.
-        if connection_pool:
+        # Attach a connection pool if provided. With shards, a list of
+        # connection pools, the keys are spread over them (see
+        # redistree.shard.ShardedRedis).
+        if shards:
+            self.pool = shards[0]
+        elif connection_pool:
             self.pool = connection_pool
         else:
             self.pool = redis.ConnectionPool(host=redis_host,
                                              port=redis_port,
                                              db=redis_db)
 
-        self.r = redis.Redis(connection_pool=self.pool)
+        # Optional redistree.instrument.Instrumentation, measuring the
+        # commands sent by each public operation.
+        self.instrumentation = instrumentation
+        if instrumentation is not None:
+            client = functools.partial(InstrumentedRedis, instrumentation)
+        else:
+            client = redis.Redis
+        if shards:
+            self.r = ShardedRedis([client(connection_pool=pool)
+                                   for pool in shards])
+        else:
+            self.r = client(connection_pool=self.pool)
+
+        # With replicas, a list of connection pools to replicas of the
+        # primary above, the read-only operations are spread over them (see
+        # redistree.replica.ReplicatedRedis), except for read_your_writes
+        # seconds after a mutation.
+        if replicas and shards:
+            raise ValueError("Replicas can't be combined with shards")
+        self.replicas = replicas
+        if replicas:
+            self.r = ReplicatedRedis(self.r, [client(connection_pool=pool)
+                                              for pool in replicas],
+                                     read_your_writes)
+
+        # Lua scripts are loaded lazily, the first time they are needed. If
+        # the server doesn't support scripting, use_scripts is turned off and
+        # the client-side implementations are used instead.
+        self.use_scripts = use_scripts
+        self._scripts = {}
+        self.use_unlink = True
+
+        # Following more symlinks than this while resolving a path raises
+        # SymlinkLoopError.
+        self.max_symlink_hops = max_symlink_hops
+
+        # Optional redistree.cache.PathCache. When several processes share the
+        # tree, publish_invalidations makes every mutation announce the
+        # modified paths on INVALIDATION_CHANNEL.
+        self.path_cache = path_cache
+        self.publish_invalidations = publish_invalidations
+        self.INVALIDATION_CHANNEL = 'TREE_INVALIDATE'
+
+        # Optional redistree.cache.TreeCache, serving the reads of TREE and
+        # NODE hashes done by real_node, get_children, get_node_info and
+        # get_target from memory. Path resolutions are then walked on the
+        # client, through the cache. The misses are always read on the
+        # primary, which sends the invalidations: a replica lagging behind
+        # would let stale hashes in the cache.
+        if tree_cache is not None and shards:
+            raise ValueError("A tree cache can't be used with shards")
+        self.tree_cache = tree_cache
+        if tree_cache is not None:
+            tree_cache.start(self.pool.connection_kwargs, client)
+
+        # When the change feed is turned on for the tree, the mutations
+        # append events to the CHANGE_FEED stream (see watch).
+        self.CHANGE_FEED = 'TREE_FEED'
+
+        # With uid_block_size, uids are leased from NODE_COUNTER by blocks of
+        # this size and handed out locally (see allocate_uids). The current
+        # block is [_uid_next, _uid_end].
+        self.uid_block_size = uid_block_size
+        self._uid_lock = threading.Lock()
+        self._uid_next = None
+        self._uid_end = None
 
+        # Read from TREE_LAYOUT, TREE_PATHINDEX, TREE_CODEC, TREE_AGGREGATE
+        # and TREE_CHANGEFEED on first use.
+        self._layout = None
+        self._path_index = None
+        self._node_codec = None
+        self._aggregate = None
+        self._feed_maxlen = None
 
-    def init_fs(self):
+    @property
+    def layout(self):
+        """The TREE hashes layout of the tree: 'path' or 'uid'."""
+        if self._layout is None:
+            self._layout = self.r.get('TREE_LAYOUT') or 'path'
+        return self._layout
+
+    @property
+    def path_index(self):
+        """Whether the tree maintains PATHINDEX, a hash mapping the real path
+        of every node to its uid (see rebuild_path_index)."""
+        if self._path_index is None:
+            self._path_index = bool(self.r.get('TREE_PATHINDEX'))
+        return self._path_index
+
+    @property
+    def node_codec(self):
+        """The storage codec of the NODE attributes: 'plain' or 'packed'."""
+        if self._node_codec is None:
+            self._node_codec = self.r.get('TREE_CODEC') or 'plain'
+        return self._node_codec
+
+    @property
+    def aggregate(self):
+        """The attribute summed up by the DU aggregates, or None when they
+        are turned off."""
+        if self._aggregate is None:
+            self._aggregate = self.r.get('TREE_AGGREGATE') or ''
+        return self._aggregate or None
+
+    @property
+    def feed_maxlen(self):
+        """The number of events the change feed is trimmed to (about), or
+        None when it is turned off (see enable_change_feed)."""
+        if self._feed_maxlen is None:
+            self._feed_maxlen = int(self.r.get('TREE_CHANGEFEED') or 0)
+        return self._feed_maxlen or None
+
+    @property
+    def change_feed(self):
+        """Whether the mutations append events to the change feed."""
+        return self.feed_maxlen is not None
+
+    def node_storage(self, uid, attributes):
+        """Return the hash key and fields storing the attributes of a node
+        with the codec of the tree."""
+        if self.node_codec == 'packed' and 'target' not in attributes:
+            packed = codec.pack(attributes)
+            if packed is not None:
+                key, field = codec.bucket(uid)
+                return key, {field: packed}
+        return "NODE:%s" % uid, attributes
+
+    def node_keys(self, uid):
+        """Return the keys which may hold the attributes of a node."""
+        if self.node_codec == 'packed':
+            return ["NODE:%s" % uid, codec.bucket(uid)[0]]
+        return ["NODE:%s" % uid]
+
+    def node_exists(self, client, uid):
+        """Return whether the node exists, checking with client (the tree
+        connection or a pipeline in immediate mode)."""
+        if client.exists("NODE:%s" % uid):
+            return True
+        return (self.node_codec == 'packed' and
+                client.hexists(*codec.bucket(uid)))
+
+    def read_node(self, pipe, uid, fields=None):
+        """Queue in pipe the commands reading the attributes of a node (or
+        the given fields of them), to be decoded by decode_node."""
+        if fields is None:
+            pipe.hgetall("NODE:%s" % uid)
+        else:
+            pipe.hmget("NODE:%s" % uid, fields)
+        if self.node_codec == 'packed':
+            pipe.hget(*codec.bucket(uid))
+
+    def node_requests(self, uid, fields=None):
+        """Return the (key, fields) hash reads of the attributes of a node
+        for tree_cache, like read_node."""
+        requests = [("NODE:%s" % uid, fields)]
+        if self.node_codec == 'packed':
+            key, field = codec.bucket(uid)
+            requests.append((key, [field]))
+        return requests
+
+    def decode_node(self, replies, fields=None):
+        """Return the attributes of a node, taking the replies of the
+        commands queued by read_node from the replies iterator."""
+        return codec.decode(replies, fields, self.node_codec == 'packed')
+
+    def read_hash(self, key, fields=None):
+        """Return the hash at key (HGETALL), or the values of the given
+        fields of it (HMGET), from tree_cache if there is one."""
+        if self.tree_cache is not None:
+            return self.tree_cache.read([(key, fields)], self.r)[0]
+        if fields is None:
+            return self.r.hgetall(key)
+        return self.r.hmget(key, fields)
+
+    def tree_key(self, path, uid):
+        """Return the key of the TREE hash holding the children of the node
+        living at the given real path and having the given uid."""
+        if self.layout == 'uid':
+            return "TREE:%s" % uid
+        return "TREE:%s" % path
+
+    @instrumented
+    def init_fs(self, layout='path', path_index=False, node_codec='plain',
+                aggregate=None, change_feed=False, feed_maxlen=1000000):
         """Create the root node and the ID counter, if they don't exist.
-        By convention, the root node has an node id of 0."""
+        By convention, the root node has an node id of 0.
+        The layout of the TREE hashes ('path' or 'uid') can only be chosen
+        when the tree is created. The path index can be turned on later with
+        rebuild_path_index. node_codec is the storage of the NODE attributes,
+        'plain' or 'packed' (see redistree.codec). aggregate turns the DU
+        aggregates on for a new tree (see enable_aggregates for an existing
+        one), and change_feed the change feed, trimmed to about feed_maxlen
+        events (see enable_change_feed)."""
 
         # Redis store strings as base-10 64 bit signed integers, so we start at
         # the smallest possible number and we start counting. If the number is
-        # an issue, we may decide to use multiple counters.
+        # an issue, we may decide to use multiple counters. The root node
+        # takes the first uid, ROOT_NODE.
 
-        self.r.setnx('NODE_COUNTER', "-9223372036854775808")
-        self.create_node({'name': 'root'})
+        self.r.setnx('TREE_LAYOUT', layout)
+        if path_index:
+            self.r.setnx('TREE_PATHINDEX', '1')
+        if node_codec != 'plain':
+            self.r.setnx('TREE_CODEC', node_codec)
+        if aggregate:
+            self.r.setnx('TREE_AGGREGATE', aggregate)
+        if change_feed:
+            self.r.setnx('TREE_CHANGEFEED', feed_maxlen)
+        self._layout = None
+        self._path_index = None
+        self._node_codec = None
+        self._aggregate = None
+        self._feed_maxlen = None
+        if self.r.setnx('NODE_COUNTER', str(self.ROOT_NODE)):
+            self.create_node({'name': 'root'}, uid=self.ROOT_NODE)
 
+    @instrumented
     def create_node(self, attributes, uid=None):
         """Create a NODE entry and assign it with the given attributes.
         If uid is provided, the node will be created with this uid, erasing any
         node already existing with this uid."""
 
         if uid == None:
-            uid = self.r.incr('NODE_COUNTER')
+            uid = self.allocate_uids()
 
-        self.r.hmset("NODE:%s" % uid, attributes)
+        self.r.hmset(*self.node_storage(uid, attributes))
         return uid
 
-    def create_child_node(self, path, attributes=None, resolve=True):
+    def allocate_uids(self, count=1):
+        """Reserve count consecutive uids and return the first one.
+        Without uid_block_size, every call is an INCRBY of NODE_COUNTER.
+        Otherwise, small allocations are served from a block leased with a
+        single INCRBY, or reused from FREE_UIDS (see release_uids), without
+        any round trip most of the time. Thread safe."""
+
+        if not self.uid_block_size or count > self.uid_block_size:
+            return self.r.incrby('NODE_COUNTER', count) - count + 1
+
+        with self._uid_lock:
+            if self._uid_next is None or self._uid_next + count > \
+                    self._uid_end + 1:
+                self._release_block()
+                self._lease_block(count)
+            uid = self._uid_next
+            self._uid_next += count
+            return uid
+
+    def _lease_block(self, count):
+        """Take a block of at least count uids, from FREE_UIDS if there is a
+        large enough one at its head, or from NODE_COUNTER."""
+
+        free = self.r.lpop('FREE_UIDS')
+        if free is not None:
+            start, end = [int(bound) for bound in free.split()]
+            if end - start + 1 >= count:
+                self._uid_next, self._uid_end = start, end
+                return
+            self.r.rpush('FREE_UIDS', free)
+
+        self._uid_end = self.r.incrby('NODE_COUNTER', self.uid_block_size)
+        self._uid_next = self._uid_end - self.uid_block_size + 1
+
+    def _release_block(self):
+        if self._uid_next is not None and self._uid_next <= self._uid_end:
+            self.r.rpush('FREE_UIDS', '%d %d' % (self._uid_next, self._uid_end))
+        self._uid_next = self._uid_end = None
+
+    def release_uids(self):
+        """Give the unused uids of the leased block back to FREE_UIDS, for
+        other clients to use. Call it when done with the tree: uids of a
+        block which is never released are simply never used."""
+        with self._uid_lock:
+            self._release_block()
+
+    @instrumented
+    def create_child_node(self, path, attributes=None, resolve=True,
+                          exclusive=False):
         """Create a node and attach it to the parent living at the given path.
         If resolve is True, the given path will be expanded (symlinks will be
         replaced basically). This is a rather slow operation, so if you are sure
-        there is no symlink in this path, prefer using with resolve=False."""
+        there is no symlink in this path, prefer using with resolve=False.
+        With the uid layout, the parent is always resolved.
+        The creation is atomic, and done in a single round trip when
+        scripting is available. With exclusive=True, NodeExists is raised if
+        the parent already has a child with this name (like O_EXCL). On trees
+        with DU aggregates, creations are always exclusive (see
+        check_vacant)."""
 
         parent, name = posixpath.split(path)
-
-        if resolve:
-            parent = self.get_real_path(parent, full=True)
+        exclusive = exclusive or bool(self.aggregate)
 
         if attributes == None:
             attributes = {'name': name}
 
-        new_uid = self.create_node(attributes)
-        self.r.hset("TREE:%s" % parent, name, new_uid)
+        # The bucket of a packed node depends on its uid, so it is allocated
+        # here rather than by the script.
+        uid = None
+        if self.uid_block_size or self.node_codec == 'packed':
+            uid = self.allocate_uids()
+
+        if self.use_scripts:
+            key, stored = '', attributes
+            if uid is not None:
+                key, stored = self.node_storage(uid, attributes)
+            fields = []
+            for item in stored.items():
+                fields.extend(item)
+            try:
+                new_uid, real_path = self.run_script(
+                    CREATE_SCRIPT, self.layout,
+                    self.path_index and '1' or '0', self.max_symlink_hops,
+                    self.ROOT_NODE, exclusive and '1' or '0',
+                    resolve and '1' or '0', uid or '', name, key,
+                    self.change_feed and self.CHANGE_FEED or '',
+                    self.feed_maxlen or 0, len(fields),
+                    *(fields + self.split_path(parent)))
+            except ScriptingUnavailable:
+                pass
+            except redis.ResponseError as e:
+                if str(e) == 'Broken path':
+                    raise BrokenPath(parent)
+                if str(e) == 'Node exists':
+                    raise NodeExists(path)
+                if str(e) == 'Too many levels of symbolic links':
+                    raise SymlinkLoopError(parent)
+                raise
+            else:
+                self._count_created(parent, attributes, resolve)
+                self.invalidate(real_path)
+                return str(new_uid)
+
+        new_uid, real_path = self._create_child_node_watch(
+            parent, name, attributes, resolve, exclusive, uid)
+        self._count_created(parent, attributes, resolve)
+        self.invalidate(real_path)
         return str(new_uid)
 
+    def _count_created(self, parent, attributes, resolve):
+        """Add a node created under parent to the DU aggregates."""
+        if not self.aggregate:
+            return
+        if self.layout == 'uid' or resolve:
+            parent = self.get_real_path(parent, full=True)
+        usage = DiskUsage(1, self.aggregate_value(attributes))
+        self.add_usage(dict((uid, usage) for uid in self.ancestors(parent)))
 
-    def real_node(self, path, full=False):
-        """Returns the expanded ("real") path version of the given path and the
-        node number.
-        If the node at path is a symlink, using full=True will follow it."""
+    def _create_child_node_watch(self, parent, name, attributes, resolve,
+                                 exclusive, uid):
+        """create_child_node without scripts: the parent TREE and NODE hashes,
+        and the TREE hash of the grandparent, where delete_node detaches the
+        parent, are watched while the node is written in a MULTI. Return the
+        uid and the real path of the node."""
+
+        if self.layout == 'uid' or resolve:
+            real_parent, parent_uid = self.real_node(parent, full=True)
+        else:
+            real_parent, parent_uid = parent, None
+        key = self.tree_key(real_parent, parent_uid)
+        watched = [key]
+        if parent_uid is not None:
+            watched.extend(self.node_keys(parent_uid))
+        if real_parent != '/':
+            grandparent, parent_name = posixpath.split(real_parent.rstrip('/'))
+            grandparent_uid = None
+            if self.layout == 'uid':
+                grandparent_uid = self.get_node_at_path(grandparent)
+            parent_key = self.tree_key(grandparent, grandparent_uid)
+            watched.append(parent_key)
+
+        if uid is None:
+            uid = self.allocate_uids()
+
+        pipe = self.r.pipeline()
+        try:
+            while True:
+                try:
+                    pipe.watch(*watched)
+                    if real_parent != '/':
+                        entry = pipe.hget(parent_key, parent_name)
+                        if entry is None or (parent_uid is not None and
+                                             entry != str(parent_uid)):
+                            raise BrokenPath(parent)
+                    if (parent_uid is not None and
+                            not self.node_exists(pipe, parent_uid)):
+                        raise BrokenPath(parent)
+                    if exclusive and pipe.hexists(key, name):
+                        raise NodeExists(posixpath.join(parent, name))
+                    pipe.multi()
+                    pipe.hmset(*self.node_storage(uid, attributes))
+                    pipe.hset(key, name, uid)
+                    if self.path_index:
+                        pipe.hset('PATHINDEX', posixpath.join(real_parent, name),
+                                  uid)
+                    self.feed_created(pipe, posixpath.join(real_parent, name),
+                                      uid, attributes)
+                    pipe.execute()
+                    return uid, posixpath.join(real_parent, name)
+                except redis.WatchError:
+                    continue
+        finally:
+            pipe.reset()
+
+    def feed_event(self, pipe, op, path, uid, **fields):
+        """Queue in pipe the XADD of an event to the change feed, if it is
+        turned on. Events have an op, a real path, a uid and depending on op
+        a dest or a target."""
+        if not self.change_feed:
+            return
+        args = ['op', op, 'path', path, 'uid', uid]
+        for item in sorted(fields.items()):
+            args.extend(item)
+        pipe.execute_command('XADD', self.CHANGE_FEED, 'MAXLEN', '~',
+                             self.feed_maxlen, '*', *args)
+
+    def feed_created(self, pipe, path, uid, attributes):
+        """Queue the create (or symlink) event of a new node, like
+        CREATE_SCRIPT does."""
+        if 'target' in attributes:
+            self.feed_event(pipe, 'symlink', path, uid,
+                            target=attributes['target'])
+        else:
+            self.feed_event(pipe, 'create', path, uid)
 
+    @instrumented
+    def enable_change_feed(self, maxlen=1000000):
+        """Turn the change feed on for the tree, trimmed to about maxlen
+        events. Other clients must be recreated to append to it."""
+        self.r.set('TREE_CHANGEFEED', maxlen)
+        self._feed_maxlen = maxlen
+
+    @instrumented
+    def drop_change_feed(self):
+        """Turn the change feed off and delete it."""
+        pipe = self.r.pipeline()
+        pipe.delete('TREE_CHANGEFEED')
+        pipe.delete(self.CHANGE_FEED)
+        pipe.execute()
+        self._feed_maxlen = 0
+
+    def watch(self, prefix='/', since='$', count=1000, block=None):
+        """Iterate over the (event id, event) of the change feed about the
+        paths under prefix (for moves and copies, the path or the dest).
+        The stream is read with XREAD by batches of count events, starting
+        after the event id since, or with the next event for '$'. Without
+        block, the iteration stops once it has caught up, otherwise it waits
+        for new events forever, block milliseconds at a time.
+        Events older than about feed_maxlen events have been trimmed: a
+        consumer resuming from a trimmed id must rescan the tree."""
+
+        if since == '$':
+            last = self.r.execute_command('XREVRANGE', self.CHANGE_FEED, '+',
+                                          '-', 'COUNT', 1)
+            since = last and last[0][0] or '0-0'
+        prefix = prefix.rstrip('/') + '/'
+
+        while True:
+            args = ['XREAD', 'COUNT', count]
+            if block is not None:
+                args.extend(['BLOCK', block])
+            args.extend(['STREAMS', self.CHANGE_FEED, since])
+            res = self.r.execute_command(*args)
+            events = res and res[0][1] or []
+            for event_id, fields in events:
+                since = event_id
+                event = dict(zip(fields[::2], fields[1::2]))
+                paths = [event['path'], event.get('dest') or '']
+                if any((path + '/').startswith(prefix) for path in paths):
+                    yield event_id, event
+            if block is None and len(events) < count:
+                return
+
+    def run_script(self, source, *args):
+        """Run a Lua script with EVALSHA, loading it with SCRIPT LOAD first if
+        needed (or again if the server script cache has been flushed).
+        Raise ScriptingUnavailable if the server doesn't know about scripts."""
+
+        for attempt in range(2):
+            sha = self._scripts.get(source)
+            try:
+                if sha is None:
+                    sha = self.r.execute_command('SCRIPT', 'LOAD', source)
+                    self._scripts[source] = sha
+                return self.r.execute_command('EVALSHA', sha, 0, *args)
+            except redis.ResponseError as e:
+                message = str(e)
+                # Recent clients parse the NOSCRIPT error code themselves.
+                noscript = (message.startswith('NOSCRIPT') or
+                            type(e).__name__ == 'NoScriptError')
+                if noscript and attempt == 0:
+                    del self._scripts[source]
+                    continue
+                if 'unknown command' in message.lower():
+                    self.use_scripts = False
+                    raise ScriptingUnavailable(message)
+                raise
+
+    def split_path(self, path):
+        """Return the list of the components of an absolute path."""
         chunks = path.split('/')
         del chunks[0]
         if chunks[-1] == '':
             chunks.pop()
+        return chunks
+
+    @instrumented
+    def real_node(self, path, full=False, snapshot=None):
+        """Returns the expanded ("real") path version of the given path and the
+        node number.
+        If the node at path is a symlink, using full=True will follow it.
+        Results are served from path_cache when one is attached. With a
+        snapshot id, path is resolved in that snapshot (see
+        snapshot_node)."""
+
+        if snapshot is not None:
+            return self.snapshot_node(snapshot, path, full)
+
+        if self.path_cache is not None:
+            cached = self.path_cache.get(path, full)
+            if cached is not None:
+                return cached
+
+        current_path, current_node = self.resolve(path, full)
+
+        if self.path_cache is not None:
+            self.path_cache.set(path, full, current_path, current_node)
+        return current_path, current_node
+
+    def resolve(self, path, full=False):
+        """Uncached version of real_node. The resolution is done on the server
+        in a single round trip when scripting is available, otherwise see
+        walk_real_node."""
 
-        current_path = '/'
-        current_node = self.ROOT_NODE
+        chunks = self.split_path(path)
+        cached = self.tree_cache is not None
+
+        if self.use_scripts and not cached:
+            try:
+                res = self.run_script(RESOLVE_SCRIPT, full and '1' or '0',
+                                      self.layout,
+                                      self.path_index and '1' or '0',
+                                      self.max_symlink_hops,
+                                      self.ROOT_NODE, *chunks)
+            except ScriptingUnavailable:
+                pass
+            except redis.ResponseError as e:
+                if str(e) == 'Broken path':
+                    raise BrokenPath(path)
+                if str(e) == 'Too many levels of symbolic links':
+                    raise SymlinkLoopError(path)
+                raise Exception(str(e))
+            else:
+                current_path, current_node = res
+                if current_node == str(self.ROOT_NODE):
+                    current_node = self.ROOT_NODE
+                return current_path, current_node
+
+        if self.path_index and chunks and not cached:
+            current_path = '/' + '/'.join(chunks)
+            current_node = self.r.hget('PATHINDEX', current_path)
+            if current_node is not None:
+                return self.walk_real_node([], full, current_path, current_node)
+
+        return self.walk_real_node(chunks, full)
+
+    def walk_real_node(self, chunks, full=False, current_path='/',
+                       current_node=None):
+        """Client-side version of real_node, taking the path components. With
+        the uid layout, it needs two round trips for every component and
+        symlink. With the path layout, the TREE keys of the next components
+        are known in advance, so they are read ahead (see _read_ahead). The
+        walk starts at the root unless another real path and its node are
+        given."""
+
+        chunks = list(chunks)
+        if current_node is None:
+            current_node = self.ROOT_NODE
+        hops = 0
+        # What _read_ahead fetched: (TREE key, name) -> uid, and
+        # uid -> values of LINK_FIELDS.
+        children = {}
+        links = {}
 
         while True:
             # Check if we are arrived.
             if len(chunks) == 0 and not full:
                 break # current_node contains the node number.
 
+            if (self.layout == 'path' and len(chunks) > 1 and
+                    current_node not in links and self.tree_cache is None):
+                self._read_ahead(current_path, current_node, chunks,
+                                 children, links)
+
             # Check if the current node is a link.
-            target, target_node = self.r.hmget("NODE:%s" % current_node, ['target', 'target_node'])
+            fields = links.get(current_node)
+            if fields is None:
+                fields = self.read_hash("NODE:%s" % current_node, LINK_FIELDS)
+            link = link_destination(fields)
 
-            if not target == None:
-                current_path = target
-                current_node = target_node
+            if link is not None:
+                hops += 1
+                if hops > self.max_symlink_hops:
+                    raise SymlinkLoopError(current_path)
+                current_path, current_node = link
                 continue
 
             if len(chunks) == 0 and full:
@@ -106,130 +984,1359 @@ class RedisTreeCore:
 
             # This is not a target and we are not arrived.
             next_chunk = chunks.pop(0)
-            current_node = self.r.hget("TREE:%s" % current_path, next_chunk)
+            key = self.tree_key(current_path, current_node)
+            if (key, next_chunk) in children:
+                current_node = children[key, next_chunk]
+            else:
+                current_node = self.read_hash(key, [next_chunk])[0]
             if current_node == None:
-                raise Exception("Broken path")
+                raise BrokenPath('/'.join([current_path, next_chunk]))
             if current_path == '/':
                 current_path = ''
             current_path = '/'.join([current_path, next_chunk])
 
         return current_path, current_node
 
+    def _read_ahead(self, current_path, current_node, chunks, children,
+                    links):
+        """Fetch, for the path layout, the uids of the next components of a
+        walk and their link fields, in two pipelines. Stops at the first
+        missing component (which includes the ones below a symlink)."""
+
+        pipe = self.r.pipeline(transaction=False)
+        pipe.hmget("NODE:%s" % current_node, LINK_FIELDS)
+        keys = []
+        path = current_path
+        for chunk in chunks:
+            keys.append(("TREE:%s" % path, chunk))
+            pipe.hget(*keys[-1])
+            path = posixpath.join(path, chunk)
+        res = pipe.execute()
+        links[current_node] = res[0]
+
+        uids = []
+        for key, uid in zip(keys, res[1:]):
+            if uid is None:
+                break
+            children[key] = uid
+            uids.append(uid)
+
+        pipe = self.r.pipeline(transaction=False)
+        for uid in uids:
+            pipe.hmget("NODE:%s" % uid, LINK_FIELDS)
+        for uid, fields in zip(uids, pipe.execute()):
+            links[uid] = fields
+
+    def invalidate(self, *paths):
+        """Tell the path caches that the tree changed at the given paths (and
+        below them). Called after every mutation."""
+
+        if self.path_cache is not None:
+            for path in paths:
+                self.path_cache.invalidate(path)
+
+        if self.tree_cache is not None:
+            self.tree_cache.sync(self.r)
+
+        if self.publish_invalidations:
+            pipe = self.r.pipeline(transaction=False)
+            for path in paths:
+                pipe.publish(self.INVALIDATION_CHANNEL, path)
+            pipe.execute()
+
+    @instrumented
     def get_node_at_path(self, *args, **kwargs):
         """Return the path composant of real_node."""
         return self.real_node(*args, **kwargs)[1]
 
+    @instrumented
     def get_real_path(self, *args, **kwargs):
         """Return the NODE uid composant of real_node."""
         return self.real_node(*args, **kwargs)[0]
 
-    def get_node_info(self, node_id):
-        """Return the attributes of a node."""
-        return self.r.hgetall("NODE:%s" % node_id)
+    @instrumented
+    def resolve_many(self, paths, full=False):
+        """Resolve several paths at once. Return a list of (real_path,
+        node_uid) tuples, like real_node, in the order of the given paths. A
+        path leading nowhere gives None.
+        All the paths are walked together, one level per round trip, and a
+        directory shared by several paths is only looked up once."""
+
+        results = {}
+        pending = []
+        for path in set(paths):
+            cached = None
+            if self.path_cache is not None:
+                cached = self.path_cache.get(path, full)
+            if cached is not None:
+                results[path] = cached
+            else:
+                pending.append(path)
+
+        if pending:
+            walked = self.walk_many(pending, full)
+            if self.path_cache is not None:
+                for path, res in walked.iteritems():
+                    if res is not None:
+                        self.path_cache.set(path, full, res[0], res[1])
+            results.update(walked)
+
+        return [results[path] for path in paths]
+
+    def walk_many(self, paths, full=False):
+        """Client-side walk of several paths at once, used by resolve_many.
+        Return a dict of path: (real_path, node_uid) or None."""
+
+        # The link_destination of the nodes seen so far (None for nodes which
+        # aren't links).
+        links = {}
+        results = {}
+        cursors = [_Cursor(path, self.split_path(path), self.ROOT_NODE)
+                   for path in paths]
+
+        while cursors:
+            # Move the cursors as far as possible with what we already know.
+            active = []
+            for cursor in cursors:
+                while True:
+                    arrived = cursor.index == len(cursor.chunks)
+                    if arrived and not full:
+                        results[cursor.path] = cursor.result()
+                        break
+                    uid = str(cursor.node)
+                    if uid not in links:
+                        active.append(cursor)
+                        break
+                    link = links[uid]
+                    if link is BrokenPath:
+                        results[cursor.path] = None
+                        break
+                    if link is not None:
+                        cursor.hops += 1
+                        if cursor.hops > self.max_symlink_hops:
+                            raise SymlinkLoopError(cursor.path)
+                        cursor.current, cursor.node = link
+                        continue
+                    if arrived:
+                        results[cursor.path] = cursor.result()
+                    else:
+                        active.append(cursor)
+                    break
+
+            # A single pipeline checks the unknown nodes for links and looks
+            # up the next component of every cursor, even if its node might
+            # turn out to be a link.
+            nodes = set()
+            lookups = set()
+            for cursor in active:
+                if str(cursor.node) not in links:
+                    nodes.add(str(cursor.node))
+                if cursor.index < len(cursor.chunks):
+                    lookups.add((self.tree_key(cursor.current, cursor.node),
+                                 cursor.chunks[cursor.index]))
+            nodes = list(nodes)
+            lookups = list(lookups)
+
+            pipe = self.r.pipeline(transaction=False)
+            for uid in nodes:
+                pipe.hmget("NODE:%s" % uid, LINK_FIELDS)
+            for key, chunk in lookups:
+                pipe.hget(key, chunk)
+            res = pipe.execute()
+
+            for uid, fields in zip(nodes, res):
+                try:
+                    links[uid] = link_destination(fields)
+                except BrokenPath:
+                    links[uid] = BrokenPath
+            children = dict(zip(lookups, res[len(nodes):]))
+
+            cursors = []
+            for cursor in active:
+                if links[str(cursor.node)] is not None:
+                    cursors.append(cursor)
+                    continue
+                if cursor.index == len(cursor.chunks):
+                    results[cursor.path] = cursor.result()
+                    continue
+                chunk = cursor.chunks[cursor.index]
+                child = children[(self.tree_key(cursor.current, cursor.node),
+                                  chunk)]
+                if child is None:
+                    results[cursor.path] = None
+                    continue
+                cursor.current = posixpath.join(cursor.current, chunk)
+                cursor.node = child
+                cursor.index += 1
+                cursors.append(cursor)
+
+        return results
+
+    @instrumented
+    def create_many(self, entries, batch_size=1000):
+        """Create several nodes at once, from a list of (path, attributes)
+        tuples (attributes may be None, like in create_child_node). Missing
+        intermediate directories are created, like mkdir -p. On trees with DU
+        aggregates, the entries must not exist yet (see check_vacant).
+        Return the list of the uids of the created nodes, in the order of
+        entries."""
+
+        paths = [path for path, _ in entries]
+        attributes = dict(entries)
+
+        # Every ancestor directory which isn't created by an entry.
+        ancestors = set()
+        for path in paths:
+            parent = posixpath.dirname(path)
+            while parent != '/' and parent not in attributes:
+                ancestors.add(parent)
+                parent = posixpath.dirname(parent)
+        ancestors.add('/')
+        ancestors = list(ancestors)
+
+        # The real path and uid where the children of every directory go.
+        dirs = dict(zip(ancestors, self.resolve_many(ancestors, full=True)))
+
+        if self.aggregate:
+            for path in paths:
+                parent, name = posixpath.split(path)
+                if dirs.get(parent) is not None:
+                    self.check_vacant(dirs[parent][0], dirs[parent][1], name)
+
+        # Parents come before their children.
+        missing = [path for path in ancestors if dirs[path] is None]
+        created = sorted(set(missing + paths), key=lambda p: p.count('/'))
+
+        first_uid = self.allocate_uids(len(created))
+        uids = {}
+        real_paths = []
+
+        # Real parent path -> DiskUsage of the nodes created under it.
+        usages = {}
+
+        pipe = self.r.pipeline(transaction=False)
+        for i, path in enumerate(created):
+            uid = first_uid + i
+            uids[path] = str(uid)
+            parent, name = posixpath.split(path)
+            real_parent, parent_uid = dirs[parent]
 
+            attrs = attributes.get(path)
+            if attrs is None:
+                attrs = {'name': name}
+            if self.aggregate:
+                nodes, total = usages.get(real_parent, (0, 0))
+                usages[real_parent] = DiskUsage(
+                    nodes + 1, total + self.aggregate_value(attrs))
+            real_path = posixpath.join(real_parent, name)
+            real_paths.append(real_path)
+            pipe.hmset(*self.node_storage(uid, attrs))
+            pipe.hset(self.tree_key(real_parent, parent_uid), name, uid)
+            if self.path_index:
+                pipe.hset('PATHINDEX', real_path, uid)
+            self.feed_created(pipe, real_path, uid, attrs)
+
+            if 'target' in attrs:
+                dirs[path] = (attrs['target'], attrs['target_node'])
+            else:
+                dirs[path] = (real_path, uid)
+        self._execute_batches(pipe, batch_size)
+
+        if usages:
+            chains = self.ancestors_many(list(usages))
+            increments = {}
+            for real_parent, (nodes, total) in usages.iteritems():
+                for uid in chains[real_parent]:
+                    n, t = increments.get(uid, (0, 0))
+                    increments[uid] = DiskUsage(n + nodes, t + total)
+            self.add_usage(increments, batch_size)
+
+        self.invalidate(*real_paths)
+        return [uids[path] for path in paths]
+
+    @instrumented
+    def get_node_info(self, node_id, fields=None):
+        """Return the attributes of a node, or only the given fields of them
+        (the ones the node doesn't have are left out)."""
+        if self.tree_cache is not None:
+            return self.get_nodes_info([node_id], fields)[0]
+        pipe = self.r.pipeline(transaction=False)
+        self.read_node(pipe, node_id, fields)
+        return self.decode_node(iter(pipe.execute()), fields)
+
+    @instrumented
+    def get_nodes_info(self, uids, fields=None, batch_size=1000):
+        """Return the list of the attributes of several nodes, like
+        get_node_info, read with pipelines of at most batch_size commands."""
+
+        if self.tree_cache is not None:
+            requests = []
+            for uid in uids:
+                requests.extend(self.node_requests(uid, fields))
+            replies = self.tree_cache.read(requests, self.r, batch_size)
+            # The field of a node in its bucket is read with HMGET.
+            res = iter(reply if key.startswith('NODE:') else reply[0]
+                       for (key, _), reply in zip(requests, replies))
+            return [self.decode_node(res, fields) for _ in uids]
+
+        pipe = self.r.pipeline(transaction=False)
+        for uid in uids:
+            self.read_node(pipe, uid, fields)
+        res = iter(self._execute_batches(pipe, batch_size))
+        return [self.decode_node(res, fields) for _ in uids]
+
+    @instrumented
+    def listdir_with_info(self, path, fields=None):
+        """Return a hash of name:(node_uid, attributes) of the children at the
+        given path, like get_children, with their attributes (or the given
+        fields of them) read in a single pipeline."""
+
+        children = self.get_children(path)
+        names = list(children)
+        infos = self.get_nodes_info([children[name] for name in names], fields)
+        return dict((name, (children[name], info))
+                    for name, info in zip(names, infos))
+
+    @instrumented
     def move_node(self, orig_path, dest_path):
         """Move the subtree starting at orig_path to dest_path.
         Example:
             move_node('/foo/bar', '/me')
             /foo/bar/bob -> /me/bob"""
 
+        if self.aggregate:
+            increments = self._moved_usage(orig_path, dest_path)
+        if self.layout == 'uid':
+            real_orig, real_dest = self._move_node_uid(orig_path, dest_path)
+        else:
+            real_orig, real_dest = self._move_node_path(orig_path, dest_path)
+        if self.aggregate:
+            self.add_usage(increments)
+        self.invalidate(real_orig, real_dest)
+
+    def _moved_usage(self, orig_path, dest_path):
+        """Return the DU increments for moving the subtree at orig_path to
+        dest_path: its usage leaves the ancestors it only has at orig_path,
+        and is added to the ones it only has at dest_path."""
+
         parent, name = posixpath.split(orig_path)
         dest_parent, dest_name = posixpath.split(dest_path)
+        if self.layout == 'uid':
+            parent = self.get_real_path(parent, full=True)
+            dest_parent, dest_uid = self.real_node(dest_parent, full=True)
+        else:
+            dest_uid = None
+        self.check_vacant(dest_parent, dest_uid, dest_name)
+        nodes, total = self.subtree_usage(
+            self.get_node_at_path(posixpath.join(parent, name)))
 
-        pipe = self.r.pipeline()
-        pipe.hget("TREE:%s" % parent, name)
-        pipe.hgetall("TREE:%s" % orig_path)
-        uid, content = pipe.execute()
+        chains = self.ancestors_many([parent, dest_parent])
+        increments = {}
+        for uid in chains[parent]:
+            increments[uid] = DiskUsage(-nodes, -total)
+        for uid in chains[dest_parent]:
+            n, t = increments.get(uid, (0, 0))
+            increments[uid] = DiskUsage(n + nodes, t + total)
+        return increments
+
+    def _move_node_path(self, orig_path, dest_path):
+        """Move a subtree with the path layout, where the given paths are
+        real ones. Return them."""
+        check_move(orig_path, dest_path)
+        parent, name = posixpath.split(orig_path)
+        dest_parent, dest_name = posixpath.split(dest_path)
 
+        uid = self.r.hget("TREE:%s" % parent, name)
         if uid == None:
-            raise Exception("Broken path")
+            raise BrokenPath(orig_path)
+
+        # TREE hashes are keyed by path, so the hash of every directory of
+        # the subtree has to be renamed.
+        nodes = self.list_subtree(orig_path, uid)
 
         pipe = self.r.pipeline()
         pipe.hdel("TREE:%s" % parent, name)
         pipe.hset("TREE:%s" % dest_parent, dest_name, uid)
-        if content:
-            pipe.delete("TREE:%s", orig_path)
-            pipe.hmset("TREE:%s" % dest_path, content)
+        for path, _, has_children in nodes:
+            if has_children:
+                pipe.rename("TREE:%s" % path,
+                            "TREE:%s%s" % (dest_path, path[len(orig_path):]))
+        if self.path_index:
+            self._move_index_entries(pipe, nodes, orig_path, dest_path)
+        if self.has_links():
+            self._move_links(pipe, nodes, orig_path, dest_path)
+        self.feed_event(pipe, 'move', orig_path, uid, dest=dest_path)
         pipe.execute()
+        return orig_path, dest_path
+
+    def _move_node_uid(self, orig_path, dest_path):
+        """Move a subtree with the uid layout. Return its real path before
+        and after the move."""
+        parent, name = posixpath.split(orig_path)
+        dest_parent, dest_name = posixpath.split(dest_path)
+
+        real_parent, parent_uid = self.real_node(parent, full=True)
+        real_dest_parent, dest_uid = self.real_node(dest_parent, full=True)
+        parent_key = self.tree_key(real_parent, parent_uid)
+        dest_key = self.tree_key(real_dest_parent, dest_uid)
+        real_orig = posixpath.join(real_parent, name)
+        real_dest = posixpath.join(real_dest_parent, dest_name)
+        check_move(real_orig, real_dest)
+
+        # Unlike the TREE hashes, the path index and the symlinks need to
+        # know every node of the subtree.
+        nodes = []
+        has_links = self.has_links()
+        if self.path_index or has_links:
+            nodes = self.list_subtree(real_orig, self.get_node_at_path(real_orig))
+
+        pipe = self.r.pipeline()
+        try:
+            while True:
+                try:
+                    pipe.watch(parent_key)
+                    uid = pipe.hget(parent_key, name)
+                    if uid == None:
+                        raise BrokenPath(orig_path)
+                    pipe.multi()
+                    pipe.hdel(parent_key, name)
+                    pipe.hset(dest_key, dest_name, uid)
+                    if self.path_index:
+                        self._move_index_entries(pipe, nodes, real_orig,
+                                                 real_dest)
+                    if has_links:
+                        self._move_links(pipe, nodes, real_orig, real_dest)
+                    self.feed_event(pipe, 'move', real_orig, uid,
+                                    dest=real_dest)
+                    pipe.execute()
+                    return real_orig, real_dest
+                except redis.WatchError:
+                    continue
+        finally:
+            pipe.reset()
+
+    def list_subtree(self, path, uid, batch_size=1000):
+        """Return the (real path, uid, has_children) tuples of every node of
+        the subtree starting at the given real path and uid, breadth-first."""
 
-    def get_children(self, path):
-        """Return a hash of name:node_uid of the gildren at the given path."""
-        result = self.r.hgetall("TREE:%s" % path)
+        nodes = []
+        level = [(path, uid)]
+        while level:
+            pipe = self.r.pipeline(transaction=False)
+            for path, uid in level:
+                pipe.hgetall(self.tree_key(path, uid))
+            res = self._execute_batches(pipe, batch_size)
+
+            next_level = []
+            for (path, uid), content in zip(level, res):
+                nodes.append((path, uid, bool(content)))
+                for child, child_uid in content.iteritems():
+                    next_level.append((posixpath.join(path, child), child_uid))
+            level = next_level
+        return nodes
+
+    @instrumented
+    def get_children(self, path, snapshot=None):
+        """Return a hash of name:node_uid of the gildren at the given path,
+        in the live tree or in the given snapshot."""
+        if snapshot is not None:
+            try:
+                uid = self.snapshot_node(snapshot, path)[1]
+            except BrokenPath:
+                return {}
+            return self.r.hgetall("SNAPTREE:%s:%s" % (snapshot, uid))
+        if self.layout == 'uid':
+            try:
+                key = self.tree_key(*self.real_node(path))
+            except BrokenPath:
+                return {}
+        else:
+            key = "TREE:%s" % path
+        result = self.read_hash(key)
         return result
 
+    def walk(self, path, topdown=True, follow_symlinks=False, with_info=False,
+             count=1000, position=None):
+        """Iterate over the subtree at path by pages of (dirpath, entries).
+        Return a redistree.walk.TreeWalker, whose position can be used to
+        resume the walk later."""
+        # redistree.walk needs this module.
+        from redistree.walk import TreeWalker
+        return TreeWalker(self, path, topdown, follow_symlinks, with_info,
+                          count, position)
+
+    def glob(self, pattern, attr_filter=None, count=1000, batch_size=1000):
+        """Iterate over the (path, uid) of the nodes matching pattern, an
+        absolute path whose components are fnmatch patterns, or ** for any
+        number of directories (see redistree.find). attr_filter is a dict
+        of attribute name: value, or a function of the value returning
+        whether it matches; the attributes are read by batches of
+        batch_size nodes. Directories are read with HSCAN by pages of about
+        count entries."""
+        from redistree.find import glob
+        return glob(self, pattern, attr_filter, count, batch_size)
+
+    def find(self, path, name='*', attr_filter=None, count=1000,
+             batch_size=1000):
+        """Iterate over the (path, uid) of the nodes below path (following a
+        final symlink) whose name matches the fnmatch pattern name and
+        whose attributes pass attr_filter, like glob."""
+        from redistree.find import find
+        return find(self, path, name, attr_filter, count, batch_size)
+
+    @instrumented
+    def export_subtree(self, path, fileobj, count=1000):
+        """Stream the subtree at path (following a final symlink) to
+        fileobj, as the JSON lines described in redistree.dump. The subtree
+        is walked like walk, by pages of about count entries.
+        Return a CopyResult (number of exported nodes, elapsed seconds)."""
+        from redistree.dump import export_subtree
+        return export_subtree(self, path, fileobj, count)
+
+    @instrumented
+    def import_subtree(self, path, fileobj, batch_size=1000, processes=None):
+        """Create at path the subtree streamed from fileobj by
+        export_subtree. Every batch of batch_size lines gets a block of uids
+        from allocate_uids and is written with pipelines; symlinks are
+        resolved in the destination tree at the end. With processes, the
+        batches are decoded and written by a pool of that many processes,
+        each with its own connections. With the DU
+        aggregates, the imported subtree is then walked by
+        check_aggregates. Return a CopyResult (number of imported nodes,
+        elapsed seconds)."""
+        from redistree.dump import import_subtree
+        return import_subtree(self, path, fileobj, batch_size, processes)
+
+    @instrumented
     def create_symlink(self, target_path, path):
         """Create a symlink between one tree to another."""
 
         target_node = self.get_node_at_path(target_path)
-        return self.create_child_node(path, {
+        final_target, final_node = self.real_node(target_path, full=True)
+        uid = self.create_child_node(path, {
             'target': target_path,
-            'target_node': target_node
+            'target_node': target_node,
+            'final_target': final_target,
+            'final_node': final_node,
         })
 
+        pipe = self.r.pipeline()
+        self.register_link(pipe, uid, target_node, final_node)
+        pipe.execute()
+        return uid
+
+    def register_link(self, pipe, uid, target_node, final_node):
+        """Queue the registration of the link uid in LINKS:<final node>, and
+        in CHAINS:<target node> if its target is a link itself."""
+        pipe.sadd("LINKS:%s" % final_node, uid)
+        pipe.sadd('LINKED', final_node)
+        if str(target_node) != str(final_node):
+            pipe.sadd("CHAINS:%s" % target_node, uid)
+            pipe.sadd('LINKED', target_node)
+
+    def has_links(self):
+        """Whether any node of the tree is the final target of a symlink, or
+        the target of a link to a symlink."""
+        return bool(self.r.scard('LINKED'))
+
+    def chained_links(self, links):
+        """Return links along with the links going through them (see
+        CHAINS), recursively: they all stop working together."""
+        result = set(links)
+        level = result
+        while level:
+            pipe = self.r.pipeline(transaction=False)
+            for link in level:
+                pipe.smembers("CHAINS:%s" % link)
+            level = set().union(*pipe.execute()) - result
+            result |= level
+        return result
+
+    def _move_links(self, pipe, nodes, orig_path, dest_path):
+        """Queue the updates of the final_target of the links to nodes (as
+        returned by list_subtree) moving from orig_path to dest_path."""
+
+        read = self.r.pipeline(transaction=False)
+        for _, uid, _ in nodes:
+            read.smembers("LINKS:%s" % uid)
+        for (path, _, _), links in zip(nodes, read.execute()):
+            for link in links:
+                pipe.hset("NODE:%s" % link, 'final_target',
+                          dest_path + path[len(orig_path):])
+
+    @instrumented
     def get_target(self, path):
         """Return the target of a symlink (where it points to)."""
 
-        parent, name = posixpath.split(path)
-        uid = self.r.hget("TREE:%s" % parent, name)
-        if not uid:
-            raise Exception("Broken path")
-        return self.r.hget("NODE:%s" % uid, 'target')
+        if self.layout == 'uid':
+            uid = self.get_node_at_path(path)
+        else:
+            parent, name = posixpath.split(path)
+            uid = self.read_hash("TREE:%s" % parent, [name])[0]
+            if not uid:
+                raise BrokenPath(path)
+        return self.read_hash("NODE:%s" % uid, ['target'])[0]
 
+    @instrumented
     def is_symlink(self, path):
         """Return a boolean indicating whether the node is a symlink or not."""
         return bool(self.get_target(path))
 
-    def delete_node(self, apath):
+    @instrumented
+    def delete_node(self, apath, background=False, batch_size=1000):
         """Remove a subtree starting at apath and delete the associated node
-        entries."""
+        entries.
+        The subtree is first detached from its parent with a single HDEL, so
+        it disappears at once for other readers. Its keys are then collected
+        breadth-first with pipelined HGETALLs and reclaimed by batches of
+        batch_size keys. Return the number of deleted nodes, or, when
+        background is True, the thread doing the reclamation."""
 
-        rpath = self.get_real_path(apath)
+        rpath, ruid = self.real_node(apath)
+        parent, name = posixpath.split(rpath)
+        if self.layout == 'uid':
+            parent_key = self.tree_key(*self.real_node(parent))
+        else:
+            parent_key = self.tree_key(parent, None)
 
-        def perform_delete(path, given_uid):
-            parent, name = posixpath.split(path)
-            pipe = self.r.pipeline()
-            pipe.hget("TREE:%s" % parent, name)
-            pipe.hgetall("TREE:%s" % path)
-            pipe.delete("TREE:%s" % path)
-            if given_uid == None:
-                pipe.hdel("TREE:%s" % parent, name)
-            res = pipe.execute()
-            uid = res[0]
-            info = res[1]
+        # The links to the top of the subtree stop working along with the
+        # detach, the links to its descendants when they are reclaimed.
+        links = self.chained_links(self.r.smembers("LINKS:%s" % ruid) |
+                                   self.r.smembers("CHAINS:%s" % ruid))
 
-            if not uid and not given_uid == None:
-                uid = given_uid
+        if self.aggregate:
+            nodes, total = self.subtree_usage(ruid)
+            usage = DiskUsage(-nodes, -total)
+            increments = dict((uid, usage) for uid in self.ancestors(parent))
 
-            if not uid:
-                raise Exception("Broken path")
+        pipe = self.r.pipeline()
+        pipe.hdel(parent_key, name)
+        if self.path_index:
+            # Remove the whole subtree from the index along with the detach,
+            # so lookups never find a node being reclaimed.
+            nodes = self.list_subtree(rpath, ruid, batch_size)
+            for i in range(0, len(nodes), batch_size):
+                pipe.hdel('PATHINDEX', *[n[0] for n in nodes[i:i + batch_size]])
+        for link in links:
+            pipe.hset("NODE:%s" % link, 'dangling', '1')
+        self.feed_event(pipe, 'delete', rpath, ruid)
+        if not pipe.execute()[0]:
+            raise BrokenPath(apath)
+        if self.aggregate:
+            self.add_usage(increments)
+        self.invalidate(apath, rpath)
+
+        if background:
+            thread = threading.Thread(target=self.reclaim_subtree,
+                                      args=(rpath, ruid, batch_size))
+            thread.start()
+            return thread
+        return self.reclaim_subtree(rpath, ruid, batch_size)
+
+    @instrumented
+    def reclaim_subtree(self, path, uid, batch_size=1000):
+        """Delete the NODE and TREE hashes of a subtree which has already been
+        detached from the tree. While snapshots exist, the NODE hashes are
+        kept and registered in SNAPSHOT_ORPHANS instead, for gc_snapshots.
+        Return the number of deleted nodes."""
+
+        has_links = self.has_links()
+        retain = self.has_snapshots()
+        packed = self.node_codec == 'packed'
+        aggregate = self.aggregate
 
-            # Now that the TREE entry has been deleted, we can remove the NODE entry
-            # and the children in a non atomic manner.
+        count = 0
+        level = [(path, uid)]
+        while level:
+            pipe = self.r.pipeline(transaction=False)
+            for path, uid in level:
+                pipe.hgetall(self.tree_key(path, uid))
+                if has_links:
+                    pipe.smembers("LINKS:%s" % uid)
+                    pipe.smembers("CHAINS:%s" % uid)
+                    pipe.hmget("NODE:%s" % uid, ['target_node', 'final_node'])
+            res = iter(self._execute_batches(pipe, batch_size))
 
-            self.r.delete("NODE:%s" % uid)
+            keys = []
+            next_level = []
+            dangling = set()
+            pipe = self.r.pipeline(transaction=False)
+            if retain:
+                for i in range(0, len(level), batch_size):
+                    pipe.sadd('SNAPSHOT_ORPHANS',
+                              *[uid for _, uid in level[i:i + batch_size]])
+            for path, uid in level:
+                content = next(res)
+                if not retain:
+                    keys.append("NODE:%s" % uid)
+                    if packed:
+                        pipe.hdel(*codec.bucket(uid))
+                if aggregate:
+                    keys.append("DU:%s" % uid)
+                if content:
+                    keys.append(self.tree_key(path, uid))
+                for child, child_uid in content.iteritems():
+                    next_level.append((posixpath.join(path, child), child_uid))
 
-            for children, node in info.iteritems():
-                perform_delete('/'.join([path, children]), node)
+                if has_links:
+                    links, chains = next(res), next(res)
+                    target_node, final_node = next(res)
+                    # Mark the links to this node or through it, and
+                    # unregister this node if it is a link itself.
+                    dangling.update(links, chains)
+                    if links:
+                        keys.append("LINKS:%s" % uid)
+                    if chains:
+                        keys.append("CHAINS:%s" % uid)
+                    if links or chains:
+                        pipe.srem('LINKED', uid)
+                    if final_node is not None:
+                        pipe.srem("LINKS:%s" % final_node, uid)
+                        if target_node != final_node:
+                            pipe.srem("CHAINS:%s" % target_node, uid)
+            for link in self.chained_links(dangling):
+                pipe.hset("NODE:%s" % link, 'dangling', '1')
+            self._execute_batches(pipe, batch_size)
+            self.delete_keys(keys, batch_size)
 
-        return perform_delete(rpath, None)
+            count += len(level)
+            level = next_level
+        return count
 
-    def clone_node(self, uid):
-        """Clone a node entry and return the uid of the new node."""
-        data = self.r.hgetall("NODE:%s" % uid)
+    def delete_keys(self, keys, batch_size=1000):
+        """Delete keys with UNLINK (or DEL on servers older than Redis 4), by
+        commands of at most batch_size keys sent in a single pipeline."""
+
+        command = self.use_unlink and 'UNLINK' or 'DEL'
+        pipe = self.r.pipeline(transaction=False)
+        for i in range(0, len(keys), batch_size):
+            pipe.execute_command(command, *keys[i:i + batch_size])
+        try:
+            pipe.execute()
+        except redis.ResponseError as e:
+            if not self.use_unlink or 'unknown command' not in str(e).lower():
+                raise
+            self.use_unlink = False
+            self.delete_keys(keys, batch_size)
+
+    @instrumented
+    def clone_node(self, uid, fields=None):
+        """Clone a node entry, or only the given fields of it, and return the
+        uid of the new node."""
+        data = self.get_node_info(uid, fields)
         return self.create_node(data)
 
-    def copy_path(self, source_path, dest_path):
-        """Copy a subtree starting at source_path to dest_path."""
+    @instrumented
+    def copy_path(self, source_path, dest_path, batch_size=1000):
+        """Copy a subtree starting at source_path to dest_path.
+        The subtree is walked breadth-first: every level is read with
+        pipelined HGETALLs, gets a block of uids from allocate_uids and is
+        written with pipelines of at most batch_size commands.
+        Return a CopyResult (number of copied nodes, elapsed seconds)."""
+
+        start = time()
         dparent, dname = posixpath.split(dest_path)
         rs_path, rs_node = self.real_node(source_path)
-        rd_path = self.get_real_path(dparent)
+        rd_path, rd_node = self.real_node(dparent, full=True)
+        self.check_vacant(rd_path, rd_node, dname)
+
+        count = 0
+        # (source path, source uid, destination parent path and uid, name)
+        level = [(rs_path, rs_node, rd_path, rd_node, dname)]
+        aggregate = self.aggregate
+        usage = None
+
+        while level:
+            pipe = self.r.pipeline(transaction=False)
+            for path, uid, _, _, _ in level:
+                self.read_node(pipe, uid)
+                pipe.hgetall(self.tree_key(path, uid))
+                if aggregate:
+                    pipe.hgetall("DU:%s" % uid)
+            res = iter(self._execute_batches(pipe, batch_size * 3))
+
+            first_uid = self.allocate_uids(len(level))
+
+            children = {}
+            next_level = []
+            pipe = self.r.pipeline(transaction=False)
+            for i, (path, uid, dparent, dparent_uid, name) in enumerate(level):
+                new_uid = first_uid + i
+                data = self.decode_node(res)
+                content = next(res)
+                if aggregate:
+                    # The copy has the same descendants as the source.
+                    du = next(res)
+                    if du:
+                        pipe.hmset("DU:%s" % new_uid, du)
+                    if usage is None:
+                        usage = DiskUsage(
+                            1 + int(du.get('nodes', 0)),
+                            self.aggregate_value(data) +
+                            int(du.get('total', 0)))
+                if data:
+                    pipe.hmset(*self.node_storage(new_uid, data))
+                    if 'final_node' in data:
+                        self.register_link(pipe, new_uid, data['target_node'],
+                                           data['final_node'])
+                dkey = self.tree_key(dparent, dparent_uid)
+                children.setdefault(dkey, {})[name] = new_uid
+
+                dpath = posixpath.join(dparent, name)
+                if self.path_index:
+                    pipe.hset('PATHINDEX', dpath, new_uid)
+                for child, child_uid in content.iteritems():
+                    next_level.append((posixpath.join(path, child), child_uid,
+                                       dpath, new_uid, child))
+
+            for dkey, content in children.iteritems():
+                pipe.hmset(dkey, content)
+            if count == 0:
+                copy_uid = first_uid
+            if not next_level:
+                self.feed_event(pipe, 'copy', rs_path, copy_uid,
+                                dest=posixpath.join(rd_path, dname))
+            self._execute_batches(pipe, batch_size)
+
+            count += len(level)
+            level = next_level
+
+        if aggregate:
+            self.add_usage(dict((uid, usage)
+                                for uid in self.ancestors(rd_path)))
+        self.invalidate(posixpath.join(rd_path, dname))
+        return CopyResult(count, time() - start)
+
+    def _execute_batches(self, pipe, batch_size):
+        """Execute the commands queued in a (non transactional) pipeline by
+        batches of batch_size, and return all the results."""
+
+        commands = pipe.command_stack
+        results = []
+        for i in range(0, len(commands), batch_size):
+            pipe.command_stack = commands[i:i + batch_size]
+            results.extend(pipe.execute())
+        pipe.command_stack = []
+        return results
+
+
+    @instrumented
+    def migrate_layout(self, layout, batch_size=1000):
+        """Switch the tree to another layout of the TREE hashes ('path' or
+        'uid') by renaming all of them. The tree must not be modified during
+        the migration, and the other clients must be recreated afterwards.
+        Return the number of renamed hashes."""
+
+        if layout == self.layout:
+            return 0
+
+        keys = {
+            'path': lambda path, uid: "TREE:%s" % path,
+            'uid': lambda path, uid: "TREE:%s" % uid,
+        }
+        old_key, new_key = keys[self.layout], keys[layout]
+
+        count = 0
+        level = [('/', self.ROOT_NODE)]
+        while level:
+            pipe = self.r.pipeline(transaction=False)
+            for path, uid in level:
+                pipe.hgetall(old_key(path, uid))
+            res = self._execute_batches(pipe, batch_size)
+
+            next_level = []
+            pipe = self.r.pipeline(transaction=False)
+            for (path, uid), content in zip(level, res):
+                if not content:
+                    continue
+                pipe.rename(old_key(path, uid), new_key(path, uid))
+                count += 1
+                for child, child_uid in content.iteritems():
+                    next_level.append((posixpath.join(path, child), child_uid))
+            self._execute_batches(pipe, batch_size)
+            level = next_level
+
+        self.r.set('TREE_LAYOUT', layout)
+        self._layout = layout
+        return count
+
+
+    def _move_index_entries(self, pipe, nodes, orig_path, dest_path):
+        """Queue the path index updates for moving nodes (as returned by
+        list_subtree) from orig_path to dest_path."""
+        for path, uid, _ in nodes:
+            pipe.hdel('PATHINDEX', path)
+            pipe.hset('PATHINDEX', dest_path + path[len(orig_path):], uid)
+
+    @instrumented
+    def rebuild_path_index(self, batch_size=1000):
+        """Build PATHINDEX from the TREE hashes and turn it on for the tree.
+        The index is built under a temporary key and swapped in at the end.
+        Other clients must be recreated to maintain it. Return the number of
+        indexed nodes."""
+
+        self.r.delete('PATHINDEX:rebuild')
+        count = 0
+        level = [('/', self.ROOT_NODE)]
+        while level:
+            pipe = self.r.pipeline(transaction=False)
+            for path, uid in level:
+                pipe.hgetall(self.tree_key(path, uid))
+            res = self._execute_batches(pipe, batch_size)
+
+            next_level = []
+            pipe = self.r.pipeline(transaction=False)
+            for (path, uid), content in zip(level, res):
+                if not content:
+                    continue
+                children = dict([(posixpath.join(path, child), child_uid)
+                                 for child, child_uid in content.iteritems()])
+                pipe.hmset('PATHINDEX:rebuild', children)
+                next_level.extend(children.items())
+            self._execute_batches(pipe, batch_size)
+            count += len(next_level)
+            level = next_level
+
+        pipe = self.r.pipeline()
+        if count:
+            pipe.rename('PATHINDEX:rebuild', 'PATHINDEX')
+        else:
+            pipe.delete('PATHINDEX')
+        pipe.set('TREE_PATHINDEX', '1')
+        pipe.execute()
+        self._path_index = True
+        return count
+
+    @instrumented
+    def drop_path_index(self):
+        """Turn the path index off and delete it."""
+        pipe = self.r.pipeline()
+        pipe.delete('TREE_PATHINDEX')
+        pipe.delete('PATHINDEX')
+        pipe.execute()
+        self._path_index = False
+
+    @instrumented
+    def path_index_size(self):
+        """Return the number of entries of the path index, and its size in
+        bytes (None if the server doesn't support MEMORY USAGE)."""
+        entries = self.r.hlen('PATHINDEX')
+        try:
+            size = self.r.execute_command('MEMORY', 'USAGE', 'PATHINDEX',
+                                          'SAMPLES', '0')
+        except redis.ResponseError:
+            size = None
+        return {'entries': entries, 'bytes': size}
+
+    def aggregate_value(self, attributes):
+        """Return the value of the aggregated attribute in attributes, 0 if
+        it is missing or isn't an integer."""
+        try:
+            return int(attributes.get(self.aggregate, 0))
+        except ValueError:
+            return 0
+
+    def ancestors(self, path):
+        """Return the uids of the nodes from the root to the given real path
+        (included)."""
+        return self.ancestors_many([path])[path]
+
+    def ancestors_many(self, paths):
+        """Return a dict of real path: uids of the nodes from the root to it.
+        With the path layout or the path index, every uid is read in a
+        single pipeline. With the uid layout, they are read by a script, or
+        by resolve_many without scripting."""
+
+        if self.layout == 'uid' and not self.path_index and self.use_scripts:
+            args = []
+            for path in paths:
+                chunks = self.split_path(path)
+                args.append(len(chunks))
+                args.extend(chunks)
+            try:
+                chains = self.run_script(ANCESTORS_SCRIPT, self.ROOT_NODE,
+                                         *args)
+            except ScriptingUnavailable:
+                pass
+            except redis.ResponseError as e:
+                if str(e) == 'Broken path':
+                    raise BrokenPath(', '.join(paths))
+                raise
+            else:
+                return dict((path, [self.ROOT_NODE] + chain)
+                            for path, chain in zip(paths, chains))
+
+        prefixes = set()
+        for path in paths:
+            while path != '/':
+                prefixes.add(path)
+                path = posixpath.dirname(path)
+        prefixes = list(prefixes)
+
+        if self.path_index or self.layout == 'path':
+            pipe = self.r.pipeline(transaction=False)
+            for prefix in prefixes:
+                if self.path_index:
+                    pipe.hget('PATHINDEX', prefix)
+                else:
+                    pipe.hget("TREE:%s" % posixpath.dirname(prefix),
+                              posixpath.basename(prefix))
+            uids = pipe.execute()
+        else:
+            uids = [res and res[1]
+                    for res in self.resolve_many(prefixes)]
+        uids = dict(zip(prefixes, uids))
+        uids['/'] = self.ROOT_NODE
+
+        chains = {}
+        for path in paths:
+            chain = []
+            prefix = path
+            while True:
+                if uids[prefix] is None:
+                    raise BrokenPath(prefix)
+                chain.append(uids[prefix])
+                if prefix == '/':
+                    break
+                prefix = posixpath.dirname(prefix)
+            chains[path] = chain[::-1]
+        return chains
+
+    def add_usage(self, increments, batch_size=1000):
+        """Add DiskUsage increments to the DU aggregates of the nodes, from a
+        dict of uid: DiskUsage, with pipelined HINCRBYs."""
+
+        pipe = self.r.pipeline(transaction=False)
+        for uid, (nodes, total) in increments.iteritems():
+            if nodes:
+                pipe.hincrby("DU:%s" % uid, 'nodes', nodes)
+            if total:
+                pipe.hincrby("DU:%s" % uid, 'total', total)
+        self._execute_batches(pipe, batch_size)
+
+    def subtree_usage(self, uid):
+        """Return the DiskUsage of the subtree of a node, itself included."""
+        pipe = self.r.pipeline(transaction=False)
+        self.read_node(pipe, uid, [self.aggregate])
+        pipe.hmget("DU:%s" % uid, ['nodes', 'total'])
+        res = iter(pipe.execute())
+        attributes = self.decode_node(res, [self.aggregate])
+        nodes, total = next(res)
+        return DiskUsage(1 + int(nodes or 0),
+                         self.aggregate_value(attributes) + int(total or 0))
+
+    def check_vacant(self, real_parent, parent_uid, name):
+        """With the DU aggregates, raise NodeExists if the directory at
+        real_parent already has a child with this name. Replacing it would
+        leave its usage in the aggregates, and with the path layout the new
+        node even takes over its TREE hash."""
+        if self.aggregate and self.r.hexists(
+                self.tree_key(real_parent, parent_uid), name):
+            raise NodeExists(posixpath.join(real_parent, name))
+
+    @instrumented
+    def du(self, path):
+        """Return the DiskUsage of the subtree at path (following a final
+        symlink), from the DU aggregates: its number of nodes and the sum of
+        the aggregated attribute over them."""
+        if not self.aggregate:
+            raise Exception("The DU aggregates are turned off")
+        return self.subtree_usage(self.get_node_at_path(path, full=True))
+
+    @instrumented
+    def check_aggregates(self, path='/', repair=False, batch_size=1000):
+        """Recompute the DU aggregates of the subtree at path from its nodes
+        and return the (real path, stored, actual DiskUsage) of the ones
+        which drifted, such as after a client died between a mutation and
+        its HINCRBYs. With repair, the drifted aggregates are rewritten."""
+
+        attribute = self.aggregate
+        if not attribute:
+            raise Exception("The DU aggregates are turned off")
+        real, uid = self.real_node(path, full=True)
+
+        # Breadth-first list of [path, uid, index of the parent, value,
+        # stored DiskUsage, actual DiskUsage of the descendants].
+        nodes = [[real, uid, None, 0, None, [0, 0]]]
+        start = 0
+        while start < len(nodes):
+            level = nodes[start:]
+            pipe = self.r.pipeline(transaction=False)
+            for path, uid, _, _, _, _ in level:
+                self.read_node(pipe, uid, [attribute])
+                pipe.hgetall(self.tree_key(path, uid))
+                pipe.hmget("DU:%s" % uid, ['nodes', 'total'])
+            res = iter(self._execute_batches(pipe, batch_size * 3))
+
+            for i, node in enumerate(level, start):
+                node[3] = self.aggregate_value(
+                    self.decode_node(res, [attribute]))
+                content = next(res)
+                stored = next(res)
+                node[4] = DiskUsage(int(stored[0] or 0), int(stored[1] or 0))
+                for child, child_uid in content.iteritems():
+                    nodes.append([posixpath.join(node[0], child), child_uid,
+                                  i, 0, None, [0, 0]])
+            start += len(level)
+
+        # Children come after their parents.
+        for path, uid, parent, value, _, actual in reversed(nodes):
+            if parent is not None:
+                nodes[parent][5][0] += 1 + actual[0]
+                nodes[parent][5][1] += value + actual[1]
+
+        drifts = []
+        pipe = self.r.pipeline(transaction=False)
+        for path, uid, _, _, stored, actual in nodes:
+            actual = DiskUsage(*actual)
+            if stored == actual:
+                continue
+            drifts.append((path, stored, actual))
+            if repair:
+                pipe.delete("DU:%s" % uid)
+                if actual.nodes:
+                    pipe.hmset("DU:%s" % uid, actual._asdict())
+        self._execute_batches(pipe, batch_size)
+        return drifts
+
+    @instrumented
+    def enable_aggregates(self, attribute='size', batch_size=1000):
+        """Turn the DU aggregates on for the tree, summing up the given
+        numeric attribute, and compute them. The tree must not be modified
+        meanwhile, and other clients must be recreated to maintain them.
+        Return the number of computed aggregates."""
+
+        self.r.set('TREE_AGGREGATE', attribute)
+        self._aggregate = attribute
+        return len(self.check_aggregates('/', True, batch_size))
+
+    @instrumented
+    def drop_aggregates(self, batch_size=1000):
+        """Turn the DU aggregates off and delete them."""
+        nodes = self.list_subtree('/', self.ROOT_NODE, batch_size)
+        self.r.delete('TREE_AGGREGATE')
+        self._aggregate = None
+        self.delete_keys(["DU:%s" % uid for _, uid, _ in nodes], batch_size)
+
+    @instrumented
+    def snapshot(self, path, batch_size=1000, attempts=10):
+        """Take a read-only, point-in-time view of the subtree at path
+        (following a final symlink) and return its id, to be given to
+        real_node and get_children.
+        The TREE hashes of the subtree are copied to SNAPTREE:<id>:<uid>
+        level by level, by scripts (or pipelines) copying at most batch_size
+        directories each, so a large subtree doesn't block Redis. The NODE
+        hashes are shared with the live tree: deleting nodes from the live
+        tree keeps their NODE hashes for the snapshots until gc_snapshots.
+        Every TREE hash is under WATCH before being copied, and the snapshot
+        is only registered by a transaction failing if any of them changed
+        meanwhile: the view is always the subtree as it was at that
+        transaction. A subtree modified during the copy is copied again, up
+        to attempts times before raising redis.WatchError."""
+
+        snapshot_id = self.r.incr('SNAPSHOT_COUNTER')
+        for attempt in range(attempts):
+            copied = []
+            registered = False
+            pipe = self.r.pipeline()
+            try:
+                real_path, uid = self._snapshot_copy(pipe, snapshot_id, path,
+                                                     batch_size, copied)
+                pipe.multi()
+                pipe.hmset("SNAPSHOT:%s" % snapshot_id,
+                           {'path': real_path, 'uid': uid,
+                            'created': '%.6f' % time()})
+                pipe.sadd('SNAPSHOTS', snapshot_id)
+                pipe.execute()
+                registered = True
+                return snapshot_id
+            except redis.WatchError:
+                if attempt == attempts - 1:
+                    raise
+            finally:
+                pipe.reset()
+                if not registered:
+                    # A sharded transaction can fail after registering.
+                    self.r.srem('SNAPSHOTS', snapshot_id)
+                    self.delete_keys(["SNAPSHOT:%s" % snapshot_id] +
+                                     ["SNAPTREE:%s:%s" % (snapshot_id, node)
+                                      for node in copied], batch_size)
+
+    def _snapshot_copy(self, pipe, snapshot_id, path, batch_size, copied):
+        """Copy the subtree at path to a snapshot, putting the TREE hashes
+        under WATCH on pipe before reading them, and the uids of the copied
+        directories in copied. Return the real path and uid of its top."""
+
+        real_path, uid = self.real_node(path, full=True)
+        parent, name = posixpath.split(real_path)
+        if self.layout == 'uid' and real_path != '/':
+            parent_key = self.tree_key(*self.real_node(parent))
+        else:
+            parent_key = self.tree_key(parent, None)
+        pipe.watch(parent_key)
+        if real_path != '/' and pipe.hget(parent_key, name) != str(uid):
+            raise BrokenPath(path)
+
+        level = [(real_path, uid)]
+        while level:
+            next_level = []
+            for i in range(0, len(level), batch_size):
+                batch = level[i:i + batch_size]
+                pipe.watch(*[self.tree_key(*directory) for directory in batch])
+                copied.extend(directory_uid for _, directory_uid in batch)
+                next_level.extend(self._snapshot_batch(snapshot_id, batch))
+            level = next_level
+        return real_path, uid
+
+    def _snapshot_batch(self, snapshot_id, directories):
+        """Copy the TREE hashes of the (real path, uid) directories to a
+        snapshot and return the (real path, uid) of their children."""
+
+        if self.use_scripts:
+            args = []
+            for directory in directories:
+                args.extend(directory)
+            try:
+                res = self.run_script(SNAPSHOT_SCRIPT, self.layout,
+                                      snapshot_id, *args)
+            except ScriptingUnavailable:
+                pass
+            else:
+                return zip(res[::2], res[1::2])
+
+        pipe = self.r.pipeline(transaction=False)
+        for path, uid in directories:
+            pipe.hgetall(self.tree_key(path, uid))
+        res = pipe.execute()
+
+        children = []
+        pipe = self.r.pipeline(transaction=False)
+        for (path, uid), content in zip(directories, res):
+            if content:
+                pipe.hmset("SNAPTREE:%s:%s" % (snapshot_id, uid), content)
+            for child, child_uid in content.iteritems():
+                children.append((posixpath.join(path, child), child_uid))
+        pipe.execute()
+        return children
+
+    def has_snapshots(self):
+        """Whether any snapshot of the tree exists."""
+        return bool(self.r.scard('SNAPSHOTS'))
+
+    @instrumented
+    def get_snapshots(self):
+        """Return a dict of snapshot id: {'path': real path of the subtree
+        when it was taken, 'uid': uid of its top node, 'created': time}."""
+
+        ids = sorted(self.r.smembers('SNAPSHOTS'), key=int)
+        pipe = self.r.pipeline(transaction=False)
+        for snapshot_id in ids:
+            pipe.hgetall("SNAPSHOT:%s" % snapshot_id)
+        return dict((int(snapshot_id), info)
+                    for snapshot_id, info in zip(ids, pipe.execute()) if info)
+
+    def snapshot_node(self, snapshot_id, path, full=False):
+        """Return the path and uid of the node at path in a snapshot. Paths
+        are relative to the top of the snapshot, '/' being its top node.
+        Symlinks are followed within the snapshot: the ones pointing out of
+        the snapshotted subtree raise BrokenPath."""
+
+        info = self.r.hgetall("SNAPSHOT:%s" % snapshot_id)
+        if not info:
+            raise SnapshotNotFound(snapshot_id)
+        source = info['path']
+        prefix = source.rstrip('/')
+
+        chunks = self.split_path(path)
+        current_path, current_node = '/', info['uid']
+        hops = 0
+        while True:
+            if len(chunks) == 0 and not full:
+                break
+
+            # Snapshots share the NODE hashes with the live tree, whose
+            # target never changes.
+            target = self.r.hget("NODE:%s" % current_node, 'target')
+            if target is not None:
+                hops += 1
+                if hops > self.max_symlink_hops:
+                    raise SymlinkLoopError(current_path)
+                if target != source and not target.startswith(prefix + '/'):
+                    raise BrokenPath(target)
+                chunks = self.split_path(target[len(prefix):] or '/') + chunks
+                current_path, current_node = '/', info['uid']
+                continue
+
+            if len(chunks) == 0:
+                break
+            chunk = chunks.pop(0)
+            current_node = self.r.hget(
+                "SNAPTREE:%s:%s" % (snapshot_id, current_node), chunk)
+            if current_node is None:
+                raise BrokenPath(posixpath.join(current_path, chunk))
+            current_path = posixpath.join(current_path, chunk)
+
+        if current_node == str(self.ROOT_NODE):
+            current_node = self.ROOT_NODE
+        return current_path, current_node
+
+    def _snapshot_nodes(self, snapshot_id, uid, batch_size=1000):
+        """Return the uids of the nodes of a snapshot, from its top node."""
+
+        nodes = []
+        level = [uid]
+        while level:
+            nodes.extend(level)
+            pipe = self.r.pipeline(transaction=False)
+            for uid in level:
+                pipe.hvals("SNAPTREE:%s:%s" % (snapshot_id, uid))
+            level = [child for children in
+                     self._execute_batches(pipe, batch_size)
+                     for child in children]
+        return nodes
+
+    @instrumented
+    def drop_snapshot(self, snapshot_id, batch_size=1000):
+        """Delete a snapshot. The NODE hashes it kept alive are released by
+        the next gc_snapshots."""
+
+        info = self.r.hgetall("SNAPSHOT:%s" % snapshot_id)
+        if not info:
+            raise SnapshotNotFound(snapshot_id)
+        pipe = self.r.pipeline()
+        pipe.srem('SNAPSHOTS', snapshot_id)
+        pipe.delete("SNAPSHOT:%s" % snapshot_id)
+        pipe.execute()
+        nodes = self._snapshot_nodes(snapshot_id, info['uid'], batch_size)
+        self.delete_keys(["SNAPTREE:%s:%s" % (snapshot_id, uid)
+                          for uid in nodes], batch_size)
+
+    @instrumented
+    def gc_snapshots(self, batch_size=1000):
+        """Delete the NODE hashes of the nodes deleted from the live tree
+        (SNAPSHOT_ORPHANS) which no remaining snapshot holds. The nodes of
+        every snapshot are walked to find the ones still held. Return the
+        number of released nodes."""
 
-        new_uid = self.clone_node(rs_node)
-        self.r.hset("TREE:%s" % rd_path, dname, new_uid)
+        orphans = list(self.r.sscan_iter('SNAPSHOT_ORPHANS', count=batch_size))
+        if not orphans:
+            return 0
+        held = set()
+        for snapshot_id, info in self.get_snapshots().iteritems():
+            held.update(self._snapshot_nodes(snapshot_id, info['uid'],
+                                             batch_size))
+        released = [uid for uid in orphans if uid not in held]
 
-        for children, node in self.get_children(rs_path).iteritems():
-            self.copy_path('/'.join([source_path, children]),
-                           '/'.join([dest_path, children]))
+        packed = self.node_codec == 'packed'
+        pipe = self.r.pipeline(transaction=False)
+        for i in range(0, len(released), batch_size):
+            pipe.srem('SNAPSHOT_ORPHANS', *released[i:i + batch_size])
+        if packed:
+            for uid in released:
+                pipe.hdel(*codec.bucket(uid))
+        self._execute_batches(pipe, batch_size)
+        self.delete_keys(["NODE:%s" % uid for uid in released], batch_size)
+        return len(released)
 
 
 class RedisTree(RedisTreeCore):
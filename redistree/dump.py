@@ -0,0 +1,267 @@
+"""
+Streaming export and import of subtrees, as JSON lines.
+
+The first line is a header, {"version": 1, "path": <exported path>}. Every
+following line is a node, parents before their children:
+
+    {"path": <path relative to the exported one>, "parent": <number of the
+     node line of the parent, the first one being 0>, "uid": <uid in the
+     source tree>, "attributes": {...}, "target": <target of a symlink>}
+
+The exported node comes first, with an empty path and no parent. Symlinks
+only keep their target: the import resolves them again, in the destination
+tree, once every node has been written.
+
+Neither side holds the whole subtree in memory: the export keeps the line
+numbers of the entries of the last page of every directory being walked,
+and the import the first uid allocated for every window of batches (and the
+symlinks, until the end).
+"""
+
+import bisect
+import json
+import multiprocessing
+import posixpath
+from itertools import islice
+from time import time
+import redis
+
+from redistree.core import LINK_FIELDS, CopyResult, RedisTree
+
+
+VERSION = 1
+
+
+def export_subtree(tree, path, fileobj, count=1000):
+    """Write the subtree at path to fileobj. See RedisTreeCore.export_subtree.
+    """
+
+    start = time()
+    walker = tree.walk(path, with_info=True, count=count)
+    fileobj.write(json.dumps({'version': VERSION, 'path': path}) + '\n')
+
+    nodes = 0
+    for records in _pages(tree, walker):
+        fileobj.write(_encode(records))
+        nodes += len(records)
+    return CopyResult(nodes, time() - start)
+
+
+def _pages(tree, walker):
+    """Yield the node records of the walk, by lists."""
+
+    root = walker.stack[0]
+    yield [{'path': '', 'uid': root.uid,
+            'attributes': tree.get_node_info(root.uid)}]
+
+    line = 1
+    # Relative path of a directory -> {name: line} for the last page of the
+    # directories between the root and the one being walked.
+    pages = {'': {}}
+    for dirpath, entries in walker:
+        rel = posixpath.relpath(dirpath, root.path)
+        if rel == '.':
+            rel = ''
+            parent = 0
+        else:
+            parent = pages[posixpath.dirname(rel)][posixpath.basename(rel)]
+        for done in [p for p in pages
+                     if p and rel != p and not rel.startswith(p + '/')]:
+            del pages[done]
+
+        records = []
+        page = pages[rel] = {}
+        for name, uid, attributes in entries:
+            record = {'path': posixpath.join(rel, name), 'parent': parent,
+                      'uid': uid}
+            target = attributes.get('target')
+            if target is not None:
+                record['target'] = target
+                for field in LINK_FIELDS:
+                    attributes.pop(field, None)
+            record['attributes'] = attributes
+            records.append(record)
+            page[name] = line
+            line += 1
+        yield records
+
+
+def _encode(records):
+    return ''.join(json.dumps(record) + '\n' for record in records)
+
+
+def _batches(fileobj, batch_size):
+    while True:
+        lines = list(islice(fileobj, batch_size))
+        if not lines:
+            return
+        yield lines
+
+
+def import_subtree(tree, path, fileobj, batch_size=1000, processes=None):
+    """Create the subtree read from fileobj at path. See
+    RedisTreeCore.import_subtree."""
+
+    start = time()
+    header = json.loads(fileobj.readline())
+    if header.get('version') != VERSION:
+        raise ValueError("Unknown dump version: %r" % header.get('version'))
+    source = header['path']
+
+    parent, name = posixpath.split(path)
+    real_parent, parent_uid = tree.real_node(parent, full=True)
+    dest = posixpath.join(real_parent, name)
+    tree.check_vacant(real_parent, parent_uid, name)
+
+    pool = None
+    window = 1
+    if processes:
+        pool = multiprocessing.Pool(processes, _init_worker,
+                                    (_connection_options(tree),))
+        window = processes * 2
+
+    # The line of the first node of every window of batches, and its uid:
+    # the uids of a window are consecutive.
+    lines = []
+    uids = []
+    links = []
+    count = 0
+    try:
+        batches = _batches(fileobj, batch_size)
+        while True:
+            batches_window = list(islice(batches, window))
+            if not batches_window:
+                break
+            size = sum(len(batch) for batch in batches_window)
+            lines.append(count)
+            uids.append(tree.allocate_uids(size))
+
+            tasks = []
+            for batch in batches_window:
+                tasks.append((batch, count, lines, uids, dest, real_parent,
+                              parent_uid, batch_size))
+                count += len(batch)
+            if pool is None:
+                results = [_write_batch(tree, *task) for task in tasks]
+            else:
+                results = pool.map(_import_batch, tasks)
+            for batch_links in results:
+                links.extend(batch_links)
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    for i in range(0, len(links), batch_size):
+        _import_links(tree, source, dest, links[i:i + batch_size])
+
+    if tree.aggregate:
+        tree.check_aggregates(dest, repair=True, batch_size=batch_size)
+        usage = tree.subtree_usage(tree.get_node_at_path(dest))
+        tree.add_usage(dict((uid, usage)
+                            for uid in tree.ancestors(real_parent)))
+
+    if count:
+        pipe = tree.r.pipeline(transaction=False)
+        tree.feed_event(pipe, 'import', dest, uids[0])
+        pipe.execute()
+    tree.invalidate(dest)
+    return CopyResult(count, time() - start)
+
+
+def _write_batch(tree, batch, first_line, lines, uids, dest, real_parent,
+                 parent_uid, batch_size):
+    """Decode a batch of lines and write their nodes, except the symlinks,
+    which are returned."""
+
+    def uid_of(line):
+        window = bisect.bisect(lines, line) - 1
+        return uids[window] + line - lines[window]
+
+    links = []
+    children = {}
+    pipe = tree.r.pipeline(transaction=False)
+    for line, text in enumerate(batch, first_line):
+        record = json.loads(text)
+        uid = uid_of(line)
+        rel = record['path']
+        if rel:
+            real = posixpath.join(dest, rel)
+            key = tree.tree_key(posixpath.dirname(real),
+                                uid_of(record['parent']))
+        else:
+            real = dest
+            key = tree.tree_key(real_parent, parent_uid)
+        child = posixpath.basename(real)
+
+        if 'target' in record:
+            links.append((key, child, uid, real, record['target'],
+                          record['attributes']))
+            continue
+        node_key, attributes = tree.node_storage(uid, record['attributes'])
+        if attributes:
+            pipe.hmset(node_key, attributes)
+        children.setdefault(key, {})[child] = uid
+        if tree.path_index:
+            pipe.hset('PATHINDEX', real, uid)
+
+    for key, content in children.items():
+        pipe.hmset(key, content)
+    tree._execute_batches(pipe, batch_size)
+    return links
+
+
+def _connection_options(tree):
+    """Return what the import processes need to connect to the tree."""
+    clients = getattr(tree.r, 'clients', None)
+    if clients is not None:
+        return [client.connection_pool.connection_kwargs
+                for client in clients]
+    return tree.pool.connection_kwargs
+
+
+# The tree of an import process.
+_worker_tree = None
+
+
+def _init_worker(options):
+    global _worker_tree
+    if isinstance(options, list):
+        _worker_tree = RedisTree(shards=[redis.ConnectionPool(**kwargs)
+                                         for kwargs in options])
+    else:
+        _worker_tree = RedisTree(
+            connection_pool=redis.ConnectionPool(**options))
+
+
+def _import_batch(task):
+    return _write_batch(_worker_tree, *task)
+
+
+def _import_links(tree, source, dest, links):
+    """Write the symlinks of an import, pointing the ones into the exported
+    subtree to the imported one."""
+
+    prefix = source.rstrip('/')
+    targets = []
+    for _, _, _, _, target, _ in links:
+        if target == source or target.startswith(prefix + '/'):
+            target = dest + target[len(prefix):]
+        targets.append(target)
+    nodes = tree.resolve_many(targets)
+    finals = tree.resolve_many(targets, full=True)
+
+    pipe = tree.r.pipeline(transaction=False)
+    for (key, child, uid, real, _, attributes), target, node, final in \
+            zip(links, targets, nodes, finals):
+        attributes = dict(attributes, target=target)
+        if node is None or final is None:
+            attributes['dangling'] = '1'
+        else:
+            attributes.update(target_node=node[1], final_target=final[0],
+                              final_node=final[1])
+            tree.register_link(pipe, uid, node[1], final[1])
+        pipe.hmset("NODE:%s" % uid, attributes)
+        pipe.hset(key, child, uid)
+        if tree.path_index:
+            pipe.hset('PATHINDEX', real, uid)
+    pipe.execute()
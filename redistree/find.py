@@ -0,0 +1,220 @@
+"""
+Pattern searches over the tree, see RedisTreeCore.glob and RedisTreeCore.find.
+
+A pattern is an absolute path whose components are fnmatch patterns (*, ?,
+[seq], [!seq]) matched against the names of the nodes, or ** for any number
+of directories (including none). Like fnmatch, and unlike the shell, names
+starting with a dot are not special.
+
+The search is breadth-first, one pattern component at a time: the
+directories matched so far are expanded together, with pipelines of at most
+batch_size commands. The leading components without wildcards are resolved
+at once with real_node, the other literal components with a HGET per
+directory, and the components with wildcards with HSCAN MATCH, so Redis
+only sends back the names which may match. With **, every directory below
+has to be listed anyway, so its pages are read whole and matched here.
+
+Symlinks are followed when they match a component which isn't the last one,
+but never by **, so a search can't loop.
+"""
+
+import posixpath
+import re
+from fnmatch import fnmatchcase
+from itertools import islice
+
+from redistree.core import LINK_FIELDS, BrokenPath, link_destination
+
+
+MAGIC = re.compile(r'[*?[]')
+
+# A bracket expression, as parsed by fnmatch.
+BRACKET = re.compile(r'\[!?\]?[^\]]*\]')
+
+
+def has_magic(component):
+    return MAGIC.search(component) is not None
+
+
+def scan_pattern(component):
+    """Return the HSCAN MATCH pattern for a component: it may match more
+    names than the component, never less. The glob of Redis differs from
+    fnmatch for bracket expressions and backslashes, so they are replaced by
+    ?, which matches any single character."""
+    pattern = BRACKET.sub('?', component)
+    return pattern.replace('[', '?').replace('\\', '?')
+
+
+def glob(tree, pattern, attr_filter=None, count=1000, batch_size=1000):
+    """Yield the (path, uid) of the nodes matching pattern. See
+    RedisTreeCore.glob."""
+
+    components = tree.split_path(pattern)
+    if components and components[-1] == '**':
+        components.append('*')
+    literal = []
+    while components and not has_magic(components[0]):
+        literal.append(components.pop(0))
+
+    path = '/' + '/'.join(literal)
+    try:
+        real, uid = tree.real_node(path, full=bool(components))
+    except BrokenPath:
+        return
+    if components:
+        matches = _match(tree, [(path, real, uid)], components, count,
+                         batch_size)
+    else:
+        matches = iter([(path, real, uid)])
+    for result in _filter(tree, matches, attr_filter, batch_size):
+        yield result
+
+
+def find(tree, path, name='*', attr_filter=None, count=1000,
+         batch_size=1000):
+    """Yield the (path, uid) of the nodes below path whose name matches
+    name. See RedisTreeCore.find."""
+
+    try:
+        real, uid = tree.real_node(path, full=True)
+    except BrokenPath:
+        return
+    matches = _match(tree, [(path, real, uid)], ['**', name], count,
+                     batch_size)
+    for result in _filter(tree, matches, attr_filter, batch_size):
+        yield result
+
+
+def _match(tree, level, components, count, batch_size):
+    """Yield the (path, real path, uid) of the nodes matching components
+    below the directories of level."""
+
+    while True:
+        recursive = components[0] == '**'
+        while components[0] == '**':
+            components = components[1:]
+        component, components = components[0], components[1:]
+
+        if recursive:
+            matches = _descendants(tree, level, component, count, batch_size)
+        else:
+            matches = _children(tree, level, component, count, batch_size)
+        if not components:
+            for match in matches:
+                yield match
+            return
+
+        level = _follow_links(tree, list(matches), batch_size)
+        if not level:
+            return
+
+
+def _children(tree, level, component, count, batch_size):
+    """Yield the children of the directories of level matching component."""
+
+    if not has_magic(component):
+        for i in range(0, len(level), batch_size):
+            batch = level[i:i + batch_size]
+            pipe = tree.r.pipeline(transaction=False)
+            for _, real, uid in batch:
+                pipe.hget(tree.tree_key(real, uid), component)
+            for (path, real, _), uid in zip(batch, pipe.execute()):
+                if uid is not None:
+                    yield (posixpath.join(path, component),
+                           posixpath.join(real, component), uid)
+        return
+
+    for (path, real, _), name, uid in _scan(tree, level,
+                                            scan_pattern(component), count,
+                                            batch_size):
+        if fnmatchcase(name, component):
+            yield posixpath.join(path, name), posixpath.join(real, name), uid
+
+
+def _descendants(tree, level, component, count, batch_size):
+    """Yield the descendants of the directories of level matching
+    component, level by level."""
+
+    while level:
+        next_level = []
+        for (path, real, _), name, uid in _scan(tree, level, None, count,
+                                                batch_size):
+            child = (posixpath.join(path, name), posixpath.join(real, name),
+                     uid)
+            next_level.append(child)
+            if fnmatchcase(name, component):
+                yield child
+        level = next_level
+
+
+def _scan(tree, level, match, count, batch_size):
+    """Yield the (directory, name, uid) of the children of the directories of
+    level (and whose name matches the HSCAN MATCH pattern match), reading
+    pages of about count entries from batch_size directories at a time."""
+
+    for i in range(0, len(level), batch_size):
+        cursors = [(directory, 0) for directory in level[i:i + batch_size]]
+        while cursors:
+            pipe = tree.r.pipeline(transaction=False)
+            for (_, real, uid), cursor in cursors:
+                pipe.hscan(tree.tree_key(real, uid), cursor, match=match,
+                           count=count)
+            next_cursors = []
+            for (directory, _), (cursor, children) in zip(cursors,
+                                                          pipe.execute()):
+                for name, uid in children.items():
+                    yield directory, name, uid
+                if int(cursor):
+                    next_cursors.append((directory, cursor))
+            cursors = next_cursors
+
+
+def _follow_links(tree, nodes, batch_size):
+    """Return the (path, real path, uid) of nodes, with the symlinks replaced
+    by their destination. Dangling symlinks are left out."""
+
+    result = []
+    for i in range(0, len(nodes), batch_size):
+        batch = nodes[i:i + batch_size]
+        pipe = tree.r.pipeline(transaction=False)
+        for _, _, uid in batch:
+            pipe.hmget("NODE:%s" % uid, LINK_FIELDS)
+        for (path, real, uid), fields in zip(batch, pipe.execute()):
+            try:
+                link = link_destination(fields)
+            except BrokenPath:
+                continue
+            if link is not None:
+                real, uid = link
+            result.append((path, real, uid))
+    return result
+
+
+def _filter(tree, matches, attr_filter, batch_size):
+    """Yield the (path, uid) of matches, keeping only the nodes passing
+    attr_filter, whose attributes are read by batches of batch_size."""
+
+    while True:
+        batch = list(islice(matches, batch_size))
+        if not batch:
+            return
+        if attr_filter is None:
+            for path, _, uid in batch:
+                yield path, uid
+            continue
+
+        fields = list(attr_filter)
+        infos = tree.get_nodes_info([uid for _, _, uid in batch], fields,
+                                    batch_size)
+        for (path, _, uid), info in zip(batch, infos):
+            if all(_accept(info.get(field), attr_filter[field])
+                   for field in fields):
+                yield path, uid
+
+
+def _accept(value, expected):
+    if value is None:
+        return False
+    if callable(expected):
+        return bool(expected(value))
+    return value == str(expected)
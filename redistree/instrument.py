@@ -0,0 +1,227 @@
+import functools
+import math
+import threading
+from time import time
+
+import redis
+
+
+# The measures recorded for every operation.
+METRICS = ['commands', 'pipelines', 'bytes_sent', 'bytes_received',
+           'wall_time', 'redis_time']
+
+
+class Instrumentation(object):
+    """
+    Measure the public operations of a RedisTreeCore. Give it as the
+    instrumentation argument of the tree.
+
+    For every operation (create_child_node, delete_node, ...), the number of
+    commands sent to Redis, the number of pipelines among them, the size of
+    their arguments and replies, the total time spent in the operation and
+    the part of it spent waiting for Redis are recorded in one Histogram per
+    operation and metric. If a callback is given, it is also called with the
+    name of the operation and a dict of these measures, to export them.
+
+    Operations called by another operation are accounted to the outermost
+    one. Commands sent outside of any operation (by a TreeWalker being
+    iterated, for example) are not recorded.
+    """
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self._local = threading.local()
+
+    def current(self):
+        """Return the measures of the operation running in this thread, or
+        None."""
+        return getattr(self._local, 'stats', None)
+
+    def run(self, operation, func, *args, **kwargs):
+        """Call func as the given operation and record its measures."""
+        if self.current() is not None:
+            return func(*args, **kwargs)
+
+        stats = dict.fromkeys(METRICS, 0)
+        self._local.stats = stats
+        start = time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            stats['wall_time'] = time() - start
+            self._local.stats = None
+            self.record(operation, stats)
+
+    def record(self, operation, stats):
+        """Add the measures of a call to the histograms of operation."""
+        with self.lock:
+            histograms = self.histograms.get(operation)
+            if histograms is None:
+                histograms = self.histograms[operation] = dict(
+                    (metric, Histogram()) for metric in METRICS)
+            for metric in METRICS:
+                histograms[metric].add(stats[metric])
+        if self.callback is not None:
+            self.callback(operation, stats)
+
+    def summary(self):
+        """Return {operation: {metric: Histogram.summary()}}."""
+        with self.lock:
+            return dict((operation, dict((metric, h.summary())
+                                         for metric, h in histograms.items()))
+                        for operation, histograms in self.histograms.items())
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+
+
+class Histogram(object):
+    """A histogram of positive values, with one bucket per power of two, so
+    percentiles are only known within a factor of two."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        # Exponent -> number of values v with 2 ** (e - 1) <= v < 2 ** e. Zero
+        # values have their own bucket, None.
+        self.buckets = {}
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        bucket = value > 0 and math.frexp(value)[1] or None
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def percentile(self, p):
+        """Return an upper bound of the p-th percentile (0 < p <= 100)."""
+        if not self.count:
+            return None
+        rank = self.count * p / 100.0
+        seen = self.buckets.get(None, 0)
+        if seen >= rank:
+            return 0
+        for bucket in sorted(b for b in self.buckets if b is not None):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(2.0 ** bucket, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.count and self.total / float(self.count) or 0,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+        }
+
+
+def instrumented(method):
+    """Decorate a method of RedisTreeCore to record it as an operation when
+    the tree has an instrumentation, and to route its commands when the tree
+    has replicas (see redistree.replica.ReplicatedRedis). Otherwise, only
+    costs two attribute lookups."""
+
+    operation = method.__name__
+
+    def measured(self, *args, **kwargs):
+        if self.instrumentation is None:
+            return method(self, *args, **kwargs)
+        return self.instrumentation.run(operation, method, self, *args,
+                                         **kwargs)
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.replicas:
+            return self.r.run(operation, measured, self, *args, **kwargs)
+        return measured(self, *args, **kwargs)
+    return wrapper
+
+
+def payload_size(value):
+    """Return the number of bytes of the strings making a command or a
+    reply."""
+    if value is None:
+        return 0
+    if isinstance(value, dict):
+        return sum(payload_size(k) + payload_size(v)
+                   for k, v in value.items())
+    if isinstance(value, (list, tuple, set)):
+        return sum(payload_size(v) for v in value)
+    if isinstance(value, bytes):
+        return len(value)
+    return len(str(value))
+
+
+class InstrumentedRedis(redis.Redis):
+    """A client adding the commands it sends to the operation running in its
+    thread, if any."""
+
+    def __init__(self, instrumentation, **kwargs):
+        super(InstrumentedRedis, self).__init__(**kwargs)
+        self.instrumentation = instrumentation
+
+    def execute_command(self, *args, **options):
+        stats = self.instrumentation.current()
+        if stats is None:
+            return super(InstrumentedRedis, self).execute_command(*args,
+                                                                  **options)
+        start = time()
+        result = super(InstrumentedRedis, self).execute_command(*args,
+                                                                **options)
+        stats['redis_time'] += time() - start
+        stats['commands'] += 1
+        stats['bytes_sent'] += payload_size(args)
+        stats['bytes_received'] += payload_size(result)
+        return result
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        pipe = InstrumentedPipeline(self.connection_pool,
+                                    self.response_callbacks, transaction,
+                                    shard_hint)
+        pipe.instrumentation = self.instrumentation
+        return pipe
+
+
+class InstrumentedPipeline(redis.client.Pipeline):
+    """The pipelines of InstrumentedRedis."""
+
+    def immediate_execute_command(self, *args, **options):
+        # Commands sent right away, after a WATCH.
+        stats = self.instrumentation.current()
+        if stats is None:
+            return super(InstrumentedPipeline, self).immediate_execute_command(
+                *args, **options)
+        start = time()
+        result = super(InstrumentedPipeline, self).immediate_execute_command(
+            *args, **options)
+        stats['redis_time'] += time() - start
+        stats['commands'] += 1
+        stats['bytes_sent'] += payload_size(args)
+        stats['bytes_received'] += payload_size(result)
+        return result
+
+    def execute(self, *args, **kwargs):
+        stats = self.instrumentation.current()
+        if stats is None or not self.command_stack:
+            return super(InstrumentedPipeline, self).execute(*args, **kwargs)
+        commands = len(self.command_stack)
+        sent = sum(payload_size(c[0]) for c in self.command_stack)
+        start = time()
+        result = super(InstrumentedPipeline, self).execute(*args, **kwargs)
+        stats['redis_time'] += time() - start
+        stats['commands'] += commands
+        stats['pipelines'] += 1
+        stats['bytes_sent'] += sent
+        stats['bytes_received'] += payload_size(result)
+        return result
@@ -0,0 +1,81 @@
+import itertools
+import threading
+from time import time
+
+import redis
+
+
+# The public operations of RedisTreeCore which never modify the tree.
+READ_OPERATIONS = frozenset([
+    'real_node', 'get_node_at_path', 'get_real_path', 'resolve_many',
+    'get_node_info', 'get_nodes_info', 'listdir_with_info', 'get_children',
+    'get_target', 'is_symlink', 'path_index_size', 'du', 'export_subtree',
+    'get_snapshots',
+])
+
+
+class ReplicatedRedis(redis.Redis):
+    """
+    A client sending the commands of the read-only operations of
+    RedisTreeCore (READ_OPERATIONS) to replicas, in turn, and every other
+    command to the primary.
+
+    The routing is decided when an operation starts (see run), for all the
+    commands it sends, including the ones of the operations it calls: the
+    reads done by a mutation always see the primary. Commands sent outside
+    of any operation (by a TreeWalker being iterated, for example) go to the
+    primary.
+
+    Replication is asynchronous, so a replica may not have the last writes
+    yet. For read_your_writes seconds after one of its mutations, the reads
+    of this client stay on the primary. A read operation failing to reach
+    its replica is retried on the primary.
+    """
+
+    def __init__(self, primary, replicas, read_your_writes=1.0):
+        super(ReplicatedRedis, self).__init__(
+            connection_pool=primary.connection_pool)
+        self.primary = primary
+        self.replicas = replicas
+        self.read_your_writes = read_your_writes
+        self.last_write = None
+        self._next_replica = itertools.count()
+        self._local = threading.local()
+
+    def current(self):
+        """Return the client the commands of this thread go to."""
+        return getattr(self._local, 'client', None) or self.primary
+
+    def pick(self, operation):
+        """Return the client for a new operation."""
+        if operation not in READ_OPERATIONS:
+            return self.primary
+        if (self.last_write is not None and
+                time() - self.last_write < self.read_your_writes):
+            return self.primary
+        return self.replicas[next(self._next_replica) % len(self.replicas)]
+
+    def run(self, operation, func, *args, **kwargs):
+        """Call func as the given operation, with its commands routed."""
+        if getattr(self._local, 'client', None) is not None:
+            return func(*args, **kwargs)
+
+        client = self._local.client = self.pick(operation)
+        try:
+            try:
+                return func(*args, **kwargs)
+            except redis.ConnectionError:
+                if client is self.primary:
+                    raise
+                self._local.client = self.primary
+                return func(*args, **kwargs)
+        finally:
+            self._local.client = None
+            if client is self.primary and operation not in READ_OPERATIONS:
+                self.last_write = time()
+
+    def execute_command(self, *args, **options):
+        return self.current().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return self.current().pipeline(transaction, shard_hint)
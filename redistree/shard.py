@@ -0,0 +1,255 @@
+import bisect
+import hashlib
+import itertools
+
+import redis
+
+
+# Every shard allocates uids from its own NODE_COUNTER, starting this far
+# from the counter of the previous shard.
+SHARD_RANGE = 2 ** 58
+
+
+class HashRing(object):
+    """Consistent hashing of key names over a number of shards: adding a
+    shard only moves about 1/n of the keys."""
+
+    def __init__(self, shards, replicas=128):
+        self.points = []
+        self.shards = []
+        for shard in range(shards):
+            for replica in range(replicas):
+                self.points.append(self.hash('%d:%d' % (shard, replica)))
+                self.shards.append(shard)
+        order = sorted(range(len(self.points)), key=self.points.__getitem__)
+        self.points = [self.points[i] for i in order]
+        self.shards = [self.shards[i] for i in order]
+
+    def hash(self, key):
+        if not isinstance(key, bytes):
+            key = key.encode('utf-8')
+        return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+    def get(self, key):
+        """Return the index of the shard holding key."""
+        i = bisect.bisect(self.points, self.hash(key)) % len(self.points)
+        return self.shards[i]
+
+
+class ShardedRedis(redis.Redis):
+    """
+    A client spreading the keys over several Redis clients, for
+    RedisTreeCore. Each key lives on the shard picked by a HashRing, so the
+    NODE hashes are spread by uid and the TREE hashes by path (or uid, with
+    the uid layout).
+
+    Commands on several keys (DEL, UNLINK, EXISTS, KEYS, FLUSHDB) are split
+    over the shards, and RENAME copies the key with DUMP and RESTORE when the
+    new name lives on another shard. Pub/sub goes through the first shard.
+    Lua scripts are refused, so the tree resolves paths client side.
+
+    Each shard has its own NODE_COUNTER, starting SHARD_RANGE after the one of
+    the previous shard, and uids are allocated from the shards in turn.
+
+    Transactions only hold within a shard: a pipeline is executed as one
+    MULTI/EXEC per shard involved.
+    """
+
+    COUNTER = 'NODE_COUNTER'
+
+    def __init__(self, clients):
+        super(ShardedRedis, self).__init__(
+            connection_pool=clients[0].connection_pool)
+        self.clients = clients
+        self.ring = HashRing(len(clients))
+        self._next_counter = itertools.count()
+
+    def shard(self, key):
+        return self.ring.get(key)
+
+    def execute_command(self, *args, **options):
+        command = args[0].upper()
+        if command == 'RENAME':
+            return self.rename_across(*args[1:])
+        parts, merge = self.split(args)
+        return merge([self.clients[shard].execute_command(*part, **options)
+                      for shard, part in parts])
+
+    def split(self, args):
+        """Return the (shard, args) commands to send for the command args,
+        and a function merging their replies."""
+
+        command = args[0].upper()
+        if command in ('SCRIPT', 'EVAL', 'EVALSHA'):
+            raise redis.ResponseError(
+                "unknown command '%s' on a sharded tree" % args[0])
+        if command in ('KEYS', 'FLUSHDB', 'DBSIZE'):
+            return ([(shard, args) for shard in range(len(self.clients))],
+                    MERGES[command])
+        if command == 'PUBLISH':
+            return [(0, args)], first
+        if command == 'MEMORY':
+            return [(self.shard(args[2]), args)], first
+        if command == 'XREAD':
+            key = args[list(args).index('STREAMS') + 1]
+            return [(self.shard(key), args)], first
+        if command in ('DEL', 'UNLINK', 'EXISTS'):
+            keys = {}
+            for key in args[1:]:
+                keys.setdefault(self.shard(key), []).append(key)
+            return ([(shard, (args[0],) + tuple(k))
+                     for shard, k in sorted(keys.items())], sum)
+
+        if len(args) > 1 and args[1] == self.COUNTER:
+            if command in ('INCR', 'INCRBY'):
+                shard = next(self._next_counter) % len(self.clients)
+                return [(shard, args)], first
+            if command == 'SETNX':
+                return ([(shard, (args[0], args[1],
+                                  int(args[2]) + shard * SHARD_RANGE))
+                         for shard in range(len(self.clients))], first)
+
+        return [(self.shard(args[1]), args)], first
+
+    def rename_across(self, src, dst):
+        source, dest = self.shard(src), self.shard(dst)
+        if source == dest:
+            return self.clients[source].rename(src, dst)
+
+        pipe = self.clients[source].pipeline(transaction=False)
+        pipe.dump(src)
+        pipe.pttl(src)
+        value, ttl = pipe.execute()
+        if value is None:
+            raise redis.ResponseError('no such key')
+        self.clients[dest].execute_command('RESTORE', dst, max(ttl, 0), value,
+                                           'REPLACE')
+        self.clients[source].delete(src)
+        return True
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return ShardedPipeline(self, transaction)
+
+    def pubsub(self, **kwargs):
+        return self.clients[0].pubsub(**kwargs)
+
+
+def first(replies):
+    return replies[0]
+
+
+def concatenate(replies):
+    return list(itertools.chain(*replies))
+
+
+MERGES = {'KEYS': concatenate, 'FLUSHDB': all, 'DBSIZE': sum}
+
+
+class ShardedPipeline(redis.Redis):
+    """The pipelines of ShardedRedis: the queued commands are grouped by
+    shard and sent as one pipeline per shard, then the replies are put back
+    in order."""
+
+    def __init__(self, sharded, transaction=True):
+        self.sharded = sharded
+        self.transaction = transaction
+        self.response_callbacks = sharded.response_callbacks
+        self.command_stack = []
+        # Shard -> pipeline, for the shards having keys under WATCH.
+        self.watching = {}
+        self.explicit_transaction = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.reset()
+
+    def __len__(self):
+        return len(self.command_stack)
+
+    def watch(self, *keys):
+        for key in keys:
+            shard = self.sharded.shard(key)
+            pipe = self.watching.get(shard)
+            if pipe is None:
+                pipe = self.watching[shard] = \
+                    self.sharded.clients[shard].pipeline(self.transaction)
+            pipe.watch(key)
+        return True
+
+    def multi(self):
+        self.explicit_transaction = True
+
+    def execute_command(self, *args, **options):
+        if self.watching and not self.explicit_transaction:
+            # Like a redis-py pipeline, run commands at once until multi().
+            if args[0].upper() == 'RENAME':
+                return self.sharded.rename_across(*args[1:])
+            parts, merge = self.sharded.split(args)
+            return merge([self._client(shard).execute_command(*part,
+                                                              **options)
+                          for shard, part in parts])
+        self.command_stack.append((args, options))
+        return self
+
+    def _client(self, shard):
+        pipe = self.watching.get(shard)
+        if pipe is None:
+            return self.sharded.clients[shard]
+        return pipe
+
+    def execute(self, raise_on_error=True):
+        stack, self.command_stack = self.command_stack, []
+
+        # Shard -> [(index in stack, args, options)]
+        groups = {}
+        merges = []
+        renames = []
+        for i, (args, options) in enumerate(stack):
+            if args[0].upper() == 'RENAME' and \
+                    self.sharded.shard(args[1]) != self.sharded.shard(args[2]):
+                renames.append(i)
+                merges.append(None)
+                continue
+            parts, merge = self.sharded.split(args)
+            merges.append(merge)
+            for shard, part in parts:
+                groups.setdefault(shard, []).append((i, part, options))
+
+        # Watched shards go first, so that a WatchError aborts the whole
+        # pipeline before anything is written. The ones without commands
+        # still run a transaction, for their keys to be checked, before the
+        # others: only a WatchError on a second watched shard having commands
+        # leaves the ones of the first written.
+        for shard in self.watching:
+            groups.setdefault(shard, [])
+        replies = [[] for _ in stack]
+        shards = sorted(groups, key=lambda s: (s not in self.watching,
+                                               bool(groups[s]), s))
+        for shard in shards:
+            pipe = self.watching.pop(shard, None)
+            if pipe is not None:
+                pipe.multi()
+            else:
+                pipe = self.sharded.clients[shard].pipeline(self.transaction)
+            for i, part, options in groups[shard]:
+                pipe.execute_command(*part, **options)
+            if not groups[shard]:
+                pipe.execute_command('PING')
+            for (i, _, _), reply in zip(groups[shard],
+                                        pipe.execute(raise_on_error)):
+                replies[i].append(reply)
+
+        for i in renames:
+            replies[i].append(self.sharded.rename_across(*stack[i][0][1:]))
+        self.reset()
+
+        return [merge is None and True or merge(parts)
+                for merge, parts in zip(merges, replies)]
+
+    def reset(self):
+        for pipe in self.watching.values():
+            pipe.reset()
+        self.watching = {}
+        self.explicit_transaction = False
@@ -0,0 +1,155 @@
+import posixpath
+
+from redistree.core import LINK_FIELDS, BrokenPath, link_destination
+
+
+class TreeWalker(object):
+    """
+    Iterate over a subtree, like os.walk, without ever holding a whole
+    directory in memory.
+
+    Every directory is read with HSCAN, by pages of about count entries, and
+    every page is yielded as a (dirpath, entries) tuple, so a directory can be
+    yielded several times. entries is a list of (name, uid) tuples, or of
+    (name, uid, attributes) tuples with with_info=True.
+
+    Each page is followed by a single pipeline fetching, for all its entries,
+    whether they have children (HLEN), their attributes and their link
+    targets when needed, and the first page of the small child directories.
+    Memory use is bounded by count times the depth of the tree.
+
+    position is a JSON serializable snapshot of the walk, which can be given
+    back to resume it (HSCAN may then repeat a few entries).
+    """
+
+    def __init__(self, tree, path, topdown=True, follow_symlinks=False,
+                 with_info=False, count=1000, position=None):
+        self.tree = tree
+        self.topdown = topdown
+        self.follow_symlinks = follow_symlinks
+        self.with_info = with_info
+        self.count = count
+
+        if position is not None:
+            self.stack = [_Frame(*frame) for frame in position]
+        else:
+            real, uid = tree.real_node(path, full=True)
+            self.stack = [_Frame(path, real, uid)]
+
+    @property
+    def position(self):
+        return [frame.dump() for frame in self.stack]
+
+    def __iter__(self):
+        stack = self.stack
+        while stack:
+            frame = stack[-1]
+
+            if frame.pending:
+                name, uid, real = frame.pending.pop(0)
+                stack.append(frame.prefetched.pop(uid, None) or
+                             _Frame(posixpath.join(frame.path, name), real, uid))
+                continue
+
+            if frame.page is not None:
+                page, frame.page = frame.page, None
+                yield frame.path, page
+                continue
+
+            if frame.cursor is None:
+                stack.pop()
+                continue
+
+            if frame.first_page is not None:
+                cursor, children = frame.first_page
+                frame.first_page = None
+            else:
+                cursor, children = self.tree.r.hscan(
+                    self.tree.tree_key(frame.real, frame.uid), frame.cursor,
+                    count=self.count)
+            frame.cursor = cursor and str(cursor) or None
+
+            entries, frame.pending = self.expand(frame, children.items())
+            if self.topdown:
+                yield frame.path, entries
+            else:
+                frame.page = entries
+
+    def expand(self, frame, children):
+        """Fetch what is needed about a page of children in one pipeline.
+        Return the entries to yield and the (name, uid, real path) of the
+        children to walk into."""
+
+        pipe = self.tree.r.pipeline(transaction=False)
+        for name, uid in children:
+            pipe.hlen(self.tree.tree_key(posixpath.join(frame.real, name), uid))
+            if self.follow_symlinks:
+                pipe.hmget("NODE:%s" % uid, LINK_FIELDS)
+            if self.with_info:
+                self.tree.read_node(pipe, uid)
+        res = iter(pipe.execute())
+
+        entries = []
+        pending = []
+        for name, uid in children:
+            real = posixpath.join(frame.real, name)
+            size = next(res)
+            if self.follow_symlinks:
+                try:
+                    link = link_destination(next(res))
+                except BrokenPath:
+                    link = None
+                ancestors = [f.uid for f in self.stack]
+                if link is not None and link[1] not in ancestors:
+                    real, uid = link
+                    size = self.tree.r.hlen(self.tree.tree_key(real, uid))
+            if self.with_info:
+                entries.append((name, uid, self.tree.decode_node(res)))
+            else:
+                entries.append((name, uid))
+            if size:
+                pending.append((name, uid, real, size))
+
+        # Read the first page of the small child directories together.
+        frame.prefetched = {}
+        budget = self.count
+        small = []
+        for name, uid, real, size in pending:
+            if size <= budget:
+                budget -= size
+                small.append((name, uid, real))
+        if small:
+            pipe = self.tree.r.pipeline(transaction=False)
+            for name, uid, real in small:
+                pipe.hscan(self.tree.tree_key(real, uid), 0, count=self.count)
+            for (name, uid, real), page in zip(small, pipe.execute()):
+                child = _Frame(posixpath.join(frame.path, name), real, uid)
+                child.first_page = page
+                frame.prefetched[uid] = child
+
+        return entries, [(name, uid, real) for name, uid, real, _ in pending]
+
+
+class _Frame(object):
+    """A directory being walked by TreeWalker."""
+
+    __slots__ = ['path', 'real', 'uid', 'cursor', 'pending', 'page',
+                 'first_page', 'prefetched']
+
+    def __init__(self, path, real, uid, cursor='0', pending=None, page=None):
+        self.path = path
+        self.real = real
+        self.uid = uid
+        self.cursor = cursor
+        self.pending = pending or []
+        self.page = page
+
+        # Filled by TreeWalker.expand, and not part of the position: the
+        # first page of this directory, and the frames of the children whose
+        # first page has been read along with this page.
+        self.first_page = None
+        self.prefetched = {}
+
+    def dump(self):
+        return [self.path, self.real, self.uid, self.cursor,
+                [list(p) for p in self.pending], self.page]
@@ -0,0 +1,152 @@
+import sys
+from unittest import TestCase, skipIf
+
+if sys.version_info >= (3, 5):
+    import asyncio
+    from redistree import BrokenPath, NodeExists, codec
+    from redistree.aio import AsyncRedisTree
+
+
+@skipIf(sys.version_info < (3, 5), "asyncio needs Python 3.5+")
+class TestAsyncRedisTree(TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.rt = AsyncRedisTree(max_connections=4)
+        self.wait(self.rt.r.flushdb())
+        self.wait(self.rt.init_fs())
+
+    def tearDown(self):
+        self.wait(self.rt.close())
+        self.loop.close()
+
+    def wait(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def test_create_and_resolve(self):
+        self.wait(self.rt.create_child_node('/foo'))
+        self.wait(self.rt.create_child_node('/foo/bar'))
+        uid = self.wait(self.rt.create_child_node('/foo/bar/bob', {'size': '1'}))
+        self.wait(self.rt.create_symlink('/foo/bar', '/me'))
+
+        self.assertEqual(self.wait(self.rt.get_node_at_path('/me/bob')), uid)
+        self.assertEqual(self.wait(self.rt.get_real_path('/me/bob')),
+                         '/foo/bar/bob')
+        self.assertEqual(self.wait(self.rt.get_node_info(uid)), {'size': '1'})
+        self.assertTrue(self.wait(self.rt.is_symlink('/me')))
+        self.assertEqual(self.wait(self.rt.get_children('/foo/bar')),
+                         {'bob': uid})
+
+    def test_change_feed(self):
+        self.wait(self.rt.r.set('TREE_CHANGEFEED', 1000))
+        self.assertRaises(Exception, self.wait,
+                          self.rt.create_child_node('/foo'))
+
+    def test_concurrent_lookups(self):
+        uids = [self.wait(self.rt.create_child_node('/%d' % i))
+                for i in range(20)]
+        lookups = [self.rt.get_node_at_path('/%d' % (i % 20))
+                   for i in range(500)]
+        res = self.wait(asyncio.gather(*lookups))
+        self.assertEqual(res, [uids[i % 20] for i in range(500)])
+
+    def test_move(self):
+        self.wait(self.rt.create_child_node('/foo'))
+        self.wait(self.rt.create_child_node('/foo/bar'))
+        uid = self.wait(self.rt.create_child_node('/foo/bar/bob'))
+        self.wait(self.rt.move_node('/foo/bar', '/me'))
+        self.assertEqual(self.wait(self.rt.get_node_at_path('/me/bob')), uid)
+        self.assertEqual(self.wait(self.rt.get_children('/foo')), {})
+
+    def test_copy_and_delete(self):
+        self.wait(self.rt.create_child_node('/foo'))
+        for i in range(10):
+            self.wait(self.rt.create_child_node('/foo/%d' % i))
+            self.wait(self.rt.create_child_node('/foo/%d/bar' % i))
+
+        result = self.wait(self.rt.copy_path('/foo', '/me', batch_size=4))
+        self.assertEqual(result.nodes, 21)
+        self.assertTrue(self.wait(self.rt.get_node_at_path('/me/3/bar')))
+
+        self.assertEqual(self.wait(self.rt.delete_node('/me', batch_size=4)), 21)
+        self.assertEqual(self.wait(self.rt.delete_node('/foo')), 21)
+        self.assertEqual(len(self.wait(self.rt.r.keys("NODE:*"))), 1)
+        self.assertEqual(len(self.wait(self.rt.r.keys("TREE:*"))), 0)
+
+    def test_uid_layout(self):
+        self.wait(self.rt.create_child_node('/foo'))
+        self.wait(self.rt.create_child_node('/foo/bar'))
+        uid = self.wait(self.rt.create_child_node('/foo/bar/bob'))
+        self.assertEqual(self.wait(self.rt.migrate_layout('uid')), 3)
+
+        self.wait(self.rt.move_node('/foo/bar', '/bar'))
+        self.assertEqual(self.wait(self.rt.get_node_at_path('/bar/bob')), uid)
+        self.assertEqual(self.wait(self.rt.delete_node('/bar')), 2)
+
+    def test_symlink_move_and_delete(self):
+        self.wait(self.rt.create_child_node('/foo'))
+        self.wait(self.rt.create_child_node('/foo/bar'))
+        uid = self.wait(self.rt.create_child_node('/foo/bar/bob'))
+        self.wait(self.rt.create_symlink('/foo', '/a'))
+        link = self.wait(self.rt.create_symlink('/a/bar', '/me'))
+
+        self.wait(self.rt.move_node('/foo', '/other'))
+        info = self.wait(self.rt.get_node_info(link))
+        self.assertEqual(info['final_target'], '/other/bar')
+        self.assertEqual(self.wait(self.rt.get_node_at_path('/me/bob')), uid)
+
+        self.wait(self.rt.delete_node('/other'))
+        self.assertEqual(self.wait(self.rt.get_node_info(link))['dangling'], '1')
+        self.assertFalse(self.wait(self.rt.has_links()))
+
+    def test_delete_chained_link(self):
+        self.wait(self.rt.create_child_node('/d'))
+        self.wait(self.rt.create_child_node('/d/bob'))
+        b = self.wait(self.rt.create_symlink('/d', '/b'))
+        a = self.wait(self.rt.create_symlink('/b', '/a'))
+        self.wait(self.rt.delete_node('/b'))
+        self.assertEqual(self.wait(self.rt.get_node_info(a))['dangling'], '1')
+        self.assertRaises(BrokenPath, self.wait,
+                          self.rt.get_node_at_path('/a/bob'))
+        self.assertFalse(self.wait(self.rt.r.exists("CHAINS:%s" % b)))
+
+    def test_exclusive(self):
+        for use_scripts in (True, False):
+            self.rt.use_scripts = use_scripts
+            path = '/foo%s' % use_scripts
+            uid = self.wait(self.rt.create_child_node(path, exclusive=True))
+            with self.assertRaises(NodeExists):
+                self.wait(self.rt.create_child_node(path, exclusive=True))
+            self.assertEqual(self.wait(self.rt.get_node_at_path(path)), uid)
+            with self.assertRaises(BrokenPath):
+                self.wait(self.rt.create_child_node(path + '/a/b'))
+
+    def test_listdir_with_info(self):
+        self.wait(self.rt.create_child_node('/foo'))
+        uid = self.wait(self.rt.create_child_node('/foo/bar',
+                                                  {'size': '1', 'blob': 'x'}))
+        self.assertEqual(self.wait(self.rt.get_node_info(uid, ['size'])),
+                         {'size': '1'})
+        self.assertEqual(self.wait(self.rt.listdir_with_info('/foo', ['size'])),
+                         {'bar': (uid, {'size': '1'})})
+
+    def test_packed_codec(self):
+        self.wait(self.rt.r.set('TREE_CODEC', 'packed'))
+        self.rt._node_codec = None
+        self.wait(self.rt.create_child_node('/foo'))
+        uid = self.wait(self.rt.create_child_node('/foo/bar', {'size': '1'}))
+        # Move the attributes to the bucket, like RedisTree would store them.
+        key, field = codec.bucket(uid)
+        self.wait(self.rt.r.delete("NODE:%s" % uid))
+        self.wait(self.rt.r.hset(key, field, codec.pack({'size': '1'})))
+
+        self.assertEqual(self.wait(self.rt.get_node_info(uid)), {'size': '1'})
+        self.rt.use_scripts = False
+        self.wait(self.rt.create_child_node('/foo/bar/bob'))
+        self.assertEqual(self.wait(self.rt.copy_path('/foo', '/me')).nodes, 3)
+        self.assertEqual(self.wait(self.rt.listdir_with_info('/me')),
+                         {'bar': (self.wait(self.rt.get_node_at_path(
+                             '/me/bar')), {'size': '1'})})
+        self.assertEqual(self.wait(self.rt.delete_node('/foo')), 3)
+        self.assertFalse(self.wait(self.rt.r.hexists(key, field)))
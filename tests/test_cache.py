@@ -0,0 +1,234 @@
+from time import time, sleep
+from unittest import TestCase
+from redistree import RedisTree, BrokenPath
+from redistree.cache import PathCache, TreeCache
+import tests.test_core as core
+
+
+class TestPathCache(TestCase):
+
+    def test_lru(self):
+        cache = PathCache(max_size=2)
+        cache.set('/a', False, '/a', '1')
+        cache.set('/b', False, '/b', '2')
+        cache.get('/a', False)
+        cache.set('/c', False, '/c', '3')
+        self.assertEqual(cache.get('/a', False), ('/a', '1'))
+        self.assertEqual(cache.get('/b', False), None)
+        self.assertEqual(cache.stats()['hits'], 2)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_ttl(self):
+        cache = PathCache(ttl=0.01)
+        cache.set('/a', False, '/a', '1')
+        sleep(0.02)
+        self.assertEqual(cache.get('/a', False), None)
+
+    def test_invalidate_prefix(self):
+        cache = PathCache()
+        cache.set('/a', False, '/a', '1')
+        cache.set('/a/b', False, '/a/b', '2')
+        cache.set('/ab', False, '/ab', '3')
+        cache.set('/me', True, '/a/b', '2')
+        cache.set('/x/link/y', False, '/z/y', '4')
+        cache.invalidate('/a/')
+        self.assertEqual(cache.get('/a', False), None)
+        self.assertEqual(cache.get('/a/b', False), None)
+        self.assertEqual(cache.get('/me', True), None)
+        self.assertEqual(cache.get('/x/link/y', False), None)
+        self.assertEqual(cache.get('/ab', False), ('/ab', '3'))
+
+
+class TestCachedTree(TestCase):
+
+    def setUp(self):
+        self.rt = RedisTree(path_cache=PathCache(), publish_invalidations=True)
+        self.rt.r.flushdb()
+        self.rt.init_fs()
+        self.rt.create_child_node('/foo')
+        self.rt.create_child_node('/foo/bar')
+        self.bob = self.rt.create_child_node('/foo/bar/bob')
+
+    def test_hit(self):
+        self.rt.get_node_at_path('/foo/bar/bob')
+        self.assertEqual(self.rt.get_node_at_path('/foo/bar/bob'), self.bob)
+        self.assertEqual(self.rt.path_cache.hits, 1)
+
+    def test_move(self):
+        self.rt.get_node_at_path('/foo/bar/bob')
+        self.rt.move_node('/foo/bar/bob', '/foo/alice')
+        self.assertRaises(Exception, self.rt.get_node_at_path, '/foo/bar/bob')
+        self.assertEqual(self.rt.get_node_at_path('/foo/alice'), self.bob)
+
+    def test_delete(self):
+        self.rt.get_node_at_path('/foo/bar/bob')
+        self.rt.delete_node('/foo/bar')
+        self.assertRaises(Exception, self.rt.get_node_at_path, '/foo/bar/bob')
+
+    def test_symlink(self):
+        self.rt.create_symlink('/foo/bar', '/me')
+        self.assertEqual(self.rt.get_node_at_path('/me/bob'), self.bob)
+        self.rt.delete_node('/foo/bar/bob')
+        self.assertRaises(Exception, self.rt.get_node_at_path, '/me/bob')
+
+    def test_create_through_symlink(self):
+        self.rt.create_symlink('/foo/bar', '/link')
+        self.assertEqual(self.rt.get_node_at_path('/foo/bar/bob'), self.bob)
+        pubsub = self.rt.r.pubsub()
+        pubsub.subscribe(self.rt.INVALIDATION_CHANNEL)
+        pubsub.get_message(timeout=1)
+
+        uid = self.rt.create_child_node('/link/bob')
+        self.assertNotEqual(uid, self.bob)
+        self.assertEqual(self.rt.get_node_at_path('/foo/bar/bob'), uid)
+        self.assertEqual(pubsub.get_message(timeout=1)['data'],
+                         '/foo/bar/bob')
+        pubsub.close()
+
+    def test_create_through_symlink_no_scripts(self):
+        self.rt.use_scripts = False
+        self.test_create_through_symlink()
+
+    def test_create_many_through_symlink(self):
+        self.rt.create_symlink('/foo/bar', '/link')
+        self.assertEqual(self.rt.get_node_at_path('/foo/bar/bob'), self.bob)
+        uid, = self.rt.create_many([('/link/bob', None)])
+        self.assertEqual(self.rt.get_node_at_path('/foo/bar/bob'), uid)
+
+    def test_move_through_symlink(self):
+        self.rt.r.flushdb()
+        self.rt.path_cache.clear()
+        self.rt.init_fs(layout='uid')
+        self.rt.create_child_node('/real')
+        uid = self.rt.create_child_node('/real/a')
+        self.rt.create_child_node('/b')
+        self.rt.create_symlink('/real', '/link')
+        self.assertEqual(self.rt.get_node_at_path('/real/a'), uid)
+
+        self.rt.move_node('/link/a', '/b/a')
+        self.assertRaises(BrokenPath, self.rt.get_node_at_path, '/real/a')
+        self.assertEqual(self.rt.get_node_at_path('/b/a'), uid)
+
+    def test_copy_through_symlink(self):
+        self.rt.create_symlink('/foo', '/link')
+        old = self.rt.create_child_node('/foo/copy')
+        self.assertEqual(self.rt.get_node_at_path('/foo/copy'), old)
+        self.rt.copy_path('/foo/bar', '/link/copy')
+        self.assertNotEqual(self.rt.get_node_at_path('/foo/copy'), old)
+
+    def test_other_client(self):
+        other = RedisTree(path_cache=PathCache())
+        other.path_cache.listen(other.r)
+        deadline = time() + 2
+        while time() < deadline:
+            channels = other.r.execute_command('PUBSUB', 'NUMSUB',
+                                               'TREE_INVALIDATE')
+            if int(channels[1]) > 0:
+                break
+            sleep(0.01)
+
+        self.assertEqual(other.get_node_at_path('/foo/bar/bob'), self.bob)
+        self.rt.delete_node('/foo/bar/bob')
+        while time() < deadline and len(other.path_cache):
+            sleep(0.01)
+        other.path_cache.stop_listening()
+        self.assertRaises(Exception, other.get_node_at_path, '/foo/bar/bob')
+
+
+class TestTreeCache(TestCase):
+
+    def setUp(self):
+        self.rt = RedisTree(tree_cache=TreeCache())
+        self.cache = self.rt.tree_cache
+        self.rt.r.flushdb()
+        self.rt.init_fs()
+        self.rt.create_child_node('/foo')
+        self.bob = self.rt.create_child_node('/foo/bob', {'size': '1'})
+        self.other = RedisTree()
+
+    def tearDown(self):
+        self.cache.stop()
+
+    def wait_invalidation(self, invalidations):
+        deadline = time() + 2
+        while (time() < deadline and
+               self.cache.stats()['invalidations'] == invalidations):
+            sleep(0.01)
+
+    def test_hits(self):
+        self.assertEqual(self.rt.get_node_at_path('/foo/bob'), self.bob)
+        misses = self.cache.stats()['misses']
+        self.assertEqual(self.rt.get_node_at_path('/foo/bob'), self.bob)
+        self.assertEqual(self.rt.get_children('/foo'), {'bob': self.bob})
+        self.assertEqual(self.rt.get_node_info(self.bob), {'size': '1'})
+        self.assertEqual(self.rt.get_node_info(self.bob, ['size', 'x']),
+                         {'size': '1'})
+        # Only the full hashes of /foo and bob had to be read.
+        self.assertEqual(self.cache.stats()['misses'], misses + 2)
+        self.assertEqual(self.cache.stats()['hits'], 5)
+
+    def test_other_client(self):
+        self.rt.get_children('/foo')
+        invalidations = self.cache.stats()['invalidations']
+        alice = self.other.create_child_node('/foo/alice')
+        self.wait_invalidation(invalidations)
+        self.assertEqual(self.rt.get_children('/foo'),
+                         {'bob': self.bob, 'alice': alice})
+
+    def test_read_own_writes(self):
+        self.rt.get_node_at_path('/foo/bob')
+        self.rt.move_node('/foo/bob', '/alice')
+        self.assertRaises(BrokenPath, self.rt.get_node_at_path, '/foo/bob')
+        self.assertEqual(self.rt.get_node_at_path('/alice'), self.bob)
+
+    def test_budget(self):
+        self.cache.max_bytes = 1000
+        for i in range(10):
+            self.rt.create_child_node('/foo/%d' % i)
+        for i in range(10):
+            self.rt.get_node_at_path('/foo/%d' % i)
+        stats = self.cache.stats()
+        self.assertTrue(stats['evictions'] > 0)
+        self.assertTrue(0 < stats['bytes'] <= 1000)
+
+    def test_reconnect(self):
+        self.rt.get_children('/foo')
+        self.other.r.execute_command('CLIENT', 'KILL', 'TYPE', 'pubsub')
+        deadline = time() + 2
+        while time() < deadline and len(self.cache):
+            sleep(0.01)
+        self.assertEqual(len(self.cache), 0)
+        while time() < deadline and self.cache._client is None:
+            sleep(0.01)
+        self.rt.get_children('/foo')
+        self.assertEqual(len(self.cache), 1)
+        alice = self.other.create_child_node('/foo/alice')
+        self.wait_invalidation(self.cache.stats()['invalidations'])
+        self.assertEqual(self.rt.get_children('/foo'),
+                         {'bob': self.bob, 'alice': alice})
+
+
+class TreeCacheCase(object):
+
+    layout = 'path'
+
+    def setUp(self):
+        self.rt = RedisTree(tree_cache=TreeCache())
+        self.rt.r.flushdb()
+        self.rt.init_fs(layout=self.layout)
+
+    def tearDown(self):
+        self.rt.tree_cache.stop()
+
+
+class TestNodesTreeCache(TreeCacheCase, core.TestNodes):
+    pass
+
+
+class TestSymlinksTreeCache(TreeCacheCase, core.TestSymlinks):
+    pass
+
+
+class TestSymlinksUidLayoutTreeCache(TestSymlinksTreeCache):
+
+    layout = 'uid'
@@ -0,0 +1,106 @@
+from unittest import TestCase
+from redistree import RedisTree
+from redistree import codec
+from redistree.walk import TreeWalker
+import tests.test_core as core
+
+
+class TestPack(TestCase):
+
+    def test_roundtrip(self):
+        attributes = {'size': '4096', 'mode': '0644', 'empty': ''}
+        self.assertEqual(codec.unpack(codec.pack(attributes)), attributes)
+        self.assertEqual(codec.unpack(codec.pack({})), {})
+
+    def test_too_large(self):
+        self.assertEqual(codec.pack({'blob': 'x' * codec.MAX_PACKED_SIZE}),
+                         None)
+
+    def test_bucket(self):
+        self.assertEqual(codec.bucket(codec.BUCKET_SIZE * 3 + 5),
+                         ('NODES:3', '5'))
+        self.assertEqual(codec.bucket(-1), ('NODES:-1', '127'))
+
+    def test_decode(self):
+        packed = codec.pack({'size': '1', 'mode': '0644'})
+        replies = iter([['x', None], packed, {}, None])
+        self.assertEqual(codec.decode(replies, ['other', 'foo', 'size'], True),
+                         {'other': 'x', 'size': '1'})
+        self.assertEqual(codec.decode(replies, packed=True), {})
+
+
+class PackedCase(object):
+
+    layout = 'path'
+
+    def setUp(self):
+        self.rt = RedisTree()
+        self.rt.r.flushdb()
+        self.rt.init_fs(layout=self.layout, node_codec='packed')
+
+    def count_nodes(self):
+        # Large attribute sets and links are still stored in NODE hashes.
+        return (len(self.rt.r.keys("NODE:*")) +
+                sum(self.rt.r.hlen(key) for key in self.rt.r.keys("NODES:*")))
+
+
+class TestPackedNodes(PackedCase, core.TestNodes):
+
+    def test_buckets(self):
+        uid = self.rt.create_child_node('/foo', {'size': '1'})
+        self.assertEqual(self.rt.r.keys('NODE:*'), [])
+        self.assertEqual(self.rt.get_node_info(uid), {'size': '1'})
+        self.rt.create_child_node('/blob', {'blob': 'x' * 100})
+        self.assertEqual(len(self.rt.r.keys('NODE:*')), 1)
+
+
+class TestPackedNodesUidLayout(TestPackedNodes):
+
+    layout = 'uid'
+
+
+class TestPackedCreateNoScripts(PackedCase, core.TestCreateNoScripts):
+
+    def setUp(self):
+        PackedCase.setUp(self)
+        self.rt.use_scripts = False
+
+
+class TestPackedNodeInfo(PackedCase, core.TestNodeInfo):
+
+    def setUp(self):
+        PackedCase.setUp(self)
+        self.rt.create_child_node('/foo')
+        self.alice = self.rt.create_child_node(
+            '/foo/alice', {'size': '1', 'mtime': '10', 'blob': 'x' * 1000})
+        self.bob = self.rt.create_child_node('/foo/bob', {'size': '2'})
+
+    def test_get_nodes_info(self):
+        self.assertEqual(
+            self.rt.get_nodes_info([self.alice, self.bob, '1000'], ['size'],
+                                   batch_size=2),
+            [{'size': '1'}, {'size': '2'}, {}])
+        self.assertEqual(self.rt.get_nodes_info([self.bob]), [{'size': '2'}])
+
+    def test_walk_with_info(self):
+        entries = list(TreeWalker(self.rt, '/foo', with_info=True))
+        self.assertEqual(sorted(entries[0][1]), [
+            ('alice', self.alice, {'size': '1', 'mtime': '10',
+                                   'blob': 'x' * 1000}),
+            ('bob', self.bob, {'size': '2'}),
+        ])
+
+
+class TestPackedSymlinks(PackedCase, core.TestSymlinks):
+    pass
+
+
+class TestPackedBatch(PackedCase, core.TestBatch):
+    pass
+
+
+class TestPackedSnapshots(PackedCase, core.TestSnapshots):
+
+    def setUp(self):
+        PackedCase.setUp(self)
+        self.populate()
@@ -1,7 +1,9 @@
+import threading
 from time import time
 from unittest import TestCase
 import redis
-from redistree import RedisTree
+from redistree import RedisTree, BrokenPath, NodeExists, SymlinkLoopError, \
+    SnapshotNotFound, PathCache
 
 
 class TestCreateRedisTree(TestCase):
@@ -31,6 +33,9 @@ class InitRedisTreeCase(TestCase):
         self.rt.r.flushdb()
         self.rt.init_fs()
 
+    def count_nodes(self):
+        return len(self.rt.r.keys("NODE:*"))
+
 class TestNodes(InitRedisTreeCase):
 
     def test_get_root_node_from_path(self):
@@ -148,22 +153,22 @@ class TestNodes(InitRedisTreeCase):
         self.rt.create_child_node('/foo/bar/alice')
         # / /foo /foo/bar
         self.assertEqual(len(self.rt.r.keys("TREE:*")), 3)
-        self.assertEqual(len(self.rt.r.keys("NODE:*")), 5)
+        self.assertEqual(self.count_nodes(), 5)
 
         self.rt.delete_node('/foo/bar')
         # /foo lost its only child, so Redis deletes the key.
         self.assertEqual(len(self.rt.r.keys("TREE:*")), 1)
-        self.assertEqual(len(self.rt.r.keys("NODE:*")), 2)
+        self.assertEqual(self.count_nodes(), 2)
 
         self.assertEqual(self.rt.get_children('/foo'), {})
 
     def test_delete_leaf(self):
         self.rt.create_child_node('/foo')
         self.assertEqual(len(self.rt.r.keys("TREE:*")), 1)
-        self.assertEqual(len(self.rt.r.keys("NODE:*")), 2)
+        self.assertEqual(self.count_nodes(), 2)
         self.rt.delete_node('/foo')
         self.assertEqual(len(self.rt.r.keys("TREE:*")), 0)
-        self.assertEqual(len(self.rt.r.keys("NODE:*")), 1)
+        self.assertEqual(self.count_nodes(), 1)
 
     def test_delete_deep(self):
         n = 100
@@ -175,17 +180,49 @@ class TestNodes(InitRedisTreeCase):
             uid = self.rt.create_child_node(path)
 
         self.assertEqual(len(self.rt.r.keys("TREE:*")), n)
-        self.assertEqual(len(self.rt.r.keys("NODE:*")), n + 1)
+        self.assertEqual(self.count_nodes(), n + 1)
 
         start = time()
         self.rt.delete_node('/foo')
         elapsed = time() - start
 
         self.assertEqual(len(self.rt.r.keys("TREE:*")), 0)
-        self.assertEqual(len(self.rt.r.keys("NODE:*")), 1)
+        self.assertEqual(self.count_nodes(), 1)
 
         self.assertTrue(elapsed < 0.06)
 
+    def test_delete_wide(self):
+        self.rt.create_child_node('/foo')
+        for i in xrange(20):
+            self.rt.create_child_node('/foo/%d' % i)
+            self.rt.create_child_node('/foo/%d/bar' % i)
+
+        self.assertEqual(self.rt.delete_node('/foo', batch_size=7), 41)
+        self.assertEqual(len(self.rt.r.keys("TREE:*")), 0)
+        self.assertEqual(self.count_nodes(), 1)
+
+    def test_delete_very_deep(self):
+        path = ''
+        for i in xrange(1050):
+            path = path + '/f'
+            self.rt.create_child_node(path, resolve=False)
+
+        self.assertEqual(self.rt.delete_node('/f'), 1050)
+        self.assertEqual(self.count_nodes(), 1)
+
+    def test_delete_background(self):
+        self.rt.create_child_node('/foo')
+        self.rt.create_child_node('/foo/bar')
+
+        thread = self.rt.delete_node('/foo', background=True)
+        self.assertRaises(Exception, self.rt.get_node_at_path, '/foo')
+        thread.join()
+        self.assertEqual(len(self.rt.r.keys("TREE:*")), 0)
+        self.assertEqual(self.count_nodes(), 1)
+
+    def test_delete_missing(self):
+        self.assertRaises(BrokenPath, self.rt.delete_node, '/foo')
+
     def test_delete_in_symlink(self):
         self.rt.create_child_node('/foo')
         self.rt.create_child_node('/foo/bar')
@@ -193,12 +230,12 @@ class TestNodes(InitRedisTreeCase):
         self.rt.create_symlink('/foo/bar', '/me')
 
         self.assertEqual(len(self.rt.r.keys("TREE:*")), 3)
-        self.assertEqual(len(self.rt.r.keys("NODE:*")), 5)
+        self.assertEqual(self.count_nodes(), 5)
 
         self.rt.delete_node('/me/bob')
 
         self.assertEqual(len(self.rt.r.keys("TREE:*")), 2)
-        self.assertEqual(len(self.rt.r.keys("NODE:*")), 4)
+        self.assertEqual(self.count_nodes(), 4)
 
 
     def test_real_path(self):
@@ -221,15 +258,423 @@ class TestNodes(InitRedisTreeCase):
         self.rt.create_child_node('/foo/bar/bob')
 
         self.assertEqual(len(self.rt.r.keys("TREE:*")), 3)
-        self.assertEqual(len(self.rt.r.keys("NODE:*")), 5)
+        self.assertEqual(self.count_nodes(), 5)
         self.assertEqual(self.rt.get_children('/foo'), expected)
 
         self.rt.copy_path('/foo', '/me')
 
         self.assertEqual(len(self.rt.r.keys("TREE:*")), 5)
-        self.assertEqual(len(self.rt.r.keys("NODE:*")), 9)
+        self.assertEqual(self.count_nodes(), 9)
         self.assertEqual(self.rt.get_children('/foo'), expected)
 
+    def test_copy_batches(self):
+        self.rt.create_child_node('/foo')
+        for i in xrange(10):
+            self.rt.create_child_node('/foo/%d' % i, {'size': str(i)})
+            self.rt.create_child_node('/foo/%d/bar' % i)
+        self.rt.create_symlink('/foo/1', '/foo/link')
+
+        result = self.rt.copy_path('/foo', '/me', batch_size=3)
+
+        self.assertEqual(result.nodes, 22)
+        self.assertEqual(sorted(self.rt.get_children('/me')),
+                         sorted(self.rt.get_children('/foo')))
+        uid = self.rt.get_node_at_path('/me/7')
+        self.assertNotEqual(uid, self.rt.get_node_at_path('/foo/7'))
+        self.assertEqual(self.rt.get_node_info(uid), {'size': '7'})
+        self.assertTrue(self.rt.get_node_at_path('/me/7/bar'))
+        self.assertEqual(self.rt.get_target('/me/link'), '/foo/1')
+        self.assertEqual(self.count_nodes(), 1 + 22 * 2)
+
+        # Copy into a subdirectory of the source.
+        self.assertEqual(self.rt.copy_path('/me', '/me/again').nodes, 22)
+
+
+
+class TestNodesUidLayout(TestNodes):
+
+    def setUp(self):
+        self.rt = RedisTree()
+        self.rt.r.flushdb()
+        self.rt.init_fs(layout='uid')
+
+    def test_layout(self):
+        self.assertEqual(self.rt.layout, 'uid')
+        foo = self.rt.create_child_node('/foo')
+        self.assertEqual(self.rt.r.keys("TREE:*"), ["TREE:%s" % self.rt.ROOT_NODE])
+        bar = self.rt.create_child_node('/foo/bar')
+        self.assertEqual(self.rt.r.hgetall("TREE:%s" % foo), {'bar': bar})
+
+
+class TestNodesPathIndex(TestNodes):
+
+    def setUp(self):
+        self.rt = RedisTree()
+        self.rt.r.flushdb()
+        self.rt.init_fs(path_index=True)
+
+
+class TestNodesUidLayoutPathIndex(TestNodes):
+
+    def setUp(self):
+        self.rt = RedisTree()
+        self.rt.r.flushdb()
+        self.rt.init_fs(layout='uid', path_index=True)
+
+
+class TestNodesUidBlocks(TestNodes):
+
+    def setUp(self):
+        self.rt = RedisTree(uid_block_size=16)
+        self.rt.r.flushdb()
+        self.rt.init_fs()
+
+
+class TestUidBlocks(InitRedisTreeCase):
+
+    def test_lease(self):
+        rt = RedisTree(uid_block_size=10)
+        uids = [int(rt.create_child_node('/%d' % i)) for i in range(15)]
+        self.assertEqual(uids, range(self.rt.ROOT_NODE + 1,
+                                     self.rt.ROOT_NODE + 16))
+        self.assertEqual(int(rt.r.get('NODE_COUNTER')), self.rt.ROOT_NODE + 20)
+
+        # A larger allocation than the block goes straight to the counter.
+        self.assertEqual(rt.allocate_uids(50), self.rt.ROOT_NODE + 21)
+
+    def test_release(self):
+        rt = RedisTree(uid_block_size=10)
+        first = rt.allocate_uids()
+        rt.release_uids()
+        self.assertEqual(rt.r.lrange('FREE_UIDS', 0, -1),
+                         ['%d %d' % (first + 1, first + 9)])
+
+        other = RedisTree(uid_block_size=10)
+        self.assertEqual(other.allocate_uids(3), first + 1)
+        self.assertEqual(other.allocate_uids(), first + 4)
+        self.assertEqual(int(rt.r.get('NODE_COUNTER')), first + 9)
+
+    def test_threads(self):
+        rt = RedisTree(uid_block_size=7)
+        uids = []
+
+        def allocate():
+            for i in range(100):
+                first = rt.allocate_uids(i % 3 + 1)
+                uids.extend(range(first, first + i % 3 + 1))
+
+        threads = [threading.Thread(target=allocate) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(uids)), len(uids))
+
+
+class TestCreate(InitRedisTreeCase):
+
+    use_scripts = True
+
+    def setUp(self):
+        InitRedisTreeCase.setUp(self)
+        self.rt.use_scripts = self.use_scripts
+
+    def test_exclusive(self):
+        uid = self.rt.create_child_node('/foo', {'size': '1'}, exclusive=True)
+        self.assertRaises(NodeExists, self.rt.create_child_node, '/foo',
+                          exclusive=True)
+        self.assertEqual(self.rt.get_node_at_path('/foo'), uid)
+        self.assertEqual(self.count_nodes(), 2)
+
+        other = self.rt.create_child_node('/foo')
+        self.assertEqual(self.rt.get_node_at_path('/foo'), other)
+
+    def test_missing_parent(self):
+        self.assertRaises(BrokenPath, self.rt.create_child_node, '/foo/bar')
+        self.assertEqual(self.count_nodes(), 1)
+
+    def test_missing_parent_unresolved(self):
+        self.assertRaises(BrokenPath, self.rt.create_child_node, '/foo/bar',
+                          resolve=False)
+        self.rt.create_child_node('/foo')
+        self.assertRaises(BrokenPath, self.rt.create_child_node,
+                          '/foo/bar/baz', resolve=False)
+        self.assertEqual(self.count_nodes(), 2)
+        self.assertEqual(self.rt.r.keys('TREE:/foo*'), [])
+
+        uid = self.rt.create_child_node('/foo/bar', resolve=False)
+        self.assertEqual(self.rt.get_node_at_path('/foo/bar'), uid)
+
+    def test_detached_parent(self):
+        for layout in ('path', 'uid'):
+            self.rt.r.flushdb()
+            self.rt.init_fs(layout=layout)
+            self.rt.create_child_node('/foo')
+            bar = self.rt.create_child_node('/foo/bar')
+            # A client still resolving /foo/bar from its cache, while
+            # delete_node has detached it but not reclaimed it yet.
+            rt = RedisTree(path_cache=PathCache(),
+                           use_scripts=self.use_scripts)
+            rt.get_node_at_path('/foo/bar', full=True)
+            self.rt.r.hdel(self.rt.tree_key('/foo', self.rt.get_node_at_path(
+                '/foo')), 'bar')
+            self.assertRaises(BrokenPath, rt.create_child_node,
+                              '/foo/bar/baz')
+            self.assertFalse(self.rt.r.exists(self.rt.tree_key('/foo/bar',
+                                                               bar)))
+
+    def test_attributes(self):
+        self.rt.create_child_node('/foo')
+        self.rt.create_symlink('/foo', '/me')
+        uid = self.rt.create_child_node('/me/bar', {'a': '1', 'b': '2'})
+        self.assertEqual(self.rt.get_node_info(uid), {'a': '1', 'b': '2'})
+        self.assertEqual(self.rt.get_children('/foo'), {'bar': uid})
+
+    def test_uid_blocks(self):
+        rt = RedisTree(uid_block_size=10, use_scripts=self.use_scripts)
+        first = rt.create_child_node('/foo')
+        self.assertEqual(int(rt.create_child_node('/bar')), int(first) + 1)
+        self.assertEqual(rt.get_node_at_path('/bar'), str(int(first) + 1))
+
+
+class TestCreateNoScripts(TestCreate):
+
+    use_scripts = False
+
+
+class TestNodeInfo(InitRedisTreeCase):
+
+    def setUp(self):
+        InitRedisTreeCase.setUp(self)
+        self.rt.create_child_node('/foo')
+        self.alice = self.rt.create_child_node(
+            '/foo/alice', {'size': '1', 'mtime': '10', 'blob': 'x' * 1000})
+        self.bob = self.rt.create_child_node('/foo/bob', {'size': '2'})
+
+    def test_get_node_info(self):
+        self.assertEqual(self.rt.get_node_info(self.alice, ['size', 'mtime']),
+                         {'size': '1', 'mtime': '10'})
+        self.assertEqual(self.rt.get_node_info(self.bob, ['size', 'mtime']),
+                         {'size': '2'})
+        self.assertEqual(len(self.rt.get_node_info(self.alice)), 3)
+
+    def test_get_nodes_info(self):
+        self.assertEqual(
+            self.rt.get_nodes_info([self.alice, self.bob, 'nobody'], ['size'],
+                                   batch_size=2),
+            [{'size': '1'}, {'size': '2'}, {}])
+        self.assertEqual(self.rt.get_nodes_info([self.bob]), [{'size': '2'}])
+
+    def test_listdir_with_info(self):
+        self.assertEqual(self.rt.listdir_with_info('/foo', ['size']), {
+            'alice': (self.alice, {'size': '1'}),
+            'bob': (self.bob, {'size': '2'}),
+        })
+        self.assertEqual(self.rt.listdir_with_info('/nobody'), {})
+
+    def test_clone_fields(self):
+        uid = self.rt.clone_node(self.alice, ['size'])
+        self.assertEqual(self.rt.get_node_info(uid), {'size': '1'})
+
+
+class TestPathIndex(InitRedisTreeCase):
+
+    def setUp(self):
+        InitRedisTreeCase.setUp(self)
+        self.rt.create_child_node('/foo')
+        self.rt.create_child_node('/foo/bar')
+        self.bob = self.rt.create_child_node('/foo/bar/bob')
+        self.rt.create_symlink('/foo/bar', '/me')
+
+    def index(self):
+        return self.rt.r.hgetall('PATHINDEX')
+
+    def test_rebuild(self):
+        self.assertEqual(self.index(), {})
+        self.assertEqual(self.rt.rebuild_path_index(), 4)
+        self.assertEqual(self.index()['/foo/bar/bob'], self.bob)
+        self.assertEqual(self.rt.path_index_size()['entries'], 4)
+        self.assertTrue(RedisTree().path_index)
+
+    def test_lookups(self):
+        self.rt.rebuild_path_index()
+        # Lookups use the index, even if it's wrong.
+        self.rt.r.hset('PATHINDEX', '/foo/bar/bob', 'indexed')
+        self.assertEqual(self.rt.get_node_at_path('/foo/bar/bob'), 'indexed')
+        self.assertEqual(self.rt.get_node_at_path('/me/bob'), self.bob)
+        self.rt.use_scripts = False
+        self.assertEqual(self.rt.get_node_at_path('/foo/bar/bob'), 'indexed')
+        self.assertEqual(self.rt.get_node_at_path('/me/bob'), self.bob)
+
+    def test_maintained(self):
+        self.rt.rebuild_path_index()
+        alice = self.rt.create_child_node('/me/alice')
+        self.assertEqual(self.index()['/foo/bar/alice'], alice)
+
+        self.rt.move_node('/foo/bar', '/bar')
+        self.assertEqual(sorted(self.index().keys()),
+                         ['/bar', '/bar/alice', '/bar/bob', '/foo', '/me'])
+
+        self.rt.copy_path('/bar', '/foo/copy')
+        self.assertEqual(self.index()['/foo/copy/bob'],
+                         self.rt.get_children('/foo/copy')['bob'])
+
+        self.rt.delete_node('/foo')
+        self.assertEqual(sorted(self.index().keys()),
+                         ['/bar', '/bar/alice', '/bar/bob', '/me'])
+
+        uids = self.rt.create_many([('/x/y', None)])
+        self.assertEqual(self.index()['/x/y'], uids[0])
+
+        self.rt.drop_path_index()
+        self.assertFalse(self.rt.r.exists('PATHINDEX'))
+
+
+class TestMoveSubtree(InitRedisTreeCase):
+
+    def check_move(self):
+        self.rt.create_child_node('/foo')
+        self.rt.create_child_node('/foo/bar')
+        self.rt.create_child_node('/foo/bar/baz')
+        uid = self.rt.create_child_node('/foo/bar/baz/bob')
+        self.rt.create_child_node('/me')
+
+        self.rt.move_node('/foo/bar', '/me/bar')
+
+        self.assertEqual(self.rt.get_node_at_path('/me/bar/baz/bob'), uid)
+        self.assertEqual(self.rt.get_children('/foo'), {})
+        self.assertEqual(self.rt.get_children('/foo/bar/baz'), {})
+        self.assertEqual(len(self.rt.r.keys("TREE:*")), 4)
+
+    def test_move_path_layout(self):
+        self.check_move()
+
+    def test_move_uid_layout(self):
+        self.rt.migrate_layout('uid')
+        self.check_move()
+
+    def test_move_missing(self):
+        self.assertRaises(BrokenPath, self.rt.move_node, '/foo', '/bar')
+
+    def check_move_into_itself(self):
+        self.rt.create_child_node('/a')
+        self.rt.create_child_node('/a/b')
+        self.assertRaises(ValueError, self.rt.move_node, '/a', '/a/b/a')
+        self.assertRaises(ValueError, self.rt.move_node, '/a', '/a')
+        self.assertEqual(list(self.rt.get_children('/')), ['a'])
+        self.assertEqual(list(self.rt.get_children('/a')), ['b'])
+        self.rt.move_node('/a/b', '/ab')
+        self.assertEqual(list(self.rt.get_children('/ab')), [])
+
+    def test_move_into_itself_path_layout(self):
+        self.check_move_into_itself()
+
+    def test_move_into_itself_uid_layout(self):
+        self.rt.migrate_layout('uid')
+        self.check_move_into_itself()
+
+
+class TestMigrateLayout(InitRedisTreeCase):
+
+    def test_migrate(self):
+        self.rt.create_child_node('/foo')
+        self.rt.create_child_node('/foo/bar')
+        uid = self.rt.create_child_node('/foo/bar/bob')
+        self.rt.create_symlink('/foo/bar', '/me')
+
+        self.assertEqual(self.rt.migrate_layout('uid'), 3)
+        self.assertEqual(self.rt.r.get('TREE_LAYOUT'), 'uid')
+        self.assertEqual(RedisTree().get_node_at_path('/me/bob'), uid)
+        self.assertEqual(self.rt.get_children('/foo/bar'), {'bob': uid})
+
+        self.assertEqual(self.rt.migrate_layout('path'), 3)
+        self.assertTrue(self.rt.r.exists('TREE:/foo/bar'))
+        self.assertEqual(self.rt.get_node_at_path('/me/bob'), uid)
+
+
+class TestBatch(InitRedisTreeCase):
+
+    def test_resolve_many(self):
+        self.rt.create_child_node('/foo')
+        bar = self.rt.create_child_node('/foo/bar')
+        bob = self.rt.create_child_node('/foo/bar/bob')
+        me = self.rt.create_symlink('/foo/bar', '/me')
+
+        paths = ['/me/bob', '/foo/bar', '/nobody/bob', '/', '/me', '/me/bob']
+        self.assertEqual(self.rt.resolve_many(paths), [
+            ('/foo/bar/bob', bob),
+            ('/foo/bar', bar),
+            None,
+            ('/', self.rt.ROOT_NODE),
+            ('/me', me),
+            ('/foo/bar/bob', bob),
+        ])
+        self.assertEqual(self.rt.resolve_many(['/me'], full=True),
+                         [('/foo/bar', bar)])
+        for path in ['/me/bob', '/foo/bar', '/me']:
+            self.assertEqual(self.rt.resolve_many([path])[0],
+                             self.rt.real_node(path))
+
+    def test_create_many(self):
+        self.rt.create_child_node('/foo')
+        self.rt.create_child_node('/foo/bar')
+        self.rt.create_symlink('/foo/bar', '/me')
+
+        uids = self.rt.create_many([
+            ('/me/a/b/c', {'size': '1'}),
+            ('/me/a/b/d', None),
+            ('/x', None),
+            ('/x/y/z', {'size': '2'}),
+        ])
+
+        self.assertEqual(len(set(uids)), 4)
+        self.assertEqual(self.rt.get_node_at_path('/foo/bar/a/b/c'), uids[0])
+        self.assertEqual(self.rt.get_node_at_path('/me/a/b/d'), uids[1])
+        self.assertEqual(self.rt.get_node_at_path('/x'), uids[2])
+        self.assertEqual(self.rt.get_node_at_path('/x/y/z'), uids[3])
+        self.assertEqual(self.rt.get_node_info(uids[3]), {'size': '2'})
+        self.assertEqual(self.rt.get_node_info(self.rt.get_node_at_path('/x/y')),
+                         {'name': 'y'})
+        self.assertEqual(self.count_nodes(), 4 + 7)
+
+
+class TestBatchUidLayout(TestBatch):
+
+    def setUp(self):
+        self.rt = RedisTree()
+        self.rt.r.flushdb()
+        self.rt.init_fs(layout='uid')
+
+
+class TestScriptResolution(InitRedisTreeCase):
+
+    def setUp(self):
+        InitRedisTreeCase.setUp(self)
+        self.rt.create_child_node('/foo')
+        self.rt.create_child_node('/foo/bar')
+        self.bob = self.rt.create_child_node('/foo/bar/bob')
+        self.rt.create_symlink('/foo/bar', '/me')
+
+    def test_same_as_walk(self):
+        for path in ['/', '/foo', '/foo/bar/bob', '/me', '/me/bob']:
+            for full in [False, True]:
+                chunks = self.rt.split_path(path)
+                self.assertEqual(self.rt.real_node(path, full),
+                                 self.rt.walk_real_node(chunks, full))
+
+    def test_script_flushed(self):
+        self.rt.get_node_at_path('/me/bob')
+        self.rt.r.execute_command('SCRIPT', 'FLUSH')
+        self.assertEqual(self.rt.get_node_at_path('/me/bob'), self.bob)
+
+    def test_broken_path(self):
+        self.assertRaises(Exception, self.rt.get_node_at_path, '/me/alice')
+
+    def test_without_scripts(self):
+        rt = RedisTree(use_scripts=False)
+        self.assertEqual(rt.get_node_at_path('/me/bob'), self.bob)
+        self.assertEqual(rt.get_real_path('/me/bob'), '/foo/bar/bob')
+        self.assertEqual(rt._scripts, {})
 
 
 class TestSymlinks(InitRedisTreeCase):
@@ -266,3 +711,453 @@ class TestSymlinks(InitRedisTreeCase):
         self.rt.create_symlink('/foo', '/bar')
         self.assertEqual(self.rt.get_children('/foo'), expected)
         self.assertEqual(self.rt.get_children('/bar'), {})
+
+    def test_symlink_chain(self):
+        self.rt.create_child_node('/foo')
+        uid = self.rt.create_child_node('/foo/bar')
+        self.rt.create_symlink('/foo', '/a')
+        link = self.rt.create_symlink('/a', '/b')
+        info = self.rt.get_node_info(link)
+        self.assertEqual(info['target'], '/a')
+        self.assertEqual(info['final_target'], '/foo')
+        self.assertEqual(self.rt.get_node_at_path('/b/bar'), uid)
+        self.assertEqual(self.rt.get_real_path('/b/bar'), '/foo/bar')
+
+    def test_symlink_loop(self):
+        a = self.rt.create_child_node('/a')
+        b = self.rt.create_symlink('/a', '/b')
+        # Turn /a into a link to /b, which can't be done through the API.
+        self.rt.r.hmset("NODE:%s" % a, {'target': '/b', 'target_node': b})
+        self.rt.r.hdel("NODE:%s" % b, 'final_target', 'final_node')
+        for use_scripts in (True, False):
+            rt = RedisTree(use_scripts=use_scripts, max_symlink_hops=8)
+            self.assertRaises(SymlinkLoopError, rt.get_node_at_path, '/b/c')
+
+    def test_move_target(self):
+        self.rt.create_child_node('/foo')
+        self.rt.create_child_node('/foo/bar')
+        uid = self.rt.create_child_node('/foo/bar/bob')
+        link = self.rt.create_symlink('/foo/bar', '/me')
+        self.rt.move_node('/foo', '/other')
+        info = self.rt.get_node_info(link)
+        self.assertEqual(info['final_target'], '/other/bar')
+        self.assertEqual(self.rt.get_node_at_path('/me/bob'), uid)
+        self.assertEqual(self.rt.get_real_path('/me/bob'), '/other/bar/bob')
+
+    def test_delete_target(self):
+        self.rt.create_child_node('/foo')
+        bar = self.rt.create_child_node('/foo/bar')
+        self.rt.create_child_node('/foo/bar/bob')
+        link = self.rt.create_symlink('/foo/bar', '/me')
+        self.assertEqual(self.rt.r.smembers("LINKS:%s" % bar), set([link]))
+        self.rt.delete_node('/foo')
+        self.assertEqual(self.rt.get_node_info(link)['dangling'], '1')
+        self.assertRaises(BrokenPath, self.rt.get_node_at_path, '/me/bob')
+        self.assertFalse(self.rt.r.exists("LINKS:%s" % bar))
+        self.assertFalse(self.rt.has_links())
+
+    def test_delete_chained_link(self):
+        d = self.rt.create_child_node('/d')
+        self.rt.create_child_node('/d/bob')
+        self.rt.create_child_node('/e')
+        b = self.rt.create_symlink('/d', '/b')
+        a = self.rt.create_symlink('/b', '/a')
+        c = self.rt.create_symlink('/a', '/c')
+        self.assertEqual(self.rt.r.smembers("LINKS:%s" % d), set([a, b, c]))
+        self.assertEqual(self.rt.r.smembers("CHAINS:%s" % b), set([a]))
+        self.rt.delete_node('/b')
+        self.assertEqual(self.rt.get_node_info(a)['dangling'], '1')
+        self.assertEqual(self.rt.get_node_info(c)['dangling'], '1')
+        self.assertRaises(BrokenPath, self.rt.get_node_at_path, '/a/bob')
+        self.assertRaises(BrokenPath, self.rt.get_node_at_path, '/c/bob')
+        # A new /b doesn't bring the links through the old one back.
+        self.rt.create_symlink('/e', '/b')
+        self.assertRaises(BrokenPath, self.rt.get_node_at_path, '/a/bob')
+        self.assertFalse(self.rt.r.exists("CHAINS:%s" % b))
+        self.assertEqual(self.rt.r.smembers("LINKS:%s" % d), set([a, c]))
+
+    def test_delete_chained_link_parent(self):
+        self.rt.create_child_node('/d')
+        self.rt.create_child_node('/d/bob')
+        self.rt.create_child_node('/foo')
+        self.rt.create_symlink('/d', '/foo/b')
+        a = self.rt.create_symlink('/foo/b', '/a')
+        self.rt.delete_node('/foo')
+        self.assertEqual(self.rt.get_node_info(a)['dangling'], '1')
+        self.assertRaises(BrokenPath, self.rt.get_node_at_path, '/a/bob')
+
+    def test_delete_chain(self):
+        d = self.rt.create_child_node('/d')
+        self.rt.create_symlink('/d', '/b')
+        a = self.rt.create_symlink('/b', '/a')
+        self.rt.delete_node('/a')
+        self.rt.delete_node('/b')
+        self.assertEqual(self.rt.r.keys("CHAINS:*"), [])
+        self.assertFalse(self.rt.r.exists("LINKS:%s" % d))
+        self.assertFalse(self.rt.r.exists("NODE:%s" % a))
+
+
+class TestSymlinksUidLayout(TestSymlinks):
+
+    def setUp(self):
+        self.rt = RedisTree()
+        self.rt.r.flushdb()
+        self.rt.init_fs(layout='uid')
+
+
+class TestNodesAggregates(TestNodes):
+
+    def setUp(self):
+        self.rt = RedisTree()
+        self.rt.r.flushdb()
+        self.rt.init_fs(aggregate='size')
+
+    def tearDown(self):
+        # Every operation keeps the aggregates up to date.
+        self.assertEqual(self.rt.check_aggregates(), [])
+
+    def test_delete_very_deep(self):
+        # Every creation updates all its ancestors: keep the tree small
+        # enough for the suite to stay fast.
+        path = ''
+        for i in xrange(150):
+            path = path + '/f'
+            self.rt.create_child_node(path, resolve=False)
+
+        self.assertEqual(self.rt.du('/f'), (150, 0))
+        self.assertEqual(self.rt.delete_node('/f'), 150)
+        self.assertEqual(self.count_nodes(), 1)
+
+
+class TestNodesUidLayoutAggregates(TestNodesAggregates):
+
+    def setUp(self):
+        self.rt = RedisTree()
+        self.rt.r.flushdb()
+        self.rt.init_fs(layout='uid', aggregate='size')
+
+
+class TestBatchAggregates(TestBatch):
+
+    def setUp(self):
+        self.rt = RedisTree()
+        self.rt.r.flushdb()
+        self.rt.init_fs(aggregate='size')
+
+    def tearDown(self):
+        self.assertEqual(self.rt.check_aggregates(), [])
+
+
+class TestAggregates(InitRedisTreeCase):
+
+    layout = 'path'
+
+    def setUp(self):
+        self.rt = RedisTree()
+        self.rt.r.flushdb()
+        self.rt.init_fs(layout=self.layout)
+        self.rt.create_child_node('/foo')
+        self.rt.create_child_node('/foo/a', {'size': '10'})
+        self.rt.create_child_node('/foo/bar')
+        self.rt.create_child_node('/foo/bar/b', {'size': '5'})
+        self.rt.create_symlink('/foo/bar', '/me')
+        self.assertEqual(self.rt.enable_aggregates('size'), 3)
+
+    def tearDown(self):
+        self.assertEqual(self.rt.check_aggregates(), [])
+
+    def test_du(self):
+        self.assertEqual(self.rt.du('/'), (6, 15))
+        self.assertEqual(self.rt.du('/foo'), (4, 15))
+        self.assertEqual(self.rt.du('/me'), (2, 5))
+        self.assertEqual(self.rt.du('/foo/a'), (1, 10))
+
+    def test_create(self):
+        self.rt.create_child_node('/me/c', {'size': '7'})
+        self.rt.create_many([('/foo/x/y', {'size': '1'}), ('/me/d', None)])
+        self.assertEqual(self.rt.du('/foo/bar'), (4, 12))
+        self.assertEqual(self.rt.du('/'), (10, 23))
+
+    def test_replace(self):
+        self.assertRaises(NodeExists, self.rt.create_child_node, '/foo/a',
+                          {'size': '3'})
+        self.assertRaises(NodeExists, self.rt.create_many,
+                          [('/me/c', None), ('/me/b', {'size': '2'})])
+        self.assertRaises(NodeExists, self.rt.copy_path, '/foo/a', '/me')
+        self.assertRaises(NodeExists, self.rt.move_node, '/foo/a',
+                          '/foo/bar/b')
+        self.assertEqual(self.rt.du('/foo'), (4, 15))
+        self.assertEqual(self.rt.du('/'), (6, 15))
+
+    def test_delete(self):
+        self.rt.delete_node('/foo/bar')
+        self.assertEqual(self.rt.du('/foo'), (2, 10))
+        # The aggregates of the deleted nodes are reclaimed with them.
+        self.assertEqual(sorted(self.rt.r.keys('DU:*')), sorted([
+            'DU:%s' % self.rt.ROOT_NODE,
+            'DU:%s' % self.rt.get_node_at_path('/foo')]))
+
+    def test_move_and_copy(self):
+        self.rt.move_node('/foo/bar', '/bar')
+        self.assertEqual(self.rt.du('/foo'), (2, 10))
+        self.assertEqual(self.rt.du('/bar'), (2, 5))
+        self.rt.copy_path('/foo', '/bar/foo')
+        self.assertEqual(self.rt.du('/bar'), (4, 15))
+        self.assertEqual(self.rt.du('/bar/foo'), (2, 10))
+        self.assertEqual(self.rt.du('/'), (8, 25))
+
+    def test_repair(self):
+        foo = self.rt.get_node_at_path('/foo')
+        self.rt.r.hincrby('DU:%s' % foo, 'total', 3)
+        drifts = self.rt.check_aggregates('/foo', repair=True)
+        self.assertEqual(drifts, [('/foo', (3, 18), (3, 15))])
+        self.assertEqual(self.rt.du('/foo'), (4, 15))
+
+    def test_drop(self):
+        self.rt.drop_aggregates()
+        self.assertEqual(self.rt.r.keys('DU:*'), [])
+        self.assertEqual(self.rt.aggregate, None)
+        self.rt.create_child_node('/foo/c', {'size': '1'})
+        self.assertEqual(self.rt.r.keys('DU:*'), [])
+        self.rt.enable_aggregates('size')
+
+
+class TestAggregatesUidLayout(TestAggregates):
+
+    layout = 'uid'
+
+
+class TestAggregatesNoScripts(TestAggregatesUidLayout):
+
+    def setUp(self):
+        TestAggregatesUidLayout.setUp(self)
+        self.rt.use_scripts = False
+
+
+class TestChangeFeed(InitRedisTreeCase):
+
+    use_scripts = True
+
+    def setUp(self):
+        self.rt = self.client()
+        self.rt.r.flushdb()
+        self.rt.init_fs(change_feed=True)
+
+    def client(self):
+        return RedisTree(use_scripts=self.use_scripts)
+
+    def events(self, prefix='/', since='0'):
+        return [(event['op'], event['path'], event.get('dest'))
+                for _, event in self.rt.watch(prefix, since, count=2)]
+
+    def test_mutations(self):
+        foo = self.rt.create_child_node('/foo')
+        self.rt.create_child_node('/foo/bar')
+        self.rt.create_symlink('/foo/bar', '/me')
+        self.rt.create_many([('/me/a', None)])
+        self.rt.move_node('/foo/bar', '/bar')
+        self.rt.copy_path('/bar', '/foo/copy')
+        self.rt.delete_node('/foo')
+
+        self.assertEqual(self.events(), [
+            ('create', '/foo', None),
+            ('create', '/foo/bar', None),
+            ('symlink', '/me', None),
+            ('create', '/foo/bar/a', None),
+            ('move', '/foo/bar', '/bar'),
+            ('copy', '/bar', '/foo/copy'),
+            ('delete', '/foo', None),
+        ])
+        first = next(self.rt.watch(since='0'))[1]
+        self.assertEqual(first, {'op': 'create', 'path': '/foo', 'uid': foo})
+        symlink = list(self.rt.watch(since='0'))[2][1]
+        self.assertEqual(symlink['target'], '/foo/bar')
+
+    def test_prefix(self):
+        self.rt.create_child_node('/foo')
+        self.rt.create_child_node('/foobar')
+        self.rt.create_child_node('/foo/bar')
+        self.rt.move_node('/foobar', '/foo/other')
+        self.assertEqual(self.events('/foo/'), [
+            ('create', '/foo', None),
+            ('create', '/foo/bar', None),
+            ('move', '/foobar', '/foo/other'),
+        ])
+
+    def test_since(self):
+        self.rt.create_child_node('/foo')
+        self.assertEqual(list(self.rt.watch()), [])
+        self.rt.create_child_node('/bar')
+        event_id, _ = list(self.rt.watch(since='0'))[0]
+        self.assertEqual(self.events(since=event_id),
+                         [('create', '/bar', None)])
+
+    def test_other_client(self):
+        # The feed is turned on for the tree, not only for self.rt.
+        rt = self.client()
+        rt.create_child_node('/foo')
+        rt.create_child_node('/foo/bar')
+        rt.delete_node('/foo')
+        self.assertEqual(self.events(), [
+            ('create', '/foo', None),
+            ('create', '/foo/bar', None),
+            ('delete', '/foo', None),
+        ])
+
+    def test_disabled(self):
+        self.rt.drop_change_feed()
+        self.assertFalse(self.rt.change_feed)
+        rt = self.client()
+        rt.create_child_node('/foo')
+        self.rt.create_child_node('/bar')
+        self.assertFalse(rt.r.exists(rt.CHANGE_FEED))
+
+        self.rt.enable_change_feed(maxlen=10)
+        self.client().create_child_node('/foo/a')
+        self.assertEqual(self.events(), [('create', '/foo/a', None)])
+        self.assertEqual(self.rt.feed_maxlen, 10)
+
+
+class TestChangeFeedNoScripts(TestChangeFeed):
+
+    use_scripts = False
+
+
+class TestSnapshots(InitRedisTreeCase):
+
+    layout = 'path'
+    use_scripts = True
+
+    def setUp(self):
+        self.rt = RedisTree(use_scripts=self.use_scripts)
+        self.rt.r.flushdb()
+        self.rt.init_fs(layout=self.layout)
+        self.populate()
+
+    def populate(self):
+        self.foo = self.rt.create_child_node('/foo')
+        self.bar = self.rt.create_child_node('/foo/bar', {'size': '1'})
+        self.rt.create_child_node('/foo/bar/baz')
+        self.rt.create_symlink('/foo/bar', '/foo/me')
+
+    def test_point_in_time(self):
+        snapshot = self.rt.snapshot('/foo')
+        self.rt.create_child_node('/foo/new')
+        self.rt.move_node('/foo/bar', '/bar')
+        self.assertEqual(sorted(self.rt.get_children('/', snapshot=snapshot)),
+                         ['bar', 'me'])
+        self.assertEqual(self.rt.real_node('/bar/baz', snapshot=snapshot)[0],
+                         '/bar/baz')
+        self.assertEqual(self.rt.get_node_at_path('/', snapshot=snapshot),
+                         self.foo)
+        self.assertEqual(self.rt.get_children('/missing', snapshot=snapshot),
+                         {})
+        self.assertRaises(BrokenPath, self.rt.real_node, '/new',
+                          snapshot=snapshot)
+
+    def test_symlinks(self):
+        self.rt.create_symlink('/', '/foo/out')
+        snapshot = self.rt.snapshot('/foo')
+        self.assertEqual(self.rt.real_node('/me/baz', snapshot=snapshot)[0],
+                         '/bar/baz')
+        self.assertEqual(self.rt.real_node('/me', full=True,
+                                           snapshot=snapshot)[0], '/bar')
+        self.assertRaises(BrokenPath, self.rt.real_node, '/out/foo',
+                          snapshot=snapshot)
+
+    def test_shared_nodes(self):
+        nodes = self.count_nodes()
+        snapshot = self.rt.snapshot('/foo')
+        self.assertEqual(self.count_nodes(), nodes)
+        self.assertEqual(self.rt.get_snapshots()[snapshot]['path'], '/foo')
+
+        self.rt.delete_node('/foo/bar')
+        self.assertEqual(self.count_nodes(), nodes)
+        uid = self.rt.get_node_at_path('/bar', snapshot=snapshot)
+        self.assertEqual(self.rt.get_node_info(uid), {'size': '1'})
+        self.assertEqual(self.rt.gc_snapshots(), 0)
+
+        self.rt.drop_snapshot(snapshot)
+        self.assertEqual(self.rt.r.keys('SNAPTREE:*'), [])
+        self.assertEqual(self.rt.gc_snapshots(), 2)
+        self.assertEqual(self.count_nodes(), nodes - 2)
+        self.assertEqual(self.rt.r.scard('SNAPSHOT_ORPHANS'), 0)
+        self.assertRaises(SnapshotNotFound, self.rt.real_node, '/',
+                          snapshot=snapshot)
+
+    def test_gc_keeps_held_nodes(self):
+        first = self.rt.snapshot('/foo')
+        self.rt.snapshot('/foo/bar')
+        self.rt.delete_node('/foo')
+        self.rt.drop_snapshot(first)
+        # /foo and /foo/me are released, /foo/bar and its child are held.
+        self.assertEqual(self.rt.gc_snapshots(), 2)
+        self.assertEqual(self.rt.get_node_info(self.bar), {'size': '1'})
+
+    def test_root(self):
+        snapshot = self.rt.snapshot('/')
+        self.rt.delete_node('/foo')
+        self.assertEqual(self.rt.get_children('/', snapshot=snapshot),
+                         {'foo': self.foo})
+        self.assertEqual(self.rt.get_node_at_path('/', snapshot=snapshot),
+                         self.rt.ROOT_NODE)
+
+    def test_broken_path(self):
+        self.assertRaises(BrokenPath, self.rt.snapshot, '/missing')
+
+    def test_batches(self):
+        for i in range(5):
+            self.rt.create_child_node('/foo/bar/%d' % i)
+        snapshot = self.rt.snapshot('/foo', batch_size=2)
+        self.rt.delete_node('/foo/bar')
+        self.assertEqual(sorted(self.rt.get_children('/bar',
+                                                     snapshot=snapshot)),
+                         ['0', '1', '2', '3', '4', 'baz'])
+        self.assertEqual(self.rt.real_node('/me/3', snapshot=snapshot)[0],
+                         '/bar/3')
+
+    def write_during_copy(self, write):
+        """Make every snapshot copy call write once its top is copied."""
+        copy_batch = self.rt._snapshot_batch
+
+        def _snapshot_batch(snapshot_id, directories):
+            res = copy_batch(snapshot_id, directories)
+            if directories[0][1] != self.foo:
+                write()
+            return res
+        self.rt._snapshot_batch = _snapshot_batch
+
+    def test_concurrent_write(self):
+        writes = []
+
+        def write():
+            if not writes:
+                writes.append(self.rt.create_child_node('/foo/new'))
+                self.rt.delete_node('/foo/me')
+        self.write_during_copy(write)
+        snapshot = self.rt.snapshot('/foo', batch_size=1)
+        # The copy started over: the view is the subtree after the writes.
+        self.assertEqual(self.rt.get_children('/', snapshot=snapshot),
+                         {'bar': self.bar, 'new': writes[0]})
+        self.assertEqual(len(self.rt.r.keys('SNAPTREE:*')), 2)
+
+    def test_conflicts(self):
+        def write():
+            self.rt.create_child_node('/foo/bar/baz/x')
+            self.rt.delete_node('/foo/bar/baz/x')
+        self.write_during_copy(write)
+        self.assertRaises(redis.WatchError, self.rt.snapshot, '/foo',
+                          attempts=3)
+        self.assertEqual(self.rt.r.keys('SNAPTREE:*'), [])
+        self.assertEqual(self.rt.get_snapshots(), {})
+        self.assertFalse(self.rt.has_snapshots())
+
+
+class TestSnapshotsUidLayout(TestSnapshots):
+
+    layout = 'uid'
+
+
+class TestSnapshotsNoScripts(TestSnapshots):
+
+    use_scripts = False
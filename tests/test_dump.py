@@ -0,0 +1,124 @@
+import json
+from StringIO import StringIO
+from unittest import TestCase
+from redistree import RedisTree, NodeExists, PathCache
+
+
+class TestDump(TestCase):
+
+    layout = 'path'
+
+    def setUp(self):
+        self.rt = RedisTree()
+        self.rt.r.flushdb()
+        self.rt.init_fs(layout=self.layout)
+        self.rt.create_many([('/foo/%d' % i, {'size': str(i)})
+                             for i in xrange(50)])
+        self.rt.create_many([('/foo/3/bar/%d' % i, None) for i in xrange(30)])
+        self.rt.create_child_node('/other')
+        self.rt.create_symlink('/foo/3/bar', '/foo/inside')
+        self.rt.create_symlink('/other', '/foo/outside')
+
+    def dump(self, path, **kwargs):
+        out = StringIO()
+        result = self.rt.export_subtree(path, out, **kwargs)
+        out.seek(0)
+        return result, out
+
+    def walk(self, path):
+        return sorted((dirpath[len(path):], sorted(entries))
+                      for dirpath, entries in self.rt.walk(path))
+
+    def test_format(self):
+        result, out = self.dump('/foo', count=10)
+        self.assertEqual(result.nodes, 1 + 50 + 30 + 2 + 1)
+        lines = [json.loads(line) for line in out]
+        self.assertEqual(lines[0], {'version': 1, 'path': '/foo'})
+        self.assertEqual(lines[1]['path'], '')
+        for record in lines[2:]:
+            parent = lines[1 + record['parent']]['path']
+            self.assertEqual(record['path'].rsplit('/', 1)[0] if parent else
+                             '', parent)
+        link = [r for r in lines if r.get('path') == 'inside'][0]
+        self.assertEqual(link['target'], '/foo/3/bar')
+        self.assertEqual(link['attributes'], {})
+
+    def test_roundtrip(self):
+        _, out = self.dump('/foo', count=10)
+        result = self.rt.import_subtree('/copy', out, batch_size=7)
+        self.assertEqual(result.nodes, 84)
+
+        expected = self.walk('/foo')
+        self.assertEqual(self.walk('/copy'), [
+            (dirpath, [(name, self.rt.get_node_at_path('/copy%s/%s' %
+                                                        (dirpath, name)))
+                       for name, _ in entries])
+            for dirpath, entries in expected])
+        self.assertEqual(self.rt.get_node_info(
+            self.rt.get_node_at_path('/copy/7')), {'size': '7'})
+
+        # Links into the subtree lead to the copy, the others are kept.
+        self.assertEqual(self.rt.get_real_path('/copy/inside/12'),
+                         '/copy/3/bar/12')
+        self.assertEqual(self.rt.get_real_path('/copy/outside', full=True),
+                         '/other')
+        self.rt.delete_node('/copy/3')
+        self.assertEqual(self.rt.get_node_info(
+            self.rt.get_node_at_path('/copy/inside'))['dangling'], '1')
+
+    def test_processes(self):
+        _, out = self.dump('/foo', count=10)
+        result = self.rt.import_subtree('/copy', out, batch_size=7,
+                                        processes=2)
+        self.assertEqual(result.nodes, 84)
+        self.assertEqual(len(self.rt.get_children('/copy/3/bar')), 30)
+
+    def test_dangling(self):
+        _, out = self.dump('/foo')
+        self.rt.delete_node('/other')
+        self.rt.import_subtree('/copy', out)
+        info = self.rt.get_node_info(self.rt.get_node_at_path('/copy/outside'))
+        self.assertEqual(info, {'target': '/other', 'dangling': '1'})
+
+    def test_root(self):
+        _, out = self.dump('/')
+        aggregate = self.rt.aggregate
+        self.rt.r.flushdb()
+        self.rt.init_fs(layout=self.layout, aggregate=aggregate)
+        self.rt.import_subtree('/backup', out)
+        self.assertEqual(self.rt.get_real_path('/backup/foo/inside/3'),
+                         '/backup/foo/3/bar/3')
+        self.assertEqual(len(self.rt.get_children('/backup/foo')), 52)
+
+    def test_through_symlink(self):
+        _, out = self.dump('/foo/3')
+        self.rt.path_cache = PathCache()
+        self.rt.create_symlink('/other', '/link')
+        old = self.rt.create_child_node('/other/imp')
+        self.assertEqual(self.rt.get_node_at_path('/other/imp'), old)
+        self.rt.import_subtree('/link/imp', out)
+        self.assertNotEqual(self.rt.get_node_at_path('/other/imp'), old)
+        self.assertEqual(len(self.rt.get_children('/other/imp/bar')), 30)
+
+
+class TestDumpUidLayout(TestDump):
+
+    layout = 'uid'
+
+
+class TestDumpAggregates(TestDump):
+
+    def setUp(self):
+        TestDump.setUp(self)
+        self.rt.enable_aggregates('size')
+
+    def tearDown(self):
+        self.assertEqual(self.rt.check_aggregates(), [])
+
+    def test_through_symlink(self):
+        # The import would replace /other/imp.
+        _, out = self.dump('/foo/3')
+        self.rt.create_symlink('/other', '/link')
+        self.rt.create_child_node('/other/imp')
+        self.assertRaises(NodeExists, self.rt.import_subtree, '/link/imp',
+                          out)
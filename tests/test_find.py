@@ -0,0 +1,97 @@
+from unittest import TestCase
+from redistree import RedisTree
+from redistree.find import scan_pattern
+
+
+class TestGlob(TestCase):
+
+    layout = 'path'
+
+    def setUp(self):
+        self.rt = RedisTree()
+        self.rt.r.flushdb()
+        self.rt.init_fs(layout=self.layout)
+        self.rt.create_many([
+            ('/projects/a/builds/1/out.log', {'size': '10'}),
+            ('/projects/a/builds/1/deep/x.log', {'size': '20'}),
+            ('/projects/a/builds/2/out.txt', None),
+            ('/projects/b/builds/out.log', {'size': '30'}),
+            ('/projects/b/src/main.log', None),
+            ('/other/c.log', None),
+        ])
+        # More entries than a HSCAN page.
+        self.rt.create_many([('/projects/b/builds/%d.dat' % i, None)
+                             for i in range(300)])
+        self.rt.create_symlink('/projects/a', '/projects/link')
+        self.rt.create_symlink('/projects', '/projects/a/builds/2/loop')
+
+    def glob(self, pattern, **kwargs):
+        return sorted(path for path, _ in self.rt.glob(pattern, count=10,
+                                                      batch_size=2, **kwargs))
+
+    def test_wildcards(self):
+        self.assertEqual(self.glob('/projects/*/builds/*/out.*'), [
+            '/projects/a/builds/1/out.log',
+            '/projects/a/builds/2/out.txt',
+            '/projects/link/builds/1/out.log',
+            '/projects/link/builds/2/out.txt',
+        ])
+        self.assertEqual(self.glob('/projects/[!a]*/*/m?in.log'),
+                         ['/projects/b/src/main.log'])
+        self.assertEqual(len(self.glob('/projects/b/builds/1*.dat')), 111)
+
+    def test_recursive(self):
+        self.assertEqual(self.glob('/projects/a/**/*.log'), [
+            '/projects/a/builds/1/deep/x.log',
+            '/projects/a/builds/1/out.log',
+        ])
+        self.assertEqual(self.glob('/projects/*/builds/**/*.log'), [
+            '/projects/a/builds/1/deep/x.log',
+            '/projects/a/builds/1/out.log',
+            '/projects/b/builds/out.log',
+            '/projects/link/builds/1/deep/x.log',
+            '/projects/link/builds/1/out.log',
+        ])
+        self.assertEqual(self.glob('/projects/a/builds/**'), [
+            '/projects/a/builds/1',
+            '/projects/a/builds/1/deep',
+            '/projects/a/builds/1/deep/x.log',
+            '/projects/a/builds/1/out.log',
+            '/projects/a/builds/2',
+            '/projects/a/builds/2/loop',
+            '/projects/a/builds/2/out.txt',
+        ])
+
+    def test_literal(self):
+        uid = self.rt.get_node_at_path('/other/c.log')
+        self.assertEqual(list(self.rt.glob('/other/c.log')),
+                         [('/other/c.log', uid)])
+        self.assertEqual(self.glob('/missing/*'), [])
+        self.assertEqual(self.glob('/other/missing'), [])
+
+    def test_attr_filter(self):
+        self.assertEqual(
+            self.glob('/projects/**/*.log', attr_filter={'size': '30'}),
+            ['/projects/b/builds/out.log'])
+        self.assertEqual(
+            self.glob('/projects/a/**/*.log',
+                      attr_filter={'size': lambda size: int(size) > 15}),
+            ['/projects/a/builds/1/deep/x.log'])
+
+    def test_find(self):
+        self.assertEqual(sorted(path for path, _ in
+                                self.rt.find('/projects/link', '*.log')), [
+            '/projects/link/builds/1/deep/x.log',
+            '/projects/link/builds/1/out.log',
+        ])
+        self.assertEqual(len(list(self.rt.find('/projects/b'))), 304)
+        self.assertEqual(list(self.rt.find('/missing')), [])
+
+    def test_scan_pattern(self):
+        self.assertEqual(scan_pattern('a[!b]c[d'), 'a?c?d')
+        self.assertEqual(scan_pattern('*.log'), '*.log')
+
+
+class TestGlobUidLayout(TestGlob):
+
+    layout = 'uid'
@@ -0,0 +1,96 @@
+from unittest import TestCase
+from redistree import RedisTree, Instrumentation
+from redistree.cache import TreeCache
+from redistree.instrument import Histogram
+
+
+class TestInstrumentation(TestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.instrumentation = Instrumentation(
+            callback=lambda operation, stats: self.calls.append((operation,
+                                                                 stats)))
+        self.rt = RedisTree(instrumentation=self.instrumentation)
+        self.rt.r.flushdb()
+        self.rt.init_fs()
+        self.calls[:] = []
+
+    def test_operation(self):
+        self.rt.create_child_node('/foo')
+        self.rt.create_child_node('/bar')
+        self.assertEqual(len(self.calls), 2)
+        operation, stats = self.calls[1]
+        self.assertEqual(operation, 'create_child_node')
+        # Only the script, once loaded.
+        self.assertEqual(stats['commands'], 1)
+        self.assertEqual(stats['pipelines'], 0)
+        self.assertTrue(stats['bytes_sent'] > 0)
+        self.assertTrue(stats['bytes_received'] > 0)
+        self.assertTrue(0 < stats['redis_time'] <= stats['wall_time'])
+
+    def test_nested(self):
+        self.rt.use_scripts = False
+        self.rt.create_child_node('/foo')
+        self.assertEqual(len(self.calls), 1)
+        operation, stats = self.calls[0]
+        # Resolving the parent is accounted to create_child_node as well.
+        self.assertEqual(operation, 'create_child_node')
+        self.assertTrue(stats['commands'] >= 5)
+        self.assertEqual(stats['pipelines'], 1)
+
+    def test_pipelines(self):
+        self.rt.create_child_node('/foo')
+        for i in range(10):
+            self.rt.create_child_node('/foo/%d' % i)
+        self.calls[:] = []
+        self.rt.delete_node('/foo', batch_size=4)
+        operation, stats = self.calls[-1]
+        self.assertEqual(operation, 'delete_node')
+        self.assertTrue(stats['pipelines'] >= 3)
+        self.assertTrue(stats['commands'] >= 11)
+
+    def test_summary(self):
+        for i in range(5):
+            self.rt.create_child_node('/%d' % i)
+        self.rt.get_node_at_path('/3')
+        summary = self.instrumentation.summary()
+        self.assertEqual(summary['create_child_node']['commands']['count'], 5)
+        self.assertEqual(summary['get_node_at_path']['pipelines']['max'], 0)
+        self.instrumentation.reset()
+        self.assertEqual(self.instrumentation.summary(), {})
+
+    def test_tree_cache(self):
+        rt = RedisTree(instrumentation=self.instrumentation,
+                       tree_cache=TreeCache())
+        try:
+            rt.create_child_node('/foo')
+            self.calls[:] = []
+            rt.get_node_at_path('/foo')
+            rt.get_node_at_path('/foo')
+        finally:
+            rt.tree_cache.stop()
+        # The misses of the first call are read by the tracking clients of
+        # the cache, the second one is served from memory.
+        self.assertTrue(self.calls[0][1]['commands'] > 0)
+        self.assertTrue(self.calls[0][1]['pipelines'] > 0)
+        self.assertEqual(self.calls[1][1]['commands'], 0)
+
+    def test_disabled(self):
+        rt = RedisTree()
+        self.assertEqual(rt.instrumentation, None)
+        rt.get_node_at_path('/')
+        self.assertEqual(self.calls, [])
+
+
+class TestHistogram(TestCase):
+
+    def test_percentile(self):
+        h = Histogram()
+        self.assertEqual(h.percentile(50), None)
+        for value in [0, 1, 2, 3, 5, 100]:
+            h.add(value)
+        self.assertEqual(h.percentile(10), 0)
+        self.assertEqual(h.percentile(50), 4)
+        self.assertEqual(h.percentile(99), 100)
+        self.assertEqual(h.summary()['max'], 100)
@@ -0,0 +1,98 @@
+import os
+from unittest import TestCase, skipIf
+import redis
+from redistree import RedisTree
+from redistree.replica import ReplicatedRedis
+import tests.test_core as core
+
+
+def replica_pools():
+    """The replicas of the local server to test with: REDISTREE_REPLICAS, a
+    comma separated list of host:port/db, or None."""
+    replicas = os.environ.get('REDISTREE_REPLICAS')
+    if not replicas:
+        return None
+    pools = []
+    for replica in replicas.split(','):
+        address, db = replica.split('/')
+        host, port = address.split(':')
+        pools.append(redis.ConnectionPool(host=host, port=int(port),
+                                          db=int(db)))
+    return pools
+
+
+class TestRouting(TestCase):
+    """Stand-in replicas: other databases of the local server, holding
+    other trees, so where a read went shows in its result."""
+
+    def setUp(self):
+        self.pools = []
+        for db, name in [(4, 'four'), (5, 'five')]:
+            pool = redis.ConnectionPool(db=db)
+            replica = RedisTree(connection_pool=pool)
+            replica.r.flushdb()
+            replica.init_fs()
+            replica.create_child_node('/%s' % name)
+            self.pools.append(pool)
+        self.rt = self.tree(read_your_writes=0)
+        self.rt.r.flushdb()
+        self.rt.init_fs()
+
+    def tree(self, **kwargs):
+        return RedisTree(replicas=self.pools, **kwargs)
+
+    def test_round_robin(self):
+        self.rt.create_child_node('/primary')
+        names = [list(self.rt.get_children('/')) for _ in range(4)]
+        self.assertEqual(sorted(names), [['five'], ['five'], ['four'],
+                                         ['four']])
+        self.assertTrue(isinstance(self.rt.r, ReplicatedRedis))
+
+    def test_mutations(self):
+        self.rt.create_child_node('/primary')
+        self.rt.create_child_node('/primary/foo')
+        # The resolutions done by the mutations see the primary.
+        self.rt.move_node('/primary/foo', '/bar')
+        self.rt.copy_path('/bar', '/primary/copy')
+        self.assertEqual(self.rt.delete_node('/primary'), 2)
+        self.assertEqual(self.rt.r.primary.hkeys('TREE:/'), ['bar'])
+
+    def test_read_your_writes(self):
+        rt = self.tree(read_your_writes=60)
+        rt.create_child_node('/primary')
+        self.assertEqual(list(rt.get_children('/')), ['primary'])
+        self.assertNotEqual(list(self.rt.get_children('/')), ['primary'])
+
+    def test_unreachable_replica(self):
+        rt = RedisTree(replicas=[redis.ConnectionPool(port=1)],
+                       read_your_writes=0)
+        rt.create_child_node('/primary')
+        self.assertEqual(list(rt.get_children('/')), ['primary'])
+
+    def test_shards(self):
+        self.assertRaises(ValueError, RedisTree, shards=self.pools,
+                          replicas=self.pools)
+
+
+@skipIf(replica_pools() is None, "needs REDISTREE_REPLICAS")
+class TestReplicatedNodes(core.TestNodes):
+
+    def setUp(self):
+        self.rt = RedisTree(replicas=replica_pools(), read_your_writes=60)
+        self.rt.r.flushdb()
+        self.rt.init_fs()
+
+
+@skipIf(replica_pools() is None, "needs REDISTREE_REPLICAS")
+class TestReplication(TestCase):
+
+    def setUp(self):
+        self.rt = RedisTree(replicas=replica_pools(), read_your_writes=0)
+        self.rt.r.flushdb()
+        self.rt.init_fs()
+
+    def test_replicated_reads(self):
+        uid = self.rt.create_child_node('/foo')
+        self.rt.r.execute_command('WAIT', len(self.rt.replicas), 1000)
+        self.assertEqual(self.rt.get_node_at_path('/foo'), uid)
+        self.assertEqual(self.rt.get_children('/'), {'foo': uid})
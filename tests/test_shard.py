@@ -0,0 +1,121 @@
+import os
+from unittest import TestCase
+import redis
+from redistree import RedisTree
+from redistree.shard import HashRing, SHARD_RANGE
+import tests.test_core as core
+
+
+def shard_pools():
+    """The shards to test with: REDISTREE_SHARDS, a comma separated list of
+    host:port/db (several redis-server processes), or by default three
+    databases of the local server."""
+    shards = os.environ.get('REDISTREE_SHARDS',
+                            'localhost:6379/1,localhost:6379/2,'
+                            'localhost:6379/3')
+    pools = []
+    for shard in shards.split(','):
+        address, db = shard.split('/')
+        host, port = address.split(':')
+        pools.append(redis.ConnectionPool(host=host, port=int(port),
+                                          db=int(db)))
+    return pools
+
+
+class ShardedCase(object):
+
+    layout = 'path'
+
+    def setUp(self):
+        self.rt = RedisTree(shards=shard_pools())
+        self.rt.r.flushdb()
+        self.rt.init_fs(layout=self.layout)
+
+
+class TestShardedNodes(ShardedCase, core.TestNodes):
+
+    def test_spread(self):
+        for i in range(30):
+            self.rt.create_child_node('/%d' % i)
+        for client in self.rt.r.clients:
+            self.assertTrue(client.keys('NODE:*'))
+
+    def test_counters(self):
+        uids = set(int(self.rt.create_child_node('/%d' % i))
+                   for i in range(9))
+        self.assertEqual(len(uids), 9)
+        shards = set((uid - self.rt.ROOT_NODE) // SHARD_RANGE for uid in uids)
+        self.assertEqual(len(shards), len(self.rt.r.clients))
+
+    def test_move_across_shards(self):
+        self.rt.create_child_node('/foo')
+        for i in range(20):
+            self.rt.create_child_node('/foo/%d' % i)
+            self.rt.create_child_node('/foo/%d/bar' % i)
+        uid = self.rt.get_node_at_path('/foo/7/bar')
+        self.rt.move_node('/foo', '/other')
+        self.assertEqual(self.rt.get_node_at_path('/other/7/bar'), uid)
+        self.assertRaises(core.BrokenPath, self.rt.get_node_at_path, '/foo')
+        self.assertEqual(len(self.rt.r.keys('TREE:/other*')), 21)
+        self.assertEqual(self.rt.r.keys('TREE:/foo*'), [])
+
+
+class TestShardedNodesUidLayout(ShardedCase, core.TestNodes):
+
+    layout = 'uid'
+
+    def test_delete_very_deep(self):
+        # Without scripts, every creation walks its whole path with the uid
+        # layout: keep the tree small enough for the suite to stay fast.
+        path = ''
+        for i in range(150):
+            path = path + '/f'
+            self.rt.create_child_node(path)
+
+        self.assertEqual(self.rt.delete_node('/f', batch_size=10), 150)
+        self.assertEqual(self.count_nodes(), 1)
+
+
+class TestShardedSymlinks(ShardedCase, core.TestSymlinks):
+
+    def test_symlink_loop(self):
+        a = self.rt.create_child_node('/a')
+        b = self.rt.create_symlink('/a', '/b')
+        self.rt.r.hmset("NODE:%s" % a, {'target': '/b', 'target_node': b})
+        self.rt.r.hdel("NODE:%s" % b, 'final_target', 'final_node')
+        rt = RedisTree(shards=shard_pools(), max_symlink_hops=8)
+        self.assertRaises(core.SymlinkLoopError, rt.get_node_at_path, '/b/c')
+
+
+class TestShardedBatch(ShardedCase, core.TestBatch):
+    pass
+
+
+class TestShardedChangeFeed(core.TestChangeFeed):
+
+    def setUp(self):
+        self.rt = self.client()
+        self.rt.r.flushdb()
+        self.rt.init_fs(change_feed=True)
+
+    def client(self):
+        return RedisTree(shards=shard_pools())
+
+
+class TestShardedSnapshots(ShardedCase, core.TestSnapshots):
+
+    def setUp(self):
+        ShardedCase.setUp(self)
+        self.populate()
+
+
+class TestHashRing(TestCase):
+
+    def test_consistent(self):
+        keys = ['NODE:%d' % i for i in range(1000)]
+        before = HashRing(4)
+        after = HashRing(5)
+        moved = [key for key in keys if before.get(key) != after.get(key)]
+        # About a fifth of the keys go to the new shard, and only there.
+        self.assertTrue(100 < len(moved) < 300)
+        self.assertEqual(set(after.get(key) for key in moved), set([4]))
@@ -0,0 +1,66 @@
+import json
+from unittest import TestCase
+from redistree import RedisTree
+
+
+class TestWalk(TestCase):
+
+    layout = 'path'
+
+    def setUp(self):
+        self.rt = RedisTree()
+        self.rt.r.flushdb()
+        self.rt.init_fs(layout=self.layout)
+        # Big enough for HSCAN to actually return several pages.
+        self.rt.create_many([('/foo/%d' % i, {'size': str(i)})
+                             for i in xrange(600)])
+        self.rt.create_child_node('/foo/3/bar')
+        self.rt.create_child_node('/foo/3/bar/bob')
+        self.rt.create_child_node('/other')
+        self.rt.create_child_node('/other/alice')
+        self.rt.create_symlink('/other', '/foo/link')
+
+    def collect(self, walker):
+        result = {}
+        for path, entries in walker:
+            result.setdefault(path, set()).update([e[0] for e in entries])
+        return result
+
+    def test_walk(self):
+        result = self.collect(self.rt.walk('/foo', count=5))
+        self.assertEqual(sorted(result.keys()),
+                         ['/foo', '/foo/3', '/foo/3/bar'])
+        self.assertEqual(len(result['/foo']), 601)
+        self.assertEqual(result['/foo/3/bar'], set(['bob']))
+
+    def test_topdown(self):
+        paths = [path for path, _ in self.rt.walk('/foo/3')]
+        self.assertEqual(paths, ['/foo/3', '/foo/3/bar'])
+        paths = [path for path, _ in self.rt.walk('/foo/3', topdown=False)]
+        self.assertEqual(paths, ['/foo/3/bar', '/foo/3'])
+
+    def test_follow_symlinks(self):
+        result = self.collect(self.rt.walk('/', follow_symlinks=True))
+        self.assertEqual(result['/foo/link'], set(['alice']))
+        self.assertEqual(result['/other'], set(['alice']))
+
+    def test_with_info(self):
+        for path, entries in self.rt.walk('/foo', with_info=True):
+            for name, uid, info in entries:
+                self.assertEqual(info, self.rt.get_node_info(uid))
+
+    def test_resume(self):
+        walker = self.rt.walk('/foo', count=5)
+        it = iter(walker)
+        first = next(it)
+        self.assertTrue(len(first[1]) < 601)
+        position = json.loads(json.dumps(walker.position))
+
+        result = self.collect(self.rt.walk(None, count=5, position=position))
+        result.setdefault(first[0], set()).update([e[0] for e in first[1]])
+        self.assertEqual(result, self.collect(self.rt.walk('/foo')))
+
+
+class TestWalkUidLayout(TestWalk):
+
+    layout = 'uid'